@@ -0,0 +1,112 @@
+"""
+Daily COVID diagnosis counts and regional case tables from the count cube.
+
+Reads output/case_counts.parquet (from cr_case_cube.py) rather than the
+patient-level dataset, and writes what an_ccount_crude.do used to tabulate
+itself:
+
+    - output/tpp_sgss_counts.svg and output/tpp_type_counts.svg, daily
+      diagnoses by source
+    - output/case_counts_daily.csv, daily diagnoses per source (one column
+      per source, empty on days with none, like `tab ..., matcell`), which
+      an_ccount_crude.do reads to fit its fractional polynomial
+    - output/case_counts_stp.csv and output/case_counts_utla.csv, TPP
+      probable diagnoses and patients per region (`table stp/utla_name,
+      contents(count incohort_date_tpp count patient_id)`)
+"""
+import argparse
+
+import matplotlib.pyplot as plt
+import pandas as pd
+
+from cr_case_cube import POPULATION
+
+LABELS = {
+    "tpp": "TPP",
+    "tppclin": "TPP Clinical",
+    "tpptest": "TPP Test",
+    "tppseq": "TPP Seq",
+    "sgss": "SGSS",
+}
+
+FIGURES = {
+    "tpp_sgss_counts": ["tpp", "sgss"],
+    "tpp_type_counts": ["tppclin", "tpptest", "tppseq"],
+}
+
+
+def daily_counts(cube):
+    cases = cube[cube["source"] != POPULATION]
+    daily = cases.pivot_table(
+        index="date", columns="source", values="count", aggfunc="sum", observed=True
+    )
+    # Days without a diagnosis from a source aren't in its tab
+    return daily.replace(0, float("nan")).reindex(columns=list(LABELS))
+
+
+def plot(daily, sources, path):
+    fig, ax = plt.subplots()
+    for source in sources:
+        series = daily[source].dropna()
+        ax.plot(series.index, series.values, label=LABELS[source])
+    ax.set_ylabel("Daily COVID diagnoses")
+    ax.legend()
+    fig.autofmt_xdate()
+    fig.savefig(path, format="svg")
+    plt.close(fig)
+
+
+def regional_counts(cube, region):
+    counts = cube.pivot_table(
+        index=region, columns="source", values="count", aggfunc="sum", observed=True
+    ).fillna(0)
+    return pd.DataFrame(
+        {"tpp_cases": counts["tpp"], "patients": counts[POPULATION]}
+    ).astype("int64")
+
+
+def self_check():
+    """daily_counts and regional_counts on a small cube, for analysis/self_checks.py"""
+    day = pd.Timestamp
+    cube = pd.DataFrame(
+        {
+            "source": [POPULATION, POPULATION, "tpp", "tpp", "sgss"],
+            "date": [pd.NaT, pd.NaT, day("2020-10-01"), day("2020-10-01"), day("2020-10-02")],
+            "stp": ["E1", "E2", "E1", "E2", "E1"],
+            "utla_name": ["Utla 1", "Utla 2", "Utla 1", "Utla 2", "Utla 1"],
+            "count": [10, 5, 2, 1, 4],
+        }
+    )
+    daily = daily_counts(cube)
+    assert list(daily.columns) == list(LABELS), list(daily.columns)
+    assert daily.loc[day("2020-10-01"), "tpp"] == 3, daily
+    assert daily.loc[day("2020-10-02"), "sgss"] == 4, daily
+    # A day without TPP diagnoses is missing, as in the tab, not 0
+    assert pd.isna(daily.loc[day("2020-10-02"), "tpp"]), daily
+    stp = regional_counts(cube, "stp")
+    assert stp.to_dict("index") == {
+        "E1": {"tpp_cases": 2, "patients": 10},
+        "E2": {"tpp_cases": 1, "patients": 5},
+    }, stp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="output/case_counts.parquet")
+    parser.add_argument("--output-dir", default="output")
+    args = parser.parse_args()
+
+    cube = pd.read_parquet(args.input)
+    daily = daily_counts(cube)
+    for name, sources in FIGURES.items():
+        plot(daily, sources, f"{args.output_dir}/{name}.svg")
+    daily.to_csv(f"{args.output_dir}/case_counts_daily.csv", index_label="date")
+
+    for region, name in [("stp", "stp"), ("utla_name", "utla")]:
+        table = regional_counts(cube, region)
+        print(f"Number of unique {name.upper()}s = {len(table)}")
+        table.to_csv(f"{args.output_dir}/case_counts_{name}.csv")
+
+
+if __name__ == "__main__":
+    main()
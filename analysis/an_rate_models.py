@@ -0,0 +1,267 @@
+"""
+Rates and Poisson models by time since first RTI/nRTI, without stsplit.
+
+an_cox_models.do stsplits the analysis dataset four times (months and weeks
+since first_rti and first_nrti), which multiplies the rows per patient
+before strate and stcox. This reads output/cr_analysis_dataset.parquet (from
+crMAINPY) a chunk at a time and adds each patient's follow-up straight into
+a table of events and person-days per exposure band, follow-up week and
+covariate pattern (age1-age3, male, utla_group). Split rows never exist.
+
+From those tables it gives, for each outcome and exposure variable:
+
+    - strate: events, person-days and rate per 100 person-days per band,
+      with strate's confidence interval (exp(±1.96/sqrt(D)) about the rate)
+    - the Poisson equivalent of `stcox ib1.<band> age1 age2 age3 male,
+      strata(utla_group)`: a piecewise-exponential model with a baseline
+      rate for every UTLA group and follow-up week. The baseline rates are
+      absorbed (profiled out), so only the band and covariate coefficients
+      are estimated, and the rate ratios approximate stcox's hazard ratios.
+      Bands with no events get a rate ratio of 0 and no CI, and a model
+      that doesn't converge is reported without rate ratios
+
+Follow-up is stset's: from enter_date to cox_<outcome>_date, failing if
+<outcome>_diag, and origin enter_date. Records with no follow-up (exit on or
+before entry) are dropped. As with stsplit, a day on a cut point belongs to
+the band before it, and patients with no RTI are pre-RTI throughout.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Outcome: (exit date, failure indicator)
+OUTCOMES = {
+    "covid": ("cox_covid_date", "covid_diag"),
+    "sgss": ("cox_sgss_date", "sgss_diag"),
+}
+
+MONTH_CUTS = [0, 28, 56, 84]
+WEEK_CUTS = [0, 7, 14, 21, 28, 35, 42, 49, 56, 63, 70, 77, 84]
+
+
+def _band_labels(pre, cuts, unit):
+    labels = [pre] + [f"{unit} {i}" for i in range(1, len(cuts))]
+    return labels + [f"{unit} {len(cuts)}+"]
+
+
+# Exposure variable from an_cox_models.do: (first exposure date, cut
+# points, labels of the recoded bands 1, 2, ...)
+EXPOSURES = {
+    "exp_time": ("min_rti", MONTH_CUTS, _band_labels("pre-RTI", MONTH_CUTS, "Month")),
+    "nexp_time": ("min_nrti", MONTH_CUTS, _band_labels("pre-nRTI", MONTH_CUTS, "Month")),
+    "exp_week": ("min_rti", WEEK_CUTS, _band_labels("pre-RTI", WEEK_CUTS, "Week")),
+    "nexp_week": ("min_nrti", WEEK_CUTS, _band_labels("pre-nRTI", WEEK_CUTS, "Week")),
+}
+
+COVARIATES = ["age1", "age2", "age3", "male", "utla_group"]
+
+# Days from entry to exposure for patients with none (the .do file's
+# 01dec2099)
+NEVER = 1e9
+
+# Width (days) of the follow-up periods the baseline rate is constant over
+PERIOD_DAYS = 7
+
+
+def days(series):
+    """Dates as float days since 1970-01-01, NaN where missing"""
+    values = series.values.astype("datetime64[D]")
+    return np.where(np.isnat(values), np.nan, values.astype("int64").astype(float))
+
+
+def person_time(df, outcome, exposure, n_periods):
+    """
+    Events and person-days per (band, period, covariates) for one chunk,
+    from each patient's follow-up (0, T] in days since enter_date
+    """
+    exit_date, failure = OUTCOMES[outcome]
+    first, cuts, _ = EXPOSURES[exposure]
+    enter = days(df["enter_date"])
+    end = days(df[exit_date]) - enter
+    keep = end > 0
+    end = end[keep]
+    # No exposure is never exposed during follow-up
+    since = days(df[first])[keep] - enter[keep]
+    since = np.where(np.isnan(since), NEVER, since)
+    failed = df[failure].to_numpy()[keep] == 1
+
+    covariates = df.loc[keep, COVARIATES].reset_index(drop=True)
+    strata = covariates.groupby(COVARIATES, dropna=False, sort=False)
+    stratum = strata.ngroup().to_numpy()
+    keys = covariates.iloc[np.unique(stratum, return_index=True)[1]]
+    n_strata = len(keys)
+
+    # Band and period of the exit day, for events
+    exit_band = np.searchsorted(cuts, end - since, side="left")
+    exit_period = np.minimum(np.ceil(end / PERIOD_DAYS) - 1, n_periods - 1)
+
+    bounds = [-np.inf] + list(cuts) + [np.inf]
+    rows, labels, events, exposed = [], [], [], []
+    for period in range(n_periods):
+        start = period * PERIOD_DAYS
+        stop = np.inf if period == n_periods - 1 else start + PERIOD_DAYS
+        for band in range(len(cuts) + 1):
+            low = np.maximum(start, since + bounds[band])
+            high = np.minimum(np.minimum(stop, since + bounds[band + 1]), end)
+            days_in = np.clip(high - low, 0, None)
+            if not days_in.any():
+                continue
+            failed_in = failed & (exit_band == band) & (exit_period == period)
+            total = np.bincount(stratum, weights=days_in, minlength=n_strata)
+            (present,) = np.nonzero(total)
+            rows.append(present)
+            labels.append(np.full((len(present), 2), (band + 1, period)))
+            exposed.append(total[present])
+            events.append(
+                np.bincount(stratum, weights=failed_in, minlength=n_strata)[present]
+            )
+    labels = np.concatenate(labels)
+    return keys.iloc[np.concatenate(rows)].assign(
+        band=labels[:, 0],
+        period=labels[:, 1],
+        events=np.concatenate(events),
+        person_days=np.concatenate(exposed),
+    )
+
+
+def combine(tables):
+    keys = ["band", "period"] + COVARIATES
+    return pd.concat(tables).groupby(keys, dropna=False, as_index=False).sum()
+
+
+def rates(table, per=100):
+    """strate: rate per `per` person-days and its 95% CI, per band"""
+    by_band = table.groupby("band")[["events", "person_days"]].sum()
+    rate = by_band["events"] / by_band["person_days"]
+    with np.errstate(divide="ignore"):
+        width = np.exp(1.96 / np.sqrt(by_band["events"]))
+    return by_band.assign(
+        rate=rate * per,
+        rate_lb=np.where(by_band["events"] > 0, rate / width * per, np.nan),
+        rate_ub=np.where(by_band["events"] > 0, rate * width * per, np.nan),
+    )
+
+
+def fit_stratified_poisson(X, events, person_days, strata, max_iter=50, tol=1e-9):
+    """
+    Newton-Raphson for a Poisson model with log(person_days) offset and a
+    free baseline rate per stratum, profiled out: within a stratum the
+    events are multinomial over its rows. Returns (coefficients, standard
+    errors)
+    """
+    n_strata = strata.max() + 1
+    totals = np.bincount(strata, weights=events, minlength=n_strata)
+    offset = np.log(person_days)
+    beta = np.zeros(X.shape[1])
+    for _ in range(max_iter):
+        eta = X @ beta + offset
+        peak = np.full(n_strata, -np.inf)
+        np.maximum.at(peak, strata, eta)
+        weight = np.exp(eta - peak[strata])
+        share = weight / np.bincount(strata, weights=weight, minlength=n_strata)[strata]
+        expected = totals[strata] * share
+        mean = np.column_stack(
+            [np.bincount(strata, weights=share * x, minlength=n_strata) for x in X.T]
+        )
+        score = X.T @ (events - expected)
+        information = (X * expected[:, None]).T @ X - (mean * totals[:, None]).T @ mean
+        step = np.linalg.solve(information, score)
+        beta += step
+        if np.abs(step).max() < tol:
+            break
+    else:
+        raise RuntimeError("Poisson model did not converge")
+    return beta, np.sqrt(np.diag(np.linalg.inv(information)))
+
+
+def rate_ratios(table, n_bands):
+    """
+    The Poisson equivalent of stcox ib1.<band> age1 age2 age3 male,
+    strata(utla_group): returns rate ratios with 95% CIs for bands 2+.
+    Bands without events get a rate ratio of 0 and no CI
+    """
+    table = table[table[COVARIATES].notna().all(axis=1) & (table["utla_group"] != "")]
+    # A band with no events has a rate ratio of 0 (its coefficient's MLE is
+    # -inf), so the model never converges with it. In that limit its rows
+    # have no expected events, which is the same as leaving them out
+    band_events = table.groupby("band")["events"].sum()
+    bands = [band for band in range(2, n_bands + 1) if band_events.get(band, 0) > 0]
+    empty = [band for band in range(2, n_bands + 1) if band_events.get(band, 1) == 0]
+    table = table[~table["band"].isin(empty)]
+    baseline = table.groupby(["utla_group", "period"]).ngroup().to_numpy()
+    # Strata without events carry no information about the coefficients
+    has_events = np.bincount(baseline, weights=table["events"])[baseline] > 0
+    table, baseline = table[has_events], baseline[has_events]
+    baseline = np.unique(baseline, return_inverse=True)[1]
+
+    X = np.column_stack(
+        [(table["band"] == band).to_numpy(float) for band in bands]
+        + [table[name].to_numpy(float) for name in COVARIATES[:-1]]
+    )
+    beta, se = fit_stratified_poisson(
+        X, table["events"].to_numpy(float), table["person_days"].to_numpy(float), baseline
+    )
+    coefficients = pd.DataFrame(
+        {
+            "hr": np.exp(beta),
+            "hr_lb": np.exp(beta - 1.96 * se),
+            "hr_ub": np.exp(beta + 1.96 * se),
+        },
+        index=bands + COVARIATES[:-1],
+    )
+    zero = pd.DataFrame({"hr": 0.0, "hr_lb": np.nan, "hr_ub": np.nan}, index=empty)
+    return pd.concat([coefficients.loc[bands], zero]).sort_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="output/cr_analysis_dataset.parquet")
+    parser.add_argument("--output", default="output/an_rate_models.csv")
+    parser.add_argument("--tables", default="output/an_person_time.parquet")
+    parser.add_argument("--batch-size", type=int, default=250_000)
+    args = parser.parse_args()
+
+    columns = ["enter_date", "censor_date", "min_rti", "min_nrti"] + COVARIATES
+    for exit_date, failure in OUTCOMES.values():
+        columns += [exit_date, failure]
+
+    parquet = pq.ParquetFile(args.input)
+    n_periods = None
+    tables = {(outcome, exposure): [] for outcome in OUTCOMES for exposure in EXPOSURES}
+    for batch in parquet.iter_batches(batch_size=args.batch_size, columns=columns):
+        df = batch.to_pandas(date_as_object=False)
+        if n_periods is None:
+            follow_up = (df["censor_date"] - df["enter_date"]).dt.days.max()
+            n_periods = int(np.ceil(follow_up / PERIOD_DAYS))
+        for outcome, exposure in tables:
+            tables[outcome, exposure].append(person_time(df, outcome, exposure, n_periods))
+        # Combine as we go so memory stays bounded by the number of strata
+        tables = {key: [combine(chunks)] for key, chunks in tables.items()}
+
+    results, person_time_tables = [], []
+    for (outcome, exposure), (table,) in tables.items():
+        labels = EXPOSURES[exposure][2]
+        try:
+            ratios = rate_ratios(table, len(labels))
+        except (RuntimeError, np.linalg.LinAlgError) as e:
+            # Report the rates and carry on with the other models
+            print(f"{outcome} by {exposure}: no rate ratios ({e})")
+            ratios = pd.DataFrame(columns=["hr", "hr_lb", "hr_ub"], dtype=float)
+        result = rates(table).join(ratios)
+        result.insert(0, "label", [labels[band - 1] for band in result.index])
+        result.insert(0, "exposure", exposure)
+        result.insert(0, "outcome", outcome)
+        results.append(result.reset_index())
+        person_time_tables.append(table.assign(outcome=outcome, exposure=exposure))
+        print(f"{outcome} by {exposure}:")
+        print(result.drop(columns=["outcome", "exposure"]).to_string(index=False))
+
+    pd.concat(results, ignore_index=True).to_csv(args.output, index=False)
+    pd.concat(person_time_tables, ignore_index=True).to_parquet(args.tables, index=False)
+    print(f"Wrote rates and rate ratios to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Benchmark the project.yaml actions at several population sizes.
+
+The test runner workflow only checks that the project runs on 10,000 dummy
+patients, so nothing shows what a change (another weekly RTI window, a new
+covariate) costs at the sizes production runs at. This runs the pipeline
+once per --scales population size, each in a scratch copy of the
+repository, and records for every action:
+
+    - wall seconds
+    - peak resident memory of its process (from wait4's rusage)
+    - total size of the outputs project.yaml declares for it
+
+generate_cohort is replaced by dummy_data.py at the given size, since
+cohortextractor's own dummy data is too slow to build at 1M rows; the other
+actions run as project.yaml says, Python with this interpreter and Stata
+with --stata (default $STATA or stata-mp). Actions whose command isn't
+available are recorded as skipped, along with everything that needs them.
+
+Each run is appended to --history (metadata/benchmark_history.json), and
+any action at least REGRESSION_FACTOR times slower, or larger in memory,
+than in the latest earlier run at the same size is flagged. Run from the
+repository root:
+
+    python analysis/benchmark_pipeline.py --scales 10000 100000 1000000
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+# Copied into each scale's scratch directory, as actions write into
+# analysis/ and output/; the rest is only read, so it's linked
+COPIED = ["analysis", "project.yaml"]
+LINKED = ["codelists", "lookups"]
+EMPTY_DIRS = ["output", "logs"]
+
+# Slower (or larger) than the previous run by this factor, and by at least
+# this many seconds (or megabytes)
+REGRESSION_FACTOR = 1.25
+REGRESSION_SECONDS = 2
+REGRESSION_MB = 50
+
+
+def load_actions(path="project.yaml"):
+    with open(path) as f:
+        return yaml.safe_load(f)["actions"]
+
+
+def with_needs(actions, wanted):
+    """`wanted` and everything they need, in project.yaml order"""
+    needed, pending = set(), list(wanted)
+    while pending:
+        name = pending.pop()
+        if name not in actions:
+            raise ValueError(f"No action called {name} in project.yaml")
+        if name not in needed:
+            needed.add(name)
+            pending.extend(actions[name].get("needs") or [])
+    return [name for name in actions if name in needed]
+
+
+def output_paths(action):
+    """Output path patterns of an action, across sensitivity levels"""
+    return [
+        path
+        for outputs in (action.get("outputs") or {}).values()
+        for path in outputs.values()
+    ]
+
+
+def command(action, stata, dummy_rows=None):
+    """
+    The local command for an action, or None if it can't run here. With
+    `dummy_rows`, the cohort comes from dummy_data.py rather than
+    cohortextractor
+    """
+    image, *args = action["run"].split()
+    image = image.split(":")[0]
+    if image == "cohortextractor":
+        if dummy_rows is None:
+            executable = shutil.which("cohortextractor")
+            return [executable, *args] if executable else None
+        (cohort,) = output_paths(action)
+        return [
+            sys.executable,
+            "analysis/dummy_data.py",
+            "--rows",
+            str(dummy_rows),
+            "--output",
+            cohort,
+            "--seed",
+            "0",
+        ]
+    if image == "python":
+        return [sys.executable, *args]
+    if image.startswith("stata"):
+        return [stata, "-b", "do", *args] if shutil.which(stata) else None
+    return None
+
+
+def run_measured(cmd, cwd, timeout=None, log=None):
+    """
+    Run `cmd`, returning (exit code, wall seconds, peak RSS in MB). Its
+    output goes to the file object `log` if given, else stdout is discarded
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        cmd, cwd=cwd, stdout=log or subprocess.DEVNULL, stderr=log or None
+    )
+    timer = threading.Timer(timeout, process.kill) if timeout else None
+    if timer:
+        timer.start()
+    # wait4 rather than wait, for the child's own resource usage
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    if timer:
+        timer.cancel()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux
+    return process.returncode, round(seconds, 3), round(usage.ru_maxrss / 1024, 1)
+
+
+def output_mb(action, cwd):
+    paths = [
+        path
+        for pattern in output_paths(action)
+        for path in glob.glob(os.path.join(cwd, pattern))
+    ]
+    return round(sum(os.path.getsize(path) for path in paths) / 2**20, 3)
+
+
+def scratch_copy(directory):
+    for name in COPIED:
+        source, target = os.path.abspath(name), os.path.join(directory, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, target, ignore=shutil.ignore_patterns("__pycache__"))
+        else:
+            shutil.copy(source, target)
+    for name in LINKED:
+        os.symlink(os.path.abspath(name), os.path.join(directory, name))
+    for name in EMPTY_DIRS:
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+
+def benchmark_scale(actions, names, scale, stata, timeout=None):
+    """{action: {"status", "seconds", "peak_rss_mb", "output_mb"}} at one size"""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix=f"benchmark_{scale}_") as directory:
+        scratch_copy(directory)
+        for name in names:
+            action = actions[name]
+            blocked = [
+                need
+                for need in action.get("needs") or []
+                if results.get(need, {}).get("status") != "ok"
+            ]
+            cmd = command(action, stata, scale)
+            if blocked or cmd is None:
+                results[name] = {"status": "skipped"}
+                print(f"{scale} {name}: skipped")
+                continue
+            code, seconds, rss = run_measured(cmd, directory, timeout)
+            results[name] = {
+                "status": "ok" if code == 0 else f"failed ({code})",
+                "seconds": seconds,
+                "peak_rss_mb": rss,
+                "output_mb": output_mb(action, directory),
+            }
+            print(f"{scale} {name}: {results[name]}")
+    return results
+
+
+def regressions(run, history):
+    """
+    Actions in `run` slower or larger than in the latest earlier run at the
+    same scale where they succeeded
+    """
+    flagged = []
+    for scale, results in run["scales"].items():
+        for name, now in results.items():
+            if now["status"] != "ok":
+                continue
+            before = next(
+                (
+                    earlier["scales"][scale][name]
+                    for earlier in reversed(history)
+                    if earlier["scales"].get(scale, {}).get(name, {}).get("status") == "ok"
+                ),
+                None,
+            )
+            if before is None:
+                continue
+            for measure, threshold in [
+                ("seconds", REGRESSION_SECONDS),
+                ("peak_rss_mb", REGRESSION_MB),
+            ]:
+                if (
+                    now[measure] >= before[measure] * REGRESSION_FACTOR
+                    and now[measure] - before[measure] >= threshold
+                ):
+                    flagged.append(
+                        {
+                            "scale": scale,
+                            "action": name,
+                            "measure": measure,
+                            "before": before[measure],
+                            "now": now[measure],
+                        }
+                    )
+    return flagged
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument(
+        "--actions",
+        nargs="+",
+        default=["crMAIN", "anCOX", "anCASE", "anSTP", "feasibility"],
+        help="actions to time; everything they need runs (and is timed) too",
+    )
+    parser.add_argument("--stata", default=os.environ.get("STATA", "stata-mp"))
+    parser.add_argument("--timeout", type=float, help="seconds before an action is killed")
+    parser.add_argument("--history", default="metadata/benchmark_history.json")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    actions = load_actions()
+    names = with_needs(actions, args.actions)
+    run = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "scales": {
+            str(scale): benchmark_scale(actions, names, scale, args.stata, args.timeout)
+            for scale in args.scales
+        },
+    }
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+    run["regressions"] = regressions(run, history)
+    with open(args.history, "w") as f:
+        json.dump(history + [run], f, indent=2)
+
+    for scale, results in run["scales"].items():
+        print(f"\n{scale} patients")
+        for name, result in results.items():
+            if result["status"] == "ok":
+                print(
+                    f"  {name:<16} {result['seconds']:>9.1f}s {result['peak_rss_mb']:>9.1f} MB "
+                    f"RSS {result['output_mb']:>9.1f} MB out"
+                )
+            else:
+                print(f"  {name:<16} {result['status']}")
+    for flag in run["regressions"]:
+        print(
+            f"Regression: {flag['action']} at {flag['scale']} patients, "
+            f"{flag['measure']} {flag['before']} -> {flag['now']}"
+        )
+    print(f"Appended run to {args.history}")
+    if run["regressions"] and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
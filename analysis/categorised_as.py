@@ -0,0 +1,362 @@
+"""
+Evaluate categorised_as expressions over whole columns at once.
+
+categorised_as definitions map each category to an expression in
+cohortextractor's restricted SQL dialect:
+
+    "most_recent_smoking_code = 'E' OR (most_recent_smoking_code = 'N' AND ever_smoked)"
+
+The backend turns them into a CASE expression, so the first matching
+category wins and the single "DEFAULT" category takes everyone else. Each
+expression is parsed here once into a small AST (names, numbers, quoted
+strings, + - * /, comparisons, NOT, AND, OR and parentheses, as
+cohortextractor allows) and compiled to a function from {name: array} to a
+boolean mask, so categorising a cohort is a handful of NumPy operations
+per category rather than a pass over its rows.
+
+As in cohortextractor, a name that isn't compared or combined with anything
+means "has a value": != 0 for numbers and flags, != '' for strings and not
+NaT for dates, so columns should hold those empty values (not masks) for
+patients without one.
+
+dummy_data.py uses this to draw hidden sub-variables that agree with each
+patient's drawn category, and simulated_ehr.py to find the source values
+that give each category (Categorisation.witnesses).
+"""
+import itertools
+import re
+
+import numpy as np
+
+DEFAULT = "DEFAULT"
+
+# One token per match; whitespace and -- comments are skipped
+TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+|--[^\n]*)
+    |(?P<number>\d+(?:\.\d*)?|\.\d+)
+    |(?P<string>'[^']*')
+    |(?P<compare><=|>=|!=|=|<|>)
+    |(?P<operator>[-+*/])
+    |(?P<paren>[()])
+    |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    """,
+    re.VERBOSE,
+)
+KEYWORDS = {"AND", "OR", "NOT"}
+
+COMPARE = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+
+class InvalidExpressionError(ValueError):
+    pass
+
+
+def tokenize(expression):
+    """[(kind, value), ...] of an expression"""
+    tokens, position = [], 0
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match:
+            raise InvalidExpressionError(
+                f"Unexpected {expression[position:position + 10]!r} in: {expression}"
+            )
+        kind, value = match.lastgroup, match.group()
+        if kind == "name" and value in KEYWORDS:
+            kind = value
+        if kind != "space":
+            tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """
+    Recursive descent over the tokens, loosest binding first:
+    OR, AND, NOT, comparison, + -, * /, then names, literals and parentheses.
+    Nodes are tuples:
+
+        ("name", name)  ("number", value)  ("string", value)
+        ("or", left, right)  ("and", left, right)  ("not", operand)
+        ("compare", op, left, right)  ("arithmetic", op, left, right)
+        ("negate", operand)
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def error(self, message):
+        return InvalidExpressionError(f"{message} in: {self.expression.strip()}")
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] != kind) or (value and token[1] != value):
+            raise self.error(f"Expected {value or kind}, found {token[1] or 'the end'}")
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise self.error("Empty expression")
+        node = self.disjunction()
+        if self.peek()[0] is not None:
+            raise self.error(f"Unexpected {self.peek()[1]}")
+        return node
+
+    def disjunction(self):
+        node = self.conjunction()
+        while self.peek()[0] == "OR":
+            self.take()
+            node = ("or", node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.peek()[0] == "AND":
+            self.take()
+            node = ("and", node, self.negation())
+        return node
+
+    def negation(self):
+        if self.peek()[0] == "NOT":
+            self.take()
+            return ("not", self.negation())
+        return self.comparison()
+
+    def comparison(self):
+        node = self.sum()
+        if self.peek()[0] == "compare":
+            _, op = self.take()
+            node = ("compare", op, node, self.sum())
+        return node
+
+    def sum(self):
+        node = self.product()
+        while self.peek()[1] in ("+", "-") and self.peek()[0] == "operator":
+            _, op = self.take()
+            node = ("arithmetic", op, node, self.product())
+        return node
+
+    def product(self):
+        node = self.unary()
+        while self.peek()[1] in ("*", "/") and self.peek()[0] == "operator":
+            _, op = self.take()
+            node = ("arithmetic", op, node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek() == ("operator", "-"):
+            self.take()
+            return ("negate", self.unary())
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.peek()
+        if kind == "paren" and value == "(":
+            self.take()
+            node = self.disjunction()
+            self.take("paren", ")")
+            return node
+        if kind == "name":
+            self.take()
+            return ("name", value)
+        if kind == "number":
+            self.take()
+            return ("number", float(value) if "." in value else int(value))
+        if kind == "string":
+            self.take()
+            return ("string", value[1:-1])
+        raise self.error(f"Expected a value, found {value or 'the end'}")
+
+
+def parse(expression):
+    return Parser(expression).parse()
+
+
+def names(node):
+    """Column names an AST references"""
+    if node[0] == "name":
+        return {node[1]}
+    return set().union(*(names(child) for child in node[1:] if isinstance(child, tuple)))
+
+
+def has_value(values):
+    """cohortextractor's implicit comparison with the column's empty value"""
+    values = np.asarray(values)
+    if values.dtype.kind == "M":
+        return ~np.isnat(values)
+    if values.dtype.kind in "US":
+        return values != ""
+    if values.dtype.kind == "O":
+        return (values != "") & (values != None)  # noqa: E711
+    return values != 0
+
+
+def literal_like(value, values):
+    """A string literal compared with a date column is a date"""
+    if isinstance(value, str) and np.asarray(values).dtype.kind == "M":
+        return np.datetime64(value)
+    return value
+
+
+def compile_value(node):
+    """A function from {name: array} to the node's values"""
+    kind = node[0]
+    if kind == "name":
+        name = node[1]
+        return lambda columns: columns[name]
+    if kind in ("number", "string"):
+        value = node[1]
+        return lambda columns: value
+    if kind == "negate":
+        operand = compile_value(node[1])
+        return lambda columns: -operand(columns)
+    if kind == "arithmetic":
+        _, op, left, right = node
+        left, right = compile_value(left), compile_value(right)
+        if op == "/":
+            return lambda columns: divide(left(columns), right(columns))
+        ufunc = {"+": np.add, "-": np.subtract, "*": np.multiply}[op]
+        return lambda columns: ufunc(left(columns), right(columns))
+    raise InvalidExpressionError(f"A condition can't be used as a value: {node}")
+
+
+def divide(left, right):
+    """T-SQL division: integers truncate towards zero"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        quotient = np.true_divide(left, right)
+    if np.asarray(left).dtype.kind in "iub" and np.asarray(right).dtype.kind in "iub":
+        return np.trunc(quotient)
+    return quotient
+
+
+def compile_condition(node):
+    """A function from {name: array} to the node's boolean mask"""
+    kind = node[0]
+    if kind == "name":
+        name = node[1]
+        return lambda columns: has_value(columns[name])
+    if kind in ("and", "or"):
+        left, right = compile_condition(node[1]), compile_condition(node[2])
+        combine = np.logical_and if kind == "and" else np.logical_or
+        return lambda columns: combine(left(columns), right(columns))
+    if kind == "not":
+        operand = compile_condition(node[1])
+        return lambda columns: ~operand(columns)
+    if kind == "compare":
+        _, op, left, right = node
+        left, right, compare = compile_value(left), compile_value(right), COMPARE[op]
+
+        def evaluate(columns):
+            a, b = left(columns), right(columns)
+            return compare(literal_like(a, b), literal_like(b, a))
+
+        return evaluate
+    raise InvalidExpressionError(f"Not a condition: {node}")
+
+
+class Categorisation:
+    """
+    A categorised_as definition, compiled. `labels` are its categories in
+    definition order, DEFAULT included, and `names` the columns it reads
+    """
+
+    def __init__(self, category_definitions):
+        defaults = [label for label, expression in category_definitions.items() if expression == DEFAULT]
+        if len(defaults) != 1:
+            raise ValueError("Exactly one category must be given the definition 'DEFAULT'")
+        self.default = defaults[0]
+        self.labels = list(category_definitions)
+        self.trees = {
+            label: parse(expression)
+            for label, expression in category_definitions.items()
+            if label != self.default
+        }
+        # In definition order, so np.select's first match is the CASE's
+        self.conditions = [
+            (self.labels.index(label), compile_condition(tree)) for label, tree in self.trees.items()
+        ]
+        self.names = set().union(*(names(tree) for tree in self.trees.values()))
+
+    def masks(self, columns):
+        """{label: mask} of each non-default category's own expression"""
+        n = length(columns)
+        return {
+            self.labels[index]: np.broadcast_to(condition(columns), (n,))
+            for index, condition in self.conditions
+        }
+
+    def codes(self, columns):
+        """Index into `labels` of each row's category, the first to match"""
+        masks = list(self.masks(columns).values())
+        choices = [index for index, _ in self.conditions]
+        default = self.labels.index(self.default)
+        if not masks:
+            return np.full(length(columns), default)
+        return np.select(masks, choices, default)
+
+    def assign(self, columns):
+        """Each row's category label"""
+        return np.array(self.labels, dtype=object)[self.codes(columns)]
+
+    def witnesses(self, domains=None):
+        """
+        {label: {name: value}}: for each category that can be reached, the
+        first combination of candidate values that's categorised as it.
+        Candidates are the empty value and whatever each name is compared
+        with (and one either side of numbers), unless given in `domains`
+        """
+        candidates = dict(self.candidates(), **(domains or {}))
+        ordered = sorted(self.names)
+        combinations = list(itertools.product(*(candidates[name] for name in ordered)))
+        columns = {
+            name: np.array([combination[i] for combination in combinations])
+            for i, name in enumerate(ordered)
+        }
+        found = {}
+        for row, code in enumerate(self.codes(columns)):
+            found.setdefault(self.labels[code], {name: columns[name][row].item() for name in ordered})
+        return {label: found[label] for label in self.labels if label in found}
+
+    def candidates(self):
+        literals = {name: set() for name in self.names}
+        for tree in self.trees.values():
+            collect_literals(tree, literals)
+        candidates = {}
+        for name, values in literals.items():
+            if any(isinstance(value, str) for value in values):
+                candidates[name] = [""] + sorted(str(value) for value in values if value != "")
+            else:
+                around = {value + step for value in values for step in (-1, 0, 1)}
+                candidates[name] = sorted({0, 1} | around, key=lambda value: (value != 0, value))
+        return candidates
+
+
+def collect_literals(node, literals):
+    """Add the literals each name is directly compared with to `literals`"""
+    if node[0] == "compare":
+        _, _, left, right = node
+        for one, other in ((left, right), (right, left)):
+            if one[0] == "name" and other[0] in ("number", "string"):
+                literals[one[1]].add(other[1])
+    for child in node[1:]:
+        if isinstance(child, tuple):
+            collect_literals(child, literals)
+
+
+def length(columns):
+    return len(next(iter(columns.values()))) if columns else 0
@@ -1,230 +1,317 @@
+import hashlib
+import os
+import pickle
+
+import numpy as np
 from cohortextractor import (
     codelist_from_csv,
     codelist,
 )
 
-
-# OUTCOME CODELISTS
-covid_codelist = codelist_from_csv(
-    "codelists/opensafely-covid-identification.csv",
-    system="icd10",
-    column="icd10_code",
-)
-
-covid_identification_in_primary_care_case_codes_clinical = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-covid_identification_in_primary_care_case_codes_test = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-covid_identification_in_primary_care_case_codes_seq = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-covid_identification_in_primary_care_case_codes_anytest = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-suspected-covid-had-test.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-covid_identification_in_primary_care_case_codes_negtest = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-antigen-test-negative.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-
-# EXPOSURES CODELISTS
-lrti_codes = codelist_from_csv(
-    "codelists/opensafely-lower-respiratory-tract-infection.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-copd_lrti_codes = codelist_from_csv(
-    "codelists/opensafely-copd-infection.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-rti_codes = codelist_from_csv(
-    "codelists/user-dgrint-respiratory-tract-infection-dev.csv",
-    system="ctv3",
-    column="code",
-)
-
-# DEMOGRAPHICS CODELISTS
-aplastic_codes = codelist_from_csv(
-    "codelists/opensafely-aplastic-anaemia.csv", system="ctv3", column="CTV3ID"
-)
-
-hiv_codes = codelist_from_csv(
-    "codelists/opensafely-hiv.csv", system="ctv3", column="CTV3ID", category_column="CTV3ID"
-)
-
-permanent_immune_codes = codelist_from_csv(
-    "codelists/opensafely-permanent-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-temp_immune_codes = codelist_from_csv(
-    "codelists/opensafely-temporary-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-stroke = codelist_from_csv(
-    "codelists/opensafely-stroke-updated.csv", system="ctv3", column="CTV3ID"
-)
-
-dementia = codelist_from_csv(
-    "codelists/opensafely-dementia.csv", system="ctv3", column="CTV3ID"
-)
-
-clear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-clear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-
-unclear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-unclear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-
-other_neuro = codelist_from_csv(
-    "codelists/opensafely-other-neurological-conditions.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-ethnicity_codes = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    system="ctv3",
-    column="Code",
-    category_column="Grouping_6",
-)
-ethnicity_codes_16 = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    system="ctv3",
-    column="Code",
-    category_column="Grouping_16",
-)
-
-chronic_respiratory_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-respiratory-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-asthma_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-diagnosis.csv", system="ctv3", column="CTV3ID"
-)
-
-salbutamol_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-inhaler-salbutamol-medication.csv",
-    system="snomed",
-    column="id",
-)
-
-ics_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-inhaler-steroid-medication.csv",
-    system="snomed",
-    column="id",
-)
-
-pred_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-oral-prednisolone-medication.csv",
-    system="snomed",
-    column="snomed_id",
-)
-
-chronic_cardiac_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-cardiac-disease.csv", system="ctv3", column="CTV3ID"
-)
-
-diabetes_codes = codelist_from_csv(
-    "codelists/opensafely-diabetes.csv", system="ctv3", column="CTV3ID"
-)
-
-lung_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-lung-cancer.csv", system="ctv3", column="CTV3ID"
-)
-
-haem_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-haematological-cancer.csv", system="ctv3", column="CTV3ID"
-)
-
-other_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-bone_marrow_transplant_codes = codelist_from_csv(
-    "codelists/opensafely-bone-marrow-transplant.csv", system="ctv3", column="CTV3ID"
-)
-
-chemo_radio_therapy_codes = codelist_from_csv(
-    "codelists/opensafely-chemotherapy-or-radiotherapy-updated.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-chronic_liver_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-liver-disease.csv", system="ctv3", column="CTV3ID"
-)
-gi_bleed_and_ulcer_codes = codelist_from_csv(
-    "codelists/opensafely-gi-bleed-or-ulcer.csv", system="ctv3", column="CTV3ID"
-)
-inflammatory_bowel_disease_codes = codelist_from_csv(
-    "codelists/opensafely-inflammatory-bowel-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
+# Parsed CSV codelists are cached here, keyed by a hash of the CSV contents
+# and the arguments used to read it, so an edited CSV is always re-parsed.
+# Cached codelists are compiled: duplicate rows (e.g. several descriptions
+# of one CTV3 code) removed and codes sorted
+CODELIST_CACHE_DIR = ".cache/codelists"
+CODELIST_CACHE_VERSION = "compiled-1"
+
+
+# CSV CODELISTS
+# name: (filename, system, column, category_column)
+# These are loaded lazily: each CSV is only read (or fetched from the cache)
+# the first time its name is used, so importing this module no longer parses
+# every file in codelists/
+CSV_CODELISTS = {
+    # OUTCOME CODELISTS
+    "covid_codelist": (
+        "codelists/opensafely-covid-identification.csv", "icd10", "icd10_code", None,
+    ),
+    "covid_identification_in_primary_care_case_codes_clinical": (
+        "codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
+        "ctv3", "CTV3ID", None,
+    ),
+    "covid_identification_in_primary_care_case_codes_test": (
+        "codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
+        "ctv3", "CTV3ID", None,
+    ),
+    "covid_identification_in_primary_care_case_codes_seq": (
+        "codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
+        "ctv3", "CTV3ID", None,
+    ),
+    "covid_identification_in_primary_care_case_codes_anytest": (
+        "codelists/opensafely-covid-identification-in-primary-care-suspected-covid-had-test.csv",
+        "ctv3", "CTV3ID", None,
+    ),
+    "covid_identification_in_primary_care_case_codes_negtest": (
+        "codelists/opensafely-covid-identification-in-primary-care-antigen-test-negative.csv",
+        "ctv3", "CTV3ID", None,
+    ),
+
+    # EXPOSURES CODELISTS
+    "lrti_codes": (
+        "codelists/opensafely-lower-respiratory-tract-infection.csv", "ctv3", "CTV3ID", None,
+    ),
+    "copd_lrti_codes": (
+        "codelists/opensafely-copd-infection.csv", "ctv3", "CTV3ID", None,
+    ),
+    "rti_codes": (
+        "codelists/user-dgrint-respiratory-tract-infection-dev.csv", "ctv3", "code", None,
+    ),
+
+    # DEMOGRAPHICS CODELISTS
+    "aplastic_codes": (
+        "codelists/opensafely-aplastic-anaemia.csv", "ctv3", "CTV3ID", None,
+    ),
+    "hiv_codes": (
+        "codelists/opensafely-hiv.csv", "ctv3", "CTV3ID", "CTV3ID",
+    ),
+    "permanent_immune_codes": (
+        "codelists/opensafely-permanent-immunosuppression.csv", "ctv3", "CTV3ID", None,
+    ),
+    "temp_immune_codes": (
+        "codelists/opensafely-temporary-immunosuppression.csv", "ctv3", "CTV3ID", None,
+    ),
+    "stroke": (
+        "codelists/opensafely-stroke-updated.csv", "ctv3", "CTV3ID", None,
+    ),
+    "dementia": (
+        "codelists/opensafely-dementia.csv", "ctv3", "CTV3ID", None,
+    ),
+    "clear_smoking_codes": (
+        "codelists/opensafely-smoking-clear.csv", "ctv3", "CTV3Code", "Category",
+    ),
+    "unclear_smoking_codes": (
+        "codelists/opensafely-smoking-unclear.csv", "ctv3", "CTV3Code", "Category",
+    ),
+    "other_neuro": (
+        "codelists/opensafely-other-neurological-conditions.csv", "ctv3", "CTV3ID", None,
+    ),
+    "ethnicity_codes": (
+        "codelists/opensafely-ethnicity.csv", "ctv3", "Code", "Grouping_6",
+    ),
+    "ethnicity_codes_16": (
+        "codelists/opensafely-ethnicity.csv", "ctv3", "Code", "Grouping_16",
+    ),
+    "chronic_respiratory_disease_codes": (
+        "codelists/opensafely-chronic-respiratory-disease.csv", "ctv3", "CTV3ID", None,
+    ),
+    "asthma_codes": (
+        "codelists/opensafely-asthma-diagnosis.csv", "ctv3", "CTV3ID", None,
+    ),
+    "salbutamol_codes": (
+        "codelists/opensafely-asthma-inhaler-salbutamol-medication.csv", "snomed", "id", None,
+    ),
+    "ics_codes": (
+        "codelists/opensafely-asthma-inhaler-steroid-medication.csv", "snomed", "id", None,
+    ),
+    "pred_codes": (
+        "codelists/opensafely-asthma-oral-prednisolone-medication.csv", "snomed", "snomed_id", None,
+    ),
+    "chronic_cardiac_disease_codes": (
+        "codelists/opensafely-chronic-cardiac-disease.csv", "ctv3", "CTV3ID", None,
+    ),
+    "diabetes_codes": (
+        "codelists/opensafely-diabetes.csv", "ctv3", "CTV3ID", None,
+    ),
+    "lung_cancer_codes": (
+        "codelists/opensafely-lung-cancer.csv", "ctv3", "CTV3ID", None,
+    ),
+    "haem_cancer_codes": (
+        "codelists/opensafely-haematological-cancer.csv", "ctv3", "CTV3ID", None,
+    ),
+    "other_cancer_codes": (
+        "codelists/opensafely-cancer-excluding-lung-and-haematological.csv", "ctv3", "CTV3ID", None,
+    ),
+    "bone_marrow_transplant_codes": (
+        "codelists/opensafely-bone-marrow-transplant.csv", "ctv3", "CTV3ID", None,
+    ),
+    "chemo_radio_therapy_codes": (
+        "codelists/opensafely-chemotherapy-or-radiotherapy-updated.csv", "ctv3", "CTV3ID", None,
+    ),
+    "chronic_liver_disease_codes": (
+        "codelists/opensafely-chronic-liver-disease.csv", "ctv3", "CTV3ID", None,
+    ),
+    "gi_bleed_and_ulcer_codes": (
+        "codelists/opensafely-gi-bleed-or-ulcer.csv", "ctv3", "CTV3ID", None,
+    ),
+    "inflammatory_bowel_disease_codes": (
+        "codelists/opensafely-inflammatory-bowel-disease.csv", "ctv3", "CTV3ID", None,
+    ),
+    "dialysis_codes": (
+        "codelists/opensafely-chronic-kidney-disease.csv", "ctv3", "CTV3ID", None,
+    ),
+    "organ_transplant_codes": (
+        "codelists/opensafely-solid-organ-transplantation.csv", "ctv3", "CTV3ID", None,
+    ),
+    "spleen_codes": (
+        "codelists/opensafely-asplenia.csv", "ctv3", "CTV3ID", None,
+    ),
+    "sickle_cell_codes": (
+        "codelists/opensafely-sickle-cell-disease.csv", "ctv3", "CTV3ID", None,
+    ),
+    "ra_sle_psoriasis_codes": (
+        "codelists/opensafely-ra-sle-psoriasis.csv", "ctv3", "CTV3ID", None,
+    ),
+    "hypertension_codes": (
+        "codelists/opensafely-hypertension.csv", "ctv3", "CTV3ID", None,
+    ),
+}
+
+
+# INLINE CODELISTS
 creatinine_codes = codelist(["XE2q5"], system="ctv3")
 
 hba1c_new_codes = codelist(["XaPbt", "Xaeze", "Xaezd"], system="ctv3")
 hba1c_old_codes = codelist(["X772q", "XaERo", "XaERp"], system="ctv3")
 
-
-dialysis_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-kidney-disease.csv", system="ctv3", column="CTV3ID"
-)
-
-organ_transplant_codes = codelist_from_csv(
-    "codelists/opensafely-solid-organ-transplantation.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-spleen_codes = codelist_from_csv(
-    "codelists/opensafely-asplenia.csv", system="ctv3", column="CTV3ID"
-)
-
-sickle_cell_codes = codelist_from_csv(
-    "codelists/opensafely-sickle-cell-disease.csv", system="ctv3", column="CTV3ID"
-)
-
-ra_sle_psoriasis_codes = codelist_from_csv(
-    "codelists/opensafely-ra-sle-psoriasis.csv", system="ctv3", column="CTV3ID"
-)
-
 systolic_blood_pressure_codes = codelist(["2469."], system="ctv3")
 diastolic_blood_pressure_codes = codelist(["246A."], system="ctv3")
 
-hypertension_codes = codelist_from_csv(
-    "codelists/opensafely-hypertension.csv", system="ctv3", column="CTV3ID"
-)
\ No newline at end of file
+
+__all__ = [
+    *CSV_CODELISTS,
+    "creatinine_codes",
+    "hba1c_new_codes",
+    "hba1c_old_codes",
+    "systolic_blood_pressure_codes",
+    "diastolic_blood_pressure_codes",
+]
+
+
+def compile_codelist(codes):
+    """
+    The same codelist without duplicate rows and sorted by code, which is
+    what the cache stores and CodeIndex searches
+    """
+    # cohortextractor's codelist() can't build an empty one
+    if not codes:
+        return codes
+    return codelist(sorted(set(codes)), codes.system)
+
+
+def load_codelist(filename, system, column, category_column=None):
+    """
+    Read and compile a CSV codelist, using the on-disk cache when the file
+    is unchanged
+    """
+    with open(filename, "rb") as f:
+        key = hashlib.sha256(f.read())
+    key.update(f"{system}|{column}|{category_column}|{CODELIST_CACHE_VERSION}".encode())
+    cache_path = os.path.join(CODELIST_CACHE_DIR, f"{key.hexdigest()}.pickle")
+
+    try:
+        with open(cache_path, "rb") as f:
+            return codelist(pickle.load(f), system)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+
+    codes = compile_codelist(
+        codelist_from_csv(
+            filename, system=system, column=column, category_column=category_column
+        )
+    )
+
+    # The cache is only an optimisation: a read-only checkout just re-parses
+    try:
+        os.makedirs(CODELIST_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(list(codes), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return codes
+
+
+def __getattr__(name):
+    # Called only for names not already in the module namespace, so each
+    # codelist is loaded once and then stored as a normal module attribute
+    if name not in CSV_CODELISTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    codes = load_codelist(*CSV_CODELISTS[name])
+    globals()[name] = codes
+    return codes
+
+
+def _named(name):
+    return globals()[name] if name in globals() else __getattr__(name)
+
+
+class CodeIndex:
+    """
+    A codelist as a sorted array, for matching whole columns of event codes
+    at once (dummy or simulated event tables, local backends) instead of
+    testing `code in codelist` row by row
+    """
+
+    def __init__(self, codes):
+        codes = compile_codelist(codes)
+        self.system = codes.system
+        self.has_categories = codes.has_categories
+        if codes.has_categories:
+            self.codes = np.array([code for code, _ in codes], dtype=str)
+            self.categories = np.array([category for _, category in codes], dtype=object)
+        else:
+            self.codes = np.array(list(codes), dtype=str)
+            self.categories = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def positions(self, values):
+        """Index of each value in self.codes, or -1 where it isn't one"""
+        # pandas is only needed here, not to import the study definition
+        import pandas as pd
+
+        # Event tables repeat a few thousand codes millions of times, so
+        # only the distinct values are searched for
+        labels, distinct = pd.factorize(np.asarray(values, dtype=object))
+        distinct = np.asarray(distinct, dtype=str)
+        if not len(self.codes):
+            return np.full(len(labels), -1)
+        found = np.searchsorted(self.codes, distinct)
+        found = np.minimum(found, len(self.codes) - 1)
+        found = np.where(self.codes[found] == distinct, found, -1)
+        return np.where(labels >= 0, found[labels], -1)
+
+    def contains(self, values):
+        return self.positions(values) >= 0
+
+    def category_of(self, values):
+        """Each value's category, or None where it isn't in the codelist"""
+        if not self.has_categories:
+            raise ValueError("codelist has no categories")
+        found = self.positions(values)
+        return np.where(found >= 0, self.categories[found], None)
+
+
+def self_check():
+    """CodeIndex on small codelists, for analysis/self_checks.py"""
+    index = CodeIndex(codelist(["Y20d1", "X73lE", "Y20d1", "XaLTE"], "ctv3"))
+    assert list(index.codes) == ["X73lE", "XaLTE", "Y20d1"], index.codes
+    found = index.positions(["Y20d1", "Y20d2", None, "X73lE", "ZZZZZ", "0"])
+    assert list(found) == [2, -1, -1, 0, -1, -1], found
+    assert not index.contains(["Y20d2", "ZZZZZ"]).any()
+    assert len(index.positions([])) == 0
+
+    # Codes are matched exactly, not as prefixes or case-insensitively
+    categorised = CodeIndex(codelist([("1371.", "1"), ("137L.", "2"), ("137S.", "3")], "ctv3"))
+    labels = categorised.category_of(["137S.", "1371", "137l.", "1371."])
+    assert list(labels) == ["3", None, None, "1"], labels
+
+    # codelist() can't build an empty codelist, so empty one
+    empty = codelist(["Y20d1"], "ctv3")
+    empty.clear()
+    assert list(CodeIndex(empty).positions(["Y20d1", None])) == [-1, -1]
+
+
+if __name__ == "__main__":
+    # Compile (and cache) every CSV codelist and report what it removed
+    by_system = {}
+    for name, (filename, system, column, category_column) in CSV_CODELISTS.items():
+        rows = codelist_from_csv(filename, system, column, category_column)
+        codes = _named(name)
+        by_system.setdefault(system, set()).update(CodeIndex(codes).codes)
+        print(f"{name:<60} {len(rows):>5} rows -> {len(codes):>5} codes")
+    for system, codes in sorted(by_system.items()):
+        print(f"{system}: {len(codes)} distinct codes across all codelists")
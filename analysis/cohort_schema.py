@@ -0,0 +1,58 @@
+import json
+
+# COLUMN SCHEMA FOR THE COHORT OUTPUT
+# Derived from the study definition (each variable's column_type, returning
+# and date_format) so the Python actions can type the cohort without
+# cohortextractor installed. Regenerate after editing study_definition.py:
+#
+#     python analysis/cohort_schema.py
+SCHEMA_PATH = "./analysis/cohort_schema.json"
+
+DATE_PRECISION = {"YYYY-MM-DD": "day", "YYYY-MM": "month", "YYYY": "year"}
+
+# Returned as integers but conceptually categories (cohortextractor treats
+# them the same way when it writes binary formats)
+CATEGORICAL_INT_RETURNS = {"index_of_multiple_deprivation", "rural_urban_classification"}
+
+
+def cohort_schema(covariate_definitions):
+    """
+    Map each output column to {"type": ...} where type is one of date, bool,
+    int, float or category; dates also carry their "precision"
+    """
+    schema = {"patient_id": {"type": "int"}}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        if name == "population" or kwargs.get("hidden"):
+            continue
+        column_type = kwargs["column_type"]
+        if column_type == "date":
+            date_format = kwargs.get("date_format")
+            if funcname == "aggregate_of":
+                # cohortextractor formats min/max dates like their first column
+                first = covariate_definitions[kwargs["column_names"][0]][1]
+                date_format = first.get("date_format")
+            date_format = date_format or "YYYY"
+            schema[name] = {"type": "date", "precision": DATE_PRECISION[date_format]}
+        elif column_type == "str" or kwargs.get("returning") in CATEGORICAL_INT_RETURNS:
+            schema[name] = {"type": "category"}
+        else:
+            schema[name] = {"type": column_type}
+    return schema
+
+
+def load_schema(path=SCHEMA_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    import sys
+
+    sys.path.insert(0, "./analysis")
+    from study_definition import study
+
+    schema = cohort_schema(study.covariate_definitions)
+    with open(SCHEMA_PATH, "w") as f:
+        json.dump(schema, f, indent=2)
+        f.write("\n")
+    print(f"Wrote schema for {len(schema)} columns to {SCHEMA_PATH}")
@@ -0,0 +1,276 @@
+"""
+Comorbidity flags, grouped comorbidities and eGFR from the cohort.
+
+cr_analysis_dataset.do derives these with a `foreach` replace per
+condition and `egen rowmax`. This does the same in one pass over the
+cohort's own columns (from crINPUT), as NumPy arrays:
+
+    - month-precision covariate dates placed mid-month (COVARIATE_DATES)
+    - conditions ever recorded before study start, as 0/1 flags
+    - stroke_dementia, spleen, cancer by time since diagnosis and
+      other_immunosuppression
+    - egfr (CKD-EPI, without ethnicity), egfr_cat, ckd and the reduced
+      kidney function groups
+
+Run `python analysis/comorbidities.py` (the crCOMORB action) to cache them as
+output/comorbidities.parquet, in the cohort's row order. The file records
+hashes of the cohort and of this module, and cr_analysis_dataset.py reads
+the cached columns whenever both still match, rather than deriving them
+again.
+"""
+import argparse
+import hashlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Conditions count if recorded before study start
+STUDY_START = np.datetime64("2020-09-01")
+
+# Month-precision covariate dates, placed mid-month, as
+# (input column, analysis column). Conditions are also flagged as ever
+# recorded before STUDY_START unless the flag is None
+COVARIATE_DATES = [
+    ("bp_sys_date_measured", "bp_sys_date", None),
+    ("bp_dias_date_measured", "bp_dias_date", None),
+    ("hba1c_percentage_date", "hba1c_percentage_date", None),
+    ("hba1c_mmol_per_mol_date", "hba1c_mmol_per_mol_date", None),
+    ("hypertension", "hypertension_date", "hypertension"),
+    ("bmi_date_measured", "bmi_date_measured", None),
+    ("chronic_respiratory_disease", "chronic_respiratory_disease_date", "chronic_respiratory_disease"),
+    ("chronic_cardiac_disease", "chronic_cardiac_disease_date", "chronic_cardiac_disease"),
+    ("diabetes", "diabetes_date", "diabetes"),
+    ("lung_cancer", "lung_cancer_date", None),
+    ("haem_cancer", "haem_cancer_date", None),
+    ("other_cancer", "other_cancer_date", None),
+    ("chronic_liver_disease", "chronic_liver_disease_date", "chronic_liver_disease"),
+    ("stroke", "stroke_date", "stroke"),
+    ("dementia", "dementia_date", "dementia"),
+    ("other_neuro", "other_neuro_date", "other_neuro"),
+    ("organ_transplant", "organ_transplant_date", "organ_transplant"),
+    ("dysplenia", "dysplenia_date", "dysplenia"),
+    ("sickle_cell", "sickle_cell_date", "sickle_cell"),
+    ("aplastic_anaemia", "aplastic_anaemia_date", "aplastic_anaemia"),
+    ("hiv_date", "hiv_date", "hiv"),
+    ("permanent_immunodeficiency", "permanent_immunodeficiency_date", "permanent_immunodeficiency"),
+    ("temporary_immunodeficiency", "temporary_immunodeficiency_date", "temporary_immunodeficiency"),
+    ("ra_sle_psoriasis", "ra_sle_psoriasis_date", "ra_sle_psoriasis"),
+    ("dialysis", "dialysis_date", "dialysis"),
+]
+
+# Cancer group by diagnosis date, later periods taking precedence:
+# (code, start, end), both ends inclusive as in inrange()
+CANCER_PERIODS = [
+    (4, "1900-01-01", "2015-02-01"),
+    (3, "2015-02-01", "2019-02-01"),
+    (2, "2019-02-01", "2020-02-01"),
+]
+
+# Temporary immunodeficiency and aplastic anaemia count within this window
+LAST_YEAR = ("2019-02-01", "2020-02-01")
+
+# egen cut(egfr), at(...): the lower bound of each band, and per band its
+# recoded ckd stage and reduced kidney function groups
+EGFR_CUTS = np.array([0, 15, 30, 45, 60, 5000])
+CKD_STAGES = np.array([5, 4, 3, 2, 0])
+REDUCED_KIDNEY_FUNCTION = np.array([3, 3, 2, 2, 1])
+REDUCED_KIDNEY_FUNCTION_2 = np.array([4, 3, 2, 2, 1])
+
+# Cohort columns derive_comorbidities() reads
+INPUT_COLUMNS = [column for column, _, _ in COVARIATE_DATES] + ["creatinine", "age", "sex"]
+
+COMORBIDITIES_PATH = "output/comorbidities.parquet"
+
+
+def inrange(dates, start, end):
+    return (dates >= np.datetime64(start)) & (dates <= np.datetime64(end))
+
+
+def period_codes(date_columns):
+    """CANCER_PERIODS code of the latest period any of the dates fall in, else 1"""
+    codes = np.ones(len(date_columns[0]), dtype="int64")
+    for code, start, end in CANCER_PERIODS:
+        hit = np.logical_or.reduce([inrange(dates, start, end) for dates in date_columns])
+        codes[hit] = code
+    return codes
+
+
+def egfr_bands(creatinine, female, age, dialysis):
+    """egfr and the columns cut from it, as float arrays with NaN for missing"""
+    # Implausible creatinine (including zero) set to missing, then converted
+    # from umol/l to mg/dl
+    creatinine = np.where((creatinine >= 20) & (creatinine <= 3000), creatinine, np.nan)
+    scr = creatinine / 88.4 / np.where(female, 0.7, 0.9)
+    low = np.maximum(scr ** np.where(female, -0.329, -0.411), 1)
+    high = np.minimum(scr**-1.209, 1)
+    egfr = low * high * 141 * 0.993**age * np.where(female, 1.018, 1)
+
+    band = np.searchsorted(EGFR_CUTS, egfr, side="right") - 1
+    valid = (egfr >= EGFR_CUTS[0]) & (egfr < EGFR_CUTS[-1])
+    band = np.where(valid, band, 0)
+
+    def by_band(values):
+        return np.where(valid, values[band], np.nan)
+
+    no_creatinine = np.isnan(creatinine)
+    reduced = np.where(no_creatinine, 1, by_band(REDUCED_KIDNEY_FUNCTION))
+    reduced_2 = np.where(no_creatinine, 1, by_band(REDUCED_KIDNEY_FUNCTION_2))
+    return {
+        "egfr": egfr,
+        "egfr_cat": by_band(EGFR_CUTS[:-1].astype(float)),
+        "ckd": by_band(CKD_STAGES.astype(float)),
+        "reduced_kidney_function_cat": reduced,
+        "reduced_kidney_function_cat2": np.where(dialysis == 1, 4, reduced_2),
+    }
+
+
+def derive_comorbidities(df):
+    """The derived columns for a frame of cohort rows, on the same index"""
+    out = {}
+    for column, date_column, flag in COVARIATE_DATES:
+        out[date_column] = df[column].to_numpy("datetime64[ns]") + np.timedelta64(14, "D")
+        if flag is not None:
+            # NaT compares false, so no record is 0
+            out[flag] = (out[date_column] < STUDY_START).astype("int8")
+
+    out["stroke_dementia"] = np.maximum(out["stroke"], out["dementia"])
+    out["spleen"] = np.maximum(out["dysplenia"], out["sickle_cell"])
+    out["cancer_haem_cat"] = period_codes([out["haem_cancer_date"]])
+    out["cancer_exhaem_cat"] = period_codes([out["lung_cancer_date"], out["other_cancer_date"]])
+
+    # Immunosuppressed: HIV, permanent immunodeficiency ever, or temporary
+    # immunodeficiency or aplastic anaemia last year
+    out["other_immunosuppression"] = (
+        (out["hiv"] == 1)
+        | (out["permanent_immunodeficiency"] == 1)
+        | inrange(out["temporary_immunodeficiency_date"], *LAST_YEAR)
+        | inrange(out["aplastic_anaemia_date"], *LAST_YEAR)
+    ).astype("int8")
+
+    female = df["sex"].astype(object).to_numpy() != "M"
+    out.update(
+        egfr_bands(
+            df["creatinine"].to_numpy(float),
+            female,
+            df["age"].to_numpy(float),
+            out["dialysis"],
+        )
+    )
+    return pd.DataFrame(out, index=df.index)
+
+
+def with_comorbidities(df, derived=None):
+    """
+    `df` with its comorbidity input columns replaced by the derived ones
+    (which also replace the cohort's hiv code, as the flag)
+    """
+    if derived is None:
+        derived = derive_comorbidities(df)
+    replaced = {column for column, _, _ in COVARIATE_DATES} | set(derived.columns)
+    kept = df.drop(columns=[column for column in df if column in replaced])
+    return pd.concat([kept, derived.set_axis(df.index)], axis=1)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_hashes(cohort_path):
+    return {
+        b"cohort_sha256": file_hash(cohort_path).encode(),
+        b"code_sha256": file_hash(__file__).encode(),
+    }
+
+
+def write_comorbidities(cohort_path, path=COMORBIDITIES_PATH, batch_size=250_000):
+    """Cache the derived columns for every cohort row, in the cohort's order"""
+    hashes = cache_hashes(cohort_path)
+    writer = None
+    rows = 0
+    parquet = pq.ParquetFile(cohort_path)
+    columns = ["patient_id"] + INPUT_COLUMNS
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        df = batch.to_pandas(date_as_object=False)
+        derived = derive_comorbidities(df)
+        derived.insert(0, "patient_id", df["patient_id"].to_numpy())
+        table = pa.Table.from_pandas(derived, preserve_index=False)
+        if writer is None:
+            schema = table.schema.with_metadata({**table.schema.metadata, **hashes})
+            writer = pq.ParquetWriter(path, schema, compression="zstd")
+        writer.write_table(table.cast(writer.schema))
+        rows += len(df)
+    if writer is not None:
+        writer.close()
+    return rows
+
+
+def is_current(cohort_path, path=COMORBIDITIES_PATH):
+    """Whether the cache at `path` was derived from this cohort by this code"""
+    try:
+        metadata = pq.read_schema(path).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return False
+    hashes = cache_hashes(cohort_path)
+    return all(metadata.get(key) == value for key, value in hashes.items())
+
+
+def self_check():
+    """Flags, cancer groups and eGFR bands on a few patients, for analysis/self_checks.py"""
+    month = pd.Timestamp
+    df = pd.DataFrame({column: pd.Series([pd.NaT] * 5) for column in INPUT_COLUMNS})
+    df["creatinine"] = [62.0, 150, 0, 800, 500]
+    df["age"] = [50, 70, 40, 80, 60]
+    df["sex"] = pd.Categorical(["F", "M", "M", "M", "F"])
+    # Placed mid-month, August is before study start but September isn't
+    df["stroke"] = [month("2020-08-01"), month("2020-09-01"), pd.NaT, pd.NaT, pd.NaT]
+    df["dementia"] = [pd.NaT, pd.NaT, month("2020-01-01"), pd.NaT, pd.NaT]
+    df["haem_cancer"] = [month("2019-06-01"), pd.NaT, pd.NaT, pd.NaT, pd.NaT]
+    # The later period (2-5 years ago) wins over 5+ years ago
+    df["lung_cancer"] = [month("2014-01-01"), pd.NaT, pd.NaT, pd.NaT, pd.NaT]
+    df["other_cancer"] = [month("2016-01-01"), pd.NaT, pd.NaT, pd.NaT, pd.NaT]
+    df["temporary_immunodeficiency"] = [
+        pd.NaT, month("2020-01-01"), month("2020-02-01"), pd.NaT, pd.NaT
+    ]
+    df["dialysis"] = [pd.NaT, pd.NaT, pd.NaT, month("2019-01-01"), pd.NaT]
+
+    out = derive_comorbidities(df)
+    expected = {
+        "stroke": [1, 0, 0, 0, 0],
+        "stroke_dementia": [1, 0, 1, 0, 0],
+        "cancer_haem_cat": [2, 1, 1, 1, 1],
+        "cancer_exhaem_cat": [3, 1, 1, 1, 1],
+        # 2020-02-15 is after LAST_YEAR ends
+        "other_immunosuppression": [0, 1, 0, 0, 0],
+        "egfr_cat": [60, 30, np.nan, 0, 0],
+        "ckd": [0, 3, np.nan, 5, 5],
+        # No creatinine (0 is implausible) is group 1, and dialysis group 4
+        "reduced_kidney_function_cat": [1, 2, 1, 3, 3],
+        "reduced_kidney_function_cat2": [1, 2, 1, 4, 4],
+    }
+    for column, values in expected.items():
+        assert np.array_equal(out[column], values, equal_nan=True), (column, list(out[column]))
+    assert out["stroke_date"][0] == month("2020-08-15"), out["stroke_date"]
+    # CKD-EPI worked by hand: 141 x 1.0019^-1.209 x 0.993^50 x 1.018, and
+    # 141 x 1.8854^-1.209 x 0.993^70
+    assert np.allclose(out["egfr"][:2], [100.79, 40.06], atol=0.01), out["egfr"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="output/input.parquet")
+    parser.add_argument("--output", default=COMORBIDITIES_PATH)
+    parser.add_argument("--batch-size", type=int, default=250_000)
+    args = parser.parse_args()
+
+    rows = write_comorbidities(args.input, args.output, args.batch_size)
+    print(f"Wrote comorbidities for {rows} patients to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,622 @@
+"""
+Create the main analysis dataset (Python port of cr_analysis_dataset.do).
+
+Reads output/input.parquet (from crINPUT) a chunk of rows at a time instead
+of loading the whole cohort, so it isn't limited by Stata's memory. The .do
+file needs some statistics over the whole cohort (IMD quintile cut points,
+age spline knots, mean age, STP numbering), so this makes two passes:
+
+    1. read only the columns the exclusions and those statistics need, and
+       count (age, imd) pairs and distinct STPs over the included patients
+    2. apply the exclusions and derive every variable chunk by chunk, in a
+       pool of --jobs worker processes
+
+Covariate dates, comorbidity flags and eGFR come from comorbidities.py,
+read from the crCOMORB action's output/comorbidities.parquet when that was
+derived from this --input.
+
+The result has the same variables (and labels) that cr_analysis_dataset.do
+keeps, written as Parquet a chunk at a time. Summaries the .do file only
+prints to its log, and the egen tag() helper counts, are not reproduced.
+
+With --dta it is also written as .dta. Stata files can't be appended to, so
+that holds every derived chunk until the end: peak memory is the whole
+dataset again, as in Stata. crMAIN already makes the Stata dataset, so the
+action doesn't ask for one.
+"""
+import argparse
+import collections
+import concurrent.futures
+import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from comorbidities import COMORBIDITIES_PATH, is_current, with_comorbidities
+from exposures import RTI_WEEKS
+from msoa_lookup import load_msoa_lookup
+
+STUDY_START = pd.Timestamp("2020-09-01")
+CENSOR_DATE = pd.Timestamp("2020-12-01")
+
+# UTLAs with small case numbers, regrouped
+UTLA_GROUPS = {
+    "Barking and Dagenham": "Redbridge, Barking and Dagenham",
+    "Redbridge": "Redbridge, Barking and Dagenham",
+    "Buckinghamshire": "Bucks/Ox/West. Berks/Swindon",
+    "Oxfordshire": "Bucks/Ox/West. Berks/Swindon",
+    "Swindon": "Bucks/Ox/West. Berks/Swindon",
+    "West Berkshire": "Bucks/Ox/West. Berks/Swindon",
+    "Camden": "Camden and Westminster",
+    "Westminster": "Camden and Westminster",
+    "Isles of Scilly": "",
+    "Richmond upon Thames": "Richmond and Hounslow",
+    "Hounslow": "Richmond and Hounslow",
+    "Rutland": "Rutland and Lincoln",
+    "Lincolnshire": "Rutland and Lincoln",
+    "Bolton": "Bolton and Tameside",
+    "Tameside": "Bolton and Tameside",
+}
+
+# Columns read in the first pass
+FIRST_PASS_COLUMNS = [
+    "covid_tpp_probable",
+    "first_pos_test_sgss",
+    "died_date_ons",
+    "age",
+    "sex",
+    "imd",
+    "stp",
+]
+
+
+def _week_label(prefix, start, end):
+    start, end = (datetime.date.fromisoformat(date) for date in (start, end))
+    return f"{prefix}: {start:%d%b} - {end:%d%b}".upper().replace("NRTI", "nRTI")
+
+
+# Variables kept in the analysis dataset, in order, with their labels (the
+# .do file keeps exactly the variables that have a variable label)
+VARIABLE_LABELS = {
+    # Demographics
+    "patient_id": "Patient ID",
+    "age": "Age (years)",
+    "agegroup": "Grouped age",
+    "age70": "70 years and older",
+    "male": "Male",
+    "household_size": "Household size",
+    "household_id": "Household ID",
+    "bmi": "Body Mass Index (BMI, kg/m2)",
+    "bmicat": "Grouped BMI",
+    "bmi_date_measured": "Body Mass Index (BMI, kg/m2), date measured",
+    "obese4cat": "Evidence of obesity (4 categories)",
+    "smoke": "Smoking status",
+    "smoke_nomiss": "Smoking status (missing set to non)",
+    "imd": "Index of Multiple Deprivation (IMD)",
+    "ethnicity": "Ethnicity",
+    "ethnicity_16": "Ethnicity in 16 categories",
+    "stp": "Sustainability and Transformation Partnership",
+    "msoa": "Geographical region: MSOA",
+    "utla": "Geographical region: UTLA",
+    "utla_name": "Geographical region: UTLA name",
+    "utla_group": "Geographical region: UTLA grouped",
+    "hba1ccat": "Categorised hba1c",
+    "egfr_cat": "Calculated eGFR",
+    "bp_sys": "Systolic blood pressure",
+    "bp_sys_date": "Systolic blood pressure, date",
+    "bp_dias": "Diastolic blood pressure",
+    "bp_dias_date": "Diastolic blood pressure, date",
+    "bpcat": "Grouped blood pressure",
+    "bpcat_nomiss": "RECODE of bpcat (Grouped blood pressure)",
+    "bphigh": "Binary high (stage 1/2) blood pressure",
+    "htdiag_or_highbp": "Diagnosed hypertension or high blood pressure",
+    "age1": "Age spline 1",
+    "age2": "Age spline 2",
+    "age3": "Age spline 3",
+    "c_age": "Centred age",
+    "c_male": "Centred sex (code: -1/+1)",
+    "c_imd": "Centred Index of Multiple Deprivation (values: -2/+2)",
+    "c_ethnicity": "Centred ethnicity (values: -2/+2)",
+    # Exposure
+    "min_rti": "First RTI",
+    **{f"rti_{week}": _week_label("RTI", start, end) for week, start, end, _ in RTI_WEEKS},
+    "min_nrti": "First nRTI",
+    **{f"nrti_{week}": _week_label("nRTI", start, end) for week, start, end, _ in RTI_WEEKS},
+    # Comorbidities
+    "chronic_respiratory_disease": "Respiratory disease (excl. asthma)",
+    "asthmacat": "Asthma, grouped by severity (OCS use)",
+    "asthma": "Asthma",
+    "chronic_cardiac_disease": "Heart disease",
+    "diabetes": "Diabetes",
+    "diabcat": "Diabetes, grouped",
+    "cancer_exhaem_cat": "Cancer (exc. haematological), grouped by time since diagnosis",
+    "cancer_haem_cat": "Haematological malignancy, grouped by time since diagnosis",
+    "chronic_liver_disease": "Chronic liver disease",
+    "stroke_dementia": "Stroke or dementia",
+    "other_neuro": "Neuro condition other than stroke/dementia",
+    "egfr": "egfr calculated using CKD-EPI formula with no eth",
+    "ckd": "CKD stage calc without eth",
+    "reduced_kidney_function_cat": "Reduced kidney function",
+    "reduced_kidney_function_cat2": "RECODE of ckd (CKD stage calc without eth)",
+    "organ_transplant": "Organ transplant recipient",
+    "dysplenia": "Dysplenia (splenectomy, other, not sickle cell)",
+    "sickle_cell": "Sickle cell",
+    "spleen": "Spleen problems (dysplenia, sickle cell)",
+    "ra_sle_psoriasis": "RA, SLE, Psoriasis (autoimmune disease)",
+    "aplastic_anaemia": "Aplastic anaemia",
+    "hiv": "HIV",
+    "permanent_immunodeficiency": "Permanent immunodeficiency",
+    "temporary_immunodeficiency": "Temporary immunosuppression",
+    "other_immunosuppression": "Immunosuppressed (combination algorithm)",
+    "chronic_respiratory_disease_date": "Respiratory disease (excl. asthma), date",
+    "chronic_cardiac_disease_date": "Heart disease, date",
+    "diabetes_date": "Diabetes, date",
+    "lung_cancer_date": "Lung cancer, date",
+    "haem_cancer_date": "Haem. cancer, date",
+    "other_cancer_date": "Any cancer, date",
+    "chronic_liver_disease_date": "Liver, date",
+    "stroke_date": "Stroke, date",
+    "dementia_date": "Dementia, date",
+    "other_neuro_date": "Neuro condition other than stroke/dementia, date",
+    "organ_transplant_date": "Organ transplant recipient, date",
+    "dysplenia_date": "Splenectomy etc, date",
+    "sickle_cell_date": "Sickle cell, date",
+    "ra_sle_psoriasis_date": "RA, SLE, Psoriasis (autoimmune disease), date",
+    "aplastic_anaemia_date": "Aplastic anaemia, date",
+    "hiv_date": "HIV, date",
+    "permanent_immunodeficiency_date": "Permanent immunodeficiency, date",
+    "temporary_immunodeficiency_date": "Temporary immunosuppression, date",
+    "dialysis": "Dialysis",
+    # Dates
+    "covid_vacc_date": "Date of first covid vaccination",
+    "covid_tpp_probable": "Date of covid diagnosis TPP",
+    "covid_tpp_clin": "Date of covid diagnosis CLIN",
+    "covid_tpp_test": "Date of covid diagnosis TEST",
+    "covid_tpp_seq": "Date of covid diagnosis SEQ",
+    "first_pos_test_sgss": "Date of first SGSS positive test",
+    # Outcomes and follow-up
+    "enter_date": "Date of study entry",
+    "censor_date": "Date of study exit",
+    "covid_diag": "Failure/censoring indicator for outcome: covid diagnosis",
+    "cox_covid_date": "Date; outcome covid diagnosis",
+    "sgss_diag": "Failure/censoring indicator for outcome: SGSS covid diagnosis",
+    "cox_sgss_date": "Date; outcome SGSS covid diagnosis",
+}
+
+_CANCER = {1: "Never", 2: "Last year", 3: "2-5 years ago", 4: "5+ years"}
+_SMOKE = {1: "Never", 2: "Former", 3: "Current"}
+_BPCAT = {1: "Normal", 2: "Elevated", 3: "High, stage I", 4: "High, stage II"}
+
+VALUE_LABELS = {
+    "agegroup": {1: "18-<40", 2: "40-<50", 3: "50-<60", 4: "60-<70", 5: "70-<80", 6: "80+"},
+    "bmicat": {
+        1: "Underweight (<18.5)",
+        2: "Normal (18.5-24.9)",
+        3: "Overweight (25-29.9)",
+        4: "Obese I (30-34.9)",
+        5: "Obese II (35-39.9)",
+        6: "Obese III (40+)",
+    },
+    "obese4cat": {
+        1: "No record of obesity",
+        2: "Obese I (30-34.9)",
+        3: "Obese II (35-39.9)",
+        4: "Obese III (40+)",
+    },
+    "smoke": _SMOKE,
+    "smoke_nomiss": _SMOKE,
+    "ethnicity": {
+        1: "White",
+        2: "Mixed",
+        3: "Asian or Asian British",
+        4: "Black",
+        5: "Other",
+    },
+    "ethnicity_16": {
+        1: "British or Mixed British",
+        2: "Irish",
+        3: "Other White",
+        4: "White + Black Caribbean",
+        5: "White + Black African",
+        6: "White + Asian",
+        7: "Other mixed",
+        8: "Indian or British Indian",
+        9: "Pakistani or British Pakistani",
+        10: "Bangladeshi or British Bangladeshi",
+        11: "Other Asian",
+        12: "Caribbean",
+        13: "African",
+        14: "Other Black",
+        15: "Chinese",
+        16: "Other",
+    },
+    "asthmacat": {1: "No", 2: "Yes, no OCS", 3: "Yes with OCS"},
+    "bpcat": _BPCAT,
+    "bpcat_nomiss": _BPCAT,
+    "imd": {1: "1 least deprived", 2: "2", 3: "3", 4: "4", 5: "5 most deprived"},
+    "cancer_haem_cat": _CANCER,
+    "cancer_exhaem_cat": _CANCER,
+    "ckd": {0: "No CKD", 1: "CKD"},
+    "reduced_kidney_function_cat": {
+        1: "None",
+        2: "Stage 3a/3b egfr 30-60",
+        3: "Stage 4/5 egfr<30",
+    },
+    "reduced_kidney_function_cat2": {
+        1: "None",
+        2: "Stage 3a/3b egfr 30-60",
+        3: "Stage 4 egfr 15-<30",
+        4: "Stage 5 egfr <15 or dialysis",
+    },
+    "hba1ccat": {0: "<6.5%", 1: ">=6.5-7.4", 2: ">=7.5-7.9", 3: ">=8-8.9", 4: ">=9"},
+    "diabcat": {
+        1: "No diabetes",
+        2: "Controlled diabetes",
+        3: "Uncontrolled diabetes",
+        4: "Diabetes, no hba1c measure",
+    },
+}
+
+
+def stata_pctile(values, counts, p):
+    """
+    The p-th percentile of `values` with frequencies `counts` (values
+    sorted), by Stata's default _pctile definition
+    """
+    cumulative = np.cumsum(counts)
+    position = cumulative[-1] * p / 100
+
+    def nth(i):
+        return values[np.searchsorted(cumulative, i)]
+
+    if position == int(position):
+        return (nth(position) + nth(position + 1)) / 2
+    return nth(int(position) + 1)
+
+
+def excluded(df):
+    """
+    Patients the .do file drops before deriving variables: COVID or death
+    on/before study start, implausible age and sex not M/F. Missing dates
+    are never excluded (Stata's missing compares greater than any date)
+    """
+    drop = df["covid_tpp_probable"] <= STUDY_START
+    drop |= df["first_pos_test_sgss"] <= STUDY_START
+    drop |= df["died_date_ons"] <= STUDY_START
+    if df["age"].isna().any():
+        raise ValueError("age is missing for some patients")
+    drop |= df["age"] > 105
+    sex = df["sex"].astype(object)
+    if not sex.isin(["M", "F", "I", "U"]).all():
+        raise ValueError("sex has values other than M, F, I and U")
+    drop |= sex.isin(["I", "U"])
+    return drop
+
+
+def numeric(series):
+    """Digit-only category columns (imd, ethnicity, asthma) as floats"""
+    return pd.to_numeric(series.astype(object), errors="coerce")
+
+
+def collect_stats(path, batch_size):
+    """
+    First pass: the cohort-wide statistics the derivations need, from the
+    distribution of (age, imd) over included patients and their STPs
+    """
+    pairs = collections.Counter()
+    stps = set()
+    parquet = pq.ParquetFile(path)
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=FIRST_PASS_COLUMNS):
+        df = batch.to_pandas(date_as_object=False)
+        df = df[~excluded(df)]
+        imd = numeric(df["imd"]).fillna(np.inf)
+        pairs.update(zip(df["age"], imd))
+        stps.update(df["stp"].astype(object).fillna(""))
+    return cohort_stats(pairs, stps)
+
+
+def cohort_stats(pairs, stps):
+    ages = collections.Counter()
+    imds = collections.Counter()
+    for (age, imd), count in pairs.items():
+        ages[age] += count
+        if np.isfinite(imd):
+            imds[imd] += count
+    age_values = np.array(sorted(ages))
+    age_counts = np.array([ages[age] for age in age_values])
+    imd_values = np.array(sorted(imds))
+    imd_counts = np.array([imds[imd] for imd in imd_values])
+
+    # egen cut(imd), group(5): codes are the number of quintile cut points
+    # at or below the value
+    imd_cuts = [stata_pctile(imd_values, imd_counts, p) for p in (20, 40, 60, 80)]
+    # mkspline age = age, cubic nknots(4): Harrell's default knots
+    age_knots = [stata_pctile(age_values, age_counts, p) for p in (5, 35, 65, 95)]
+
+    # Centred age uses the mean after dropping patients with no IMD (-1)
+    total = weight = 0
+    for (age, imd), count in pairs.items():
+        if np.isfinite(imd) and imd != -1:
+            total += age * count
+            weight += count
+    return {
+        "imd_cuts": imd_cuts,
+        "age_knots": age_knots,
+        "mean_age": total / weight,
+        # bysort stp: numbered in sort order, with missing ("") first
+        "stp_codes": {stp: code for code, stp in enumerate(sorted(stps), start=1)},
+    }
+
+
+def restricted_cubic_spline(x, knots):
+    """mkspline's restricted cubic spline basis, [x, x2, ..., x(k-1)]"""
+    k = len(knots)
+    t = knots
+    scale = (t[-1] - t[0]) ** 2
+
+    def cube(values):
+        return np.clip(values, 0, None) ** 3
+
+    basis = [x.astype(float)]
+    for i in range(k - 2):
+        term = (
+            cube(x - t[i])
+            - cube(x - t[k - 2]) * (t[k - 1] - t[i]) / (t[k - 1] - t[k - 2])
+            + cube(x - t[k - 1]) * (t[k - 2] - t[i]) / (t[k - 1] - t[k - 2])
+        )
+        basis.append(term / scale)
+    return basis
+
+
+def inrange(series, low, high):
+    return (series >= low) & (series <= high)
+
+
+def derive(df, stats, lookup):
+    """Second pass: cr_analysis_dataset.do's derivations for one chunk"""
+    # Covariate dates placed mid-month, comorbidity flags and eGFR, unless
+    # read from the crCOMORB cache
+    if "egfr" not in df:
+        df = with_comorbidities(df)
+    df = df[~excluded(df)].copy()
+
+    # merge m:1 msoa using MSOA_lookup, keeping unmatched patients, unless
+    # crINPUT --utla already has
+    if "utla" not in df:
+        ids = lookup.utla_ids(df["msoa"])
+        df["utla"] = lookup.utla[ids]
+        df["utla_name"] = lookup.utla_name[ids]
+    for column in ["msoa", "utla", "utla_name"]:
+        df[column] = df[column].astype(object).fillna("").values
+
+    # Exposure: RTIs, and RTIs with a negative SGSS test around them
+    for week, *_ in RTI_WEEKS:
+        df[f"nrti_{week}"] = df[f"rti_{week}"].where(df[f"neg_{week}"] == 1)
+    df["min_nrti"] = df[[f"nrti_{week}" for week, *_ in RTI_WEEKS]].min(axis=1)
+    df["min_rti"] = df[[f"rti_{week}" for week, *_ in RTI_WEEKS]].min(axis=1)
+
+    # Implausible BMIs set to missing
+    df["bmi"] = df["bmi"].where(inrange(df["bmi"], 15, 50))
+
+    df["male"] = (df["sex"].astype(object) == "M").astype("int8")
+    smoking = df["smoking_status"].astype(object)
+    df["smoke"] = smoking.map({"N": 1.0, "E": 2.0, "S": 3.0})
+
+    df["ethnicity"] = numeric(df["ethnicity"])
+    df["ethnicity_16"] = numeric(df["ethnicity_16"]).where(df["ethnicity"].notna())
+
+    df["stp"] = df["stp"].astype(object).fillna("").map(stats["stp_codes"])
+
+    df["utla_group"] = df["utla_name"].map(UTLA_GROUPS).fillna(df["utla_name"])
+
+    # Age. recode leaves ages below 18 unchanged in agegroup, as Stata does
+    age = df["age"]
+    df["agegroup"] = np.select(
+        [age < 18, age < 40, age < 50, age < 60, age < 70, age < 80],
+        [age, 1, 2, 3, 4, 5],
+        6,
+    )
+    df["age70"] = (age >= 70).astype("int8")
+    df["age1"], df["age2"], df["age3"] = restricted_cubic_spline(age, stats["age_knots"])
+
+    # BMI
+    bmi = df["bmi"]
+    df["bmicat"] = np.select(
+        [bmi < 18.5, bmi < 25, bmi < 30, bmi < 35, bmi < 40, bmi.notna()],
+        [1, 2, 3, 4, 5, 6],
+        np.nan,
+    )
+    df["obese4cat"] = df["bmicat"].map({4: 2, 5: 3, 6: 4}).fillna(1)
+
+    df["smoke_nomiss"] = df["smoke"].fillna(1)
+
+    # Asthma (coded: 0 No, 1 Yes no OCS, 2 Yes with OCS)
+    df["asthmacat"] = numeric(df["asthma"]).map({0: 1, 1: 2, 2: 3}).fillna(1)
+    df["asthma"] = df["asthmacat"].isin([2, 3]).astype("int8")
+
+    # Blood pressure
+    sys_bp, dias_bp = df["bp_sys"], df["bp_dias"]
+    bpcat = pd.Series(np.nan, index=df.index)
+    bpcat[(sys_bp < 120) & (dias_bp < 80)] = 1
+    bpcat[inrange(sys_bp, 120, 130) & (dias_bp < 80)] = 2
+    bpcat[inrange(sys_bp, 130, 140) | inrange(dias_bp, 80, 90)] = 3
+    bpcat[(sys_bp >= 140) | (dias_bp >= 90)] = 4
+    bpcat[sys_bp.isna() | dias_bp.isna() | (sys_bp == 0) | (dias_bp == 0)] = np.nan
+    df["bpcat"] = bpcat
+    df["bpcat_nomiss"] = bpcat.fillna(1)
+    df["bphigh"] = (bpcat == 4).astype("int8")
+
+    # IMD quintiles, reversed so high is more deprived
+    imd = numeric(df["imd"])
+    quintile = pd.Series(
+        np.searchsorted(stats["imd_cuts"], imd, side="right") + 1.0, index=imd.index
+    )
+    df["imd"] = (6 - quintile).where(imd.notna() & (imd != -1))
+    no_imd = df["imd"].isna()
+    if no_imd.any():
+        df = df[~no_imd].copy()
+
+    # Centred age, sex, IMD, ethnicity (for adjusted KM plots)
+    df["c_age"] = df["age"] - stats["mean_age"]
+    df["c_male"] = df["male"].replace(0, -1)
+    df["c_imd"] = df["imd"] - 3
+    df["c_ethnicity"] = df["ethnicity"] - 3
+
+    df["htdiag_or_highbp"] = (df["bphigh"] | df["hypertension"]).astype("int8")
+
+    # HbA1c: only positive measurements from the last 15 months, expressed
+    # as a percentage
+    since = pd.Timestamp("2018-11-01")
+    percentage = df["hba1c_percentage"].where(df["hba1c_percentage"] > 0)
+    percentage = percentage.mask(df["hba1c_percentage_date"] < since)
+    mmol = df["hba1c_mmol_per_mol"].where(df["hba1c_mmol_per_mol"] > 0)
+    mmol = mmol.mask(df["hba1c_mmol_per_mol_date"] < since)
+    hba1c_pct = (mmol / 10.929 + 2.15).fillna(percentage)
+    hba1c_pct = hba1c_pct.where(inrange(hba1c_pct, 0, 20)).round(1)
+    df["hba1ccat"] = np.select(
+        [hba1c_pct < 6.5, hba1c_pct < 7.5, hba1c_pct < 8, hba1c_pct < 9, hba1c_pct.notna()],
+        [0, 1, 2, 3, 4],
+        np.nan,
+    )
+    df["diabcat"] = np.select(
+        [
+            df["diabetes"] == 0,
+            df["hba1ccat"].isin([0, 1]),
+            df["hba1ccat"].isin([2, 3, 4]),
+        ],
+        [1, 2, 3],
+        4,
+    )
+
+    # Follow-up from 1 Sep 2020 until 1 Dec 2020, vaccination or outcome
+    df["enter_date"] = STUDY_START
+    df["censor_date"] = CENSOR_DATE
+    for outcome, column, end in [
+        ("covid_diag", "covid_tpp_probable", "cox_covid_date"),
+        ("sgss_diag", "first_pos_test_sgss", "cox_sgss_date"),
+    ]:
+        df[end] = df[["censor_date", "covid_vacc_date", column]].min(axis=1)
+        df[outcome] = (df[column].notna() & (df[column] <= df[end])).astype("int8")
+
+    return df[list(VARIABLE_LABELS)]
+
+
+def to_arrow(df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    dates = [name for name in df if pd.api.types.is_datetime64_any_dtype(df[name])]
+    for name in dates:
+        index = table.schema.get_field_index(name)
+        table = table.set_column(index, name, table.column(name).cast(pa.date32()))
+    return table
+
+
+def write_dta(df, path):
+    convert_dates = {
+        name: "td" for name in df if pd.api.types.is_datetime64_any_dtype(df[name])
+    }
+    df.to_stata(
+        path,
+        version=118,
+        write_index=False,
+        convert_dates=convert_dates,
+        variable_labels=VARIABLE_LABELS,
+        value_labels=VALUE_LABELS,
+        data_label="Viral competition",
+    )
+
+
+def self_check():
+    """
+    stata_pctile and restricted_cubic_spline against values worked by hand
+    from Stata's documented _pctile and mkspline formulas, for
+    analysis/self_checks.py
+    """
+    # _pctile: with P = N * p / 100, the mean of the P-th and (P+1)-th
+    # values when P is whole, otherwise the (floor(P)+1)-th
+    ones = np.ones(10, dtype="int64")
+    pctiles = [stata_pctile(np.arange(1, 11), ones, p) for p in (20, 35, 50, 95)]
+    assert pctiles == [2.5, 4, 5.5, 10], pctiles
+    # The same with frequency weights: 1, 2, 3, 3
+    weighted = [stata_pctile(np.array([1, 2, 3]), np.array([1, 1, 2]), p) for p in (5, 50, 75, 95)]
+    assert weighted == [1, 2.5, 3, 3], weighted
+
+    # mkspline, cubic with knots 0-3: zero below the first knot, linear
+    # beyond the last; x = 2.5 gives (2.5^3 - 0.5^3 * 3) / 9 and
+    # (1.5^3 - 0.5^3 * 2) / 9
+    x = np.array([-1, 0.5, 2.5, 4, 5])
+    basis = restricted_cubic_spline(x, [0, 1, 2, 3])
+    expected = [x, [0, 0.125 / 9, 15.25 / 9, 42 / 9, 60 / 9], [0, 0, 3.125 / 9, 12 / 9, 18 / 9]]
+    assert len(basis) == 3 and all(np.allclose(b, e) for b, e in zip(basis, expected)), basis
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="output/input.parquet")
+    parser.add_argument("--parquet", default="output/cr_analysis_dataset.parquet")
+    parser.add_argument("--dta", help="also write a .dta, holding the whole dataset in memory")
+    parser.add_argument("--batch-size", type=int, default=250_000)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument(
+        "--comorbidities",
+        default=COMORBIDITIES_PATH,
+        help="derived columns from crCOMORB, used if derived from this --input",
+    )
+    args = parser.parse_args()
+
+    stats = collect_stats(args.input, args.batch_size)
+    lookup = load_msoa_lookup()
+
+    cached = is_current(args.input, args.comorbidities)
+    print(f"Comorbidities {'read from ' + args.comorbidities if cached else 'derived'}")
+
+    def batches():
+        parquet = pq.ParquetFile(args.input)
+        source = parquet.iter_batches(batch_size=args.batch_size)
+        if not cached:
+            yield from (batch.to_pandas(date_as_object=False) for batch in source)
+            return
+        # The cache has the cohort's rows in the same order
+        derived = pq.ParquetFile(args.comorbidities).iter_batches(batch_size=args.batch_size)
+        for batch, derived_batch in zip(source, derived):
+            df = batch.to_pandas(date_as_object=False)
+            derived_df = derived_batch.to_pandas(date_as_object=False)
+            if not (derived_df.pop("patient_id").values == df["patient_id"].values).all():
+                raise ValueError(f"{args.comorbidities} is out of step with {args.input}")
+            yield with_comorbidities(df, derived_df)
+
+    chunks = []
+    writer = None
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        # Only a couple of chunks per worker are in flight at once, so memory
+        # doesn't grow with the size of the cohort
+        pending = collections.deque()
+        source = batches()
+        while True:
+            for df in source:
+                pending.append(pool.submit(derive, df, stats, lookup))
+                if len(pending) >= 2 * args.jobs:
+                    break
+            if not pending:
+                break
+            chunk = pending.popleft().result()
+            table = to_arrow(chunk)
+            if writer is None:
+                writer = pq.ParquetWriter(args.parquet, table.schema, compression="zstd")
+            writer.write_table(table)
+            if args.dta:
+                chunks.append(chunk)
+    if writer is not None:
+        writer.close()
+
+    if args.dta:
+        # Stata loads the whole dataset anyway, so only this output is
+        # assembled in memory
+        dataset = pd.concat(chunks, ignore_index=True).sort_values("patient_id")
+        write_dta(dataset, args.dta)
+        print(f"Wrote {len(dataset)} patients to {args.dta}")
+
+
+if __name__ == "__main__":
+    main()
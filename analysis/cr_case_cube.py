@@ -0,0 +1,120 @@
+"""
+Build the daily COVID case-count cube from the analysis dataset.
+
+an_ccount_crude.do reloads the whole patient-level dataset to tabulate each
+diagnosis source by day (tab ..., matcell) and by region (table stp/utla).
+This reads output/cr_analysis_dataset.parquet (from crMAINPY) once, a chunk
+at a time, and counts diagnoses in follow-up (enter_date to censor_date) for
+every source at once by
+
+    date x source x stp x utla x agegroup
+
+writing output/case_counts.parquet. Each region and age group's number of
+patients is included as source "population" with no date, for denominators.
+The counting and plotting steps (an_case_counts.py) read this instead of the
+patient-level data.
+"""
+import argparse
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Source name (as in an_ccount_crude.do): diagnosis date columns, the first
+# of which counts
+SOURCES = {
+    "covid": ["covid_tpp_probable", "first_pos_test_sgss"],
+    "tpp": ["covid_tpp_probable"],
+    "tppclin": ["covid_tpp_clin"],
+    "tpptest": ["covid_tpp_test"],
+    "tppseq": ["covid_tpp_seq"],
+    "sgss": ["first_pos_test_sgss"],
+}
+
+POPULATION = "population"
+
+DIMENSIONS = ["stp", "utla", "utla_name", "agegroup"]
+
+KEYS = ["source", "date"] + DIMENSIONS
+
+
+def count_chunk(df):
+    """Counts for one chunk of patients, as a long frame keyed by KEYS"""
+    regions = df[DIMENSIONS].fillna({"utla": "", "utla_name": ""})
+    frames = [regions.assign(source=POPULATION, date=pd.NaT)]
+    for source, columns in SOURCES.items():
+        date = df[columns].min(axis=1)
+        in_follow_up = (date >= df["enter_date"]) & (date <= df["censor_date"])
+        frames.append(regions[in_follow_up].assign(source=source, date=date[in_follow_up]))
+    long = pd.concat(frames, ignore_index=True)
+    return long.groupby(KEYS, dropna=False, sort=False).size().rename("count")
+
+
+def build_cube(path, batch_size=250_000):
+    columns = ["enter_date", "censor_date"] + DIMENSIONS
+    columns += sorted({column for source in SOURCES.values() for column in source})
+    counts = None
+    parquet = pq.ParquetFile(path)
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        chunk = count_chunk(batch.to_pandas(date_as_object=False))
+        counts = chunk if counts is None else counts.add(chunk, fill_value=0)
+    cube = counts.astype("int64").reset_index()
+    source_order = [POPULATION] + list(SOURCES)
+    cube["source"] = pd.Categorical(cube["source"], categories=source_order)
+    return cube.sort_values(KEYS, ignore_index=True)
+
+
+def write_cube(cube, path):
+    table = pa.Table.from_pandas(cube, preserve_index=False)
+    index = table.schema.get_field_index("date")
+    table = table.set_column(index, "date", table.column("date").cast(pa.date32()))
+    pq.write_table(table, path, compression="zstd")
+
+
+def self_check():
+    """count_chunk on three patients, for analysis/self_checks.py"""
+    day = pd.Timestamp
+    df = pd.DataFrame(
+        {
+            "enter_date": [day("2020-09-01")] * 3,
+            "censor_date": [day("2020-12-01")] * 3,
+            "stp": ["E1", "E1", "E2"],
+            "utla": ["U1", "U1", None],
+            "utla_name": ["Utla 1", "Utla 1", None],
+            "agegroup": [1, 1, 2],
+            # After follow-up, in it, and before it
+            "covid_tpp_probable": [day("2021-01-01"), day("2020-10-01"), day("2020-08-01")],
+            "covid_tpp_clin": [pd.NaT, day("2020-10-01"), pd.NaT],
+            "covid_tpp_test": [pd.NaT] * 3,
+            "covid_tpp_seq": [pd.NaT] * 3,
+            # The first patient's earliest diagnosis, so covid counts them on it
+            "first_pos_test_sgss": [day("2020-09-15"), pd.NaT, pd.NaT],
+        }
+    )
+    counts = count_chunk(df).reset_index()
+    totals = counts.groupby("source")["count"].sum().to_dict()
+    expected = {POPULATION: 3, "covid": 2, "tpp": 1, "tppclin": 1, "sgss": 1}
+    assert totals == expected, f"count_chunk totals {totals}, expected {expected}"
+    covid = counts[counts["source"] == "covid"].set_index("date")["count"]
+    assert covid.to_dict() == {day("2020-09-15"): 1, day("2020-10-01"): 1}, covid
+    # The patient without a UTLA is counted under "", not dropped
+    population = counts[counts["source"] == POPULATION]
+    assert population.set_index("utla")["count"].to_dict() == {"U1": 2, "": 1}, population
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="output/cr_analysis_dataset.parquet")
+    parser.add_argument("--output", default="output/case_counts.parquet")
+    parser.add_argument("--batch-size", type=int, default=250_000)
+    args = parser.parse_args()
+
+    cube = build_cube(args.input, args.batch_size)
+    write_cube(cube, args.output)
+    totals = cube.groupby("source", observed=True)["count"].sum()
+    print(totals.to_string())
+    print(f"Wrote {len(cube)} cells to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
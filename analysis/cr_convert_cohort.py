@@ -0,0 +1,288 @@
+"""
+Convert the generate_cohort output into typed columnar files.
+
+generate_cohort writes output/input.feather (Arrow IPC). This action applies
+the study definition schema (analysis/cohort_schema.json) and writes
+
+    output/input.parquet  dates as date32, categories dictionary-encoded
+    output/input.dta      dates as Stata %td, for the Stata actions
+
+so none of the downstream steps re-parse string dates from CSV.
+
+With --compact it also writes an integer-coded Parquet file, the narrowest
+form of the cohort: day dates as int32 days since 1970-01-01, month dates
+as int16 months since 1970-01 (year dates as int16 years since 1970), and
+categories as int8/int16 codes. A JSON dictionary alongside records each
+column's encoding and category labels; read_compact() decodes it.
+
+With --utla it appends utla and utla_name from the MSOA lookup (see
+msoa_lookup.py), as `merge m:1 msoa using MSOA_lookup` would, so later
+actions don't each repeat that merge.
+"""
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cohort_schema import SCHEMA_PATH, load_schema
+from msoa_lookup import load_msoa_lookup
+
+DATE_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+ARROW_TYPES = {
+    "date": pa.date32(),
+    "bool": pa.bool_(),
+    "int": pa.int64(),
+    "float": pa.float64(),
+}
+
+
+def read_cohort(path):
+    if path.endswith(".feather"):
+        return pd.read_feather(path)
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    # CSV: read everything as strings and let apply_schema do the typing
+    return pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[""])
+
+
+def apply_schema(df, schema):
+    """
+    Cast every column in `df` to the pandas type given by `schema`. Columns
+    missing from the schema (e.g. a stale cohort_schema.json) are left as
+    read, with a warning
+    """
+    df = df.copy(deep=False)
+    for column in df.columns:
+        spec = schema.get(column)
+        if spec is None:
+            print(f"WARNING: {column} not in {SCHEMA_PATH}; leaving as read")
+            continue
+        series = df[column]
+        kind = spec["type"]
+        if kind == "date":
+            if not pd.api.types.is_datetime64_any_dtype(series):
+                series = pd.to_datetime(
+                    series, format=DATE_FORMATS[spec["precision"]], errors="coerce"
+                )
+        elif kind == "bool":
+            if series.dtype != bool:
+                series = pd.to_numeric(series, errors="coerce").fillna(0).astype(bool)
+        elif kind in ("int", "float"):
+            series = pd.to_numeric(series, errors="coerce")
+            if kind == "int" and not series.isna().any():
+                series = series.astype("int64")
+        elif kind == "category":
+            series = series.astype("category")
+            series = series.cat.rename_categories(
+                [str(category) for category in series.cat.categories]
+            )
+        df[column] = series
+    return df
+
+
+def add_utla(df, schema):
+    """`df` with utla and utla_name appended, and the schema including them"""
+    lookup = load_msoa_lookup()
+    ids = lookup.utla_ids(df["msoa"])
+    df = df.assign(
+        # Without the trailing "", so unmatched MSOAs are missing
+        utla=pd.Categorical.from_codes(ids, lookup.utla[:-1]),
+        utla_name=pd.Categorical.from_codes(ids, lookup.utla_name[:-1]),
+    )
+    return df, {**schema, "utla": {"type": "category"}, "utla_name": {"type": "category"}}
+
+
+def to_arrow(df, schema):
+    arrays, fields = [], []
+    for column in df.columns:
+        kind = schema.get(column, {}).get("type")
+        array = pa.array(df[column], from_pandas=True)
+        if kind in ARROW_TYPES:
+            array = array.cast(ARROW_TYPES[kind])
+        fields.append(pa.field(column, array.type))
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+# Unit and integer type of each date precision in the compact output
+COMPACT_DATES = {
+    "day": ("days", pa.int32()),
+    "month": ("months", pa.int16()),
+    "year": ("years", pa.int16()),
+}
+
+
+def date_offsets(series, unit):
+    """Whole days, months or years since 1970-01-01, as floats (NaN missing)"""
+    if unit == "days":
+        values = series.values.astype("datetime64[D]").astype("int64")
+    elif unit == "months":
+        values = (series.dt.year - 1970) * 12 + series.dt.month - 1
+    else:
+        values = series.dt.year - 1970
+    return np.where(series.isna(), np.nan, values)
+
+
+def compact_arrow(df, schema):
+    """The compact table for `df` and its dictionary of column encodings"""
+    arrays, fields, dictionary = [], [], {}
+    for column in df.columns:
+        spec = schema.get(column, {})
+        kind = spec.get("type")
+        series = df[column]
+        if kind == "date":
+            unit, arrow_type = COMPACT_DATES[spec["precision"]]
+            array = pa.array(date_offsets(series, unit), from_pandas=True).cast(arrow_type)
+            dictionary[column] = {"encoding": unit, "epoch": "1970-01-01"}
+        elif kind == "category":
+            categories = list(series.cat.categories)
+            arrow_type = pa.int8() if len(categories) < 128 else pa.int16()
+            codes = series.cat.codes.to_numpy()
+            array = pa.array(codes, mask=codes == -1).cast(arrow_type)
+            dictionary[column] = {"encoding": "categories", "categories": categories}
+        else:
+            array = pa.array(series, from_pandas=True)
+            if kind in ARROW_TYPES:
+                array = array.cast(ARROW_TYPES[kind])
+        fields.append(pa.field(column, array.type))
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields)), dictionary
+
+
+def dictionary_path(compact_path):
+    return compact_path.rsplit(".", 1)[0] + ".json"
+
+
+def write_compact(df, schema, path):
+    table, dictionary = compact_arrow(df, schema)
+    pq.write_table(table, path, compression="zstd")
+    with open(dictionary_path(path), "w") as f:
+        json.dump(dictionary, f, indent=2)
+
+
+def read_compact(path, columns=None):
+    """Read a compact cohort back into the same frame apply_schema() gives"""
+    with open(dictionary_path(path)) as f:
+        dictionary = json.load(f)
+    df = pq.read_table(path, columns=columns).to_pandas()
+    epoch = np.datetime64("1970-01-01", "D")
+    for column in df.columns:
+        spec = dictionary.get(column)
+        if spec is None:
+            continue
+        values = df[column]
+        if spec["encoding"] == "categories":
+            codes = values.fillna(-1).astype("int64")
+            df[column] = pd.Categorical.from_codes(codes, spec["categories"])
+            continue
+        offsets = values.fillna(0).astype("int64").to_numpy()
+        if spec["encoding"] == "days":
+            dates = epoch + offsets.astype("timedelta64[D]")
+        elif spec["encoding"] == "months":
+            dates = np.datetime64("1970-01", "M") + offsets.astype("timedelta64[M]")
+        else:
+            dates = np.datetime64("1970", "Y") + offsets.astype("timedelta64[Y]")
+        dates = pd.Series(dates.astype("datetime64[ns]"), index=df.index)
+        df[column] = dates.where(values.notna())
+    return df
+
+
+def self_check():
+    """write_compact/read_compact round trip, for analysis/self_checks.py"""
+    schema = {
+        "patient_id": {"type": "int"},
+        "died_date_ons": {"type": "date", "precision": "day"},
+        "dereg_date": {"type": "date", "precision": "month"},
+        "year_of_birth": {"type": "date", "precision": "year"},
+        "sex": {"type": "category"},
+        "has_bmi": {"type": "bool"},
+        "bmi": {"type": "float"},
+    }
+    # As read_cohort reads a CSV, including dates before 1970 (negative
+    # offsets) and a missing value in every nullable column
+    raw = pd.DataFrame(
+        {
+            "patient_id": ["1", "2", "3"],
+            "died_date_ons": ["2020-10-01", None, "1969-12-31"],
+            "dereg_date": ["2020-11", "1965-03", None],
+            "year_of_birth": ["1950", None, "1999"],
+            "sex": ["F", "M", None],
+            "has_bmi": ["1", "0", None],
+            "bmi": ["25.5", None, "31"],
+        }
+    )
+    expected = apply_schema(raw, schema)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "input_compact.parquet")
+        write_compact(expected, schema, path)
+        pd.testing.assert_frame_equal(read_compact(path), expected)
+        columns = ["patient_id", "dereg_date", "sex"]
+        pd.testing.assert_frame_equal(read_compact(path, columns), expected[columns])
+
+
+def is_numeric_category(categories):
+    return len(categories) > 0 and all(
+        category.lstrip("-").isdigit() for category in categories
+    )
+
+
+def to_stata_frame(df, schema):
+    """
+    Match what `import delimited` used to produce: categories made only of
+    digits (ethnicity, imd, asthma) become numbers, other categories are
+    strings with "" for missing, and flags are bytes
+    """
+    df = df.copy(deep=False)
+    convert_dates = {}
+    for column in df.columns:
+        kind = schema.get(column, {}).get("type")
+        if kind == "date":
+            convert_dates[column] = "td"
+        elif kind == "bool":
+            df[column] = df[column].astype("int8")
+        elif kind == "category":
+            series = df[column]
+            if is_numeric_category(series.cat.categories):
+                df[column] = pd.to_numeric(series.astype(object))
+            else:
+                df[column] = series.astype(object).fillna("")
+    return df, convert_dates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="output/input.feather")
+    parser.add_argument("--parquet", default="output/input.parquet")
+    parser.add_argument("--dta", default="output/input.dta")
+    parser.add_argument("--compact", help="also write the integer-coded Parquet")
+    parser.add_argument("--schema", default=SCHEMA_PATH)
+    parser.add_argument("--utla", action="store_true", help="join the MSOA to UTLA lookup")
+    args = parser.parse_args()
+
+    schema = load_schema(args.schema)
+    df = apply_schema(read_cohort(args.input), schema)
+    # Study definition order, so Stata varlist ranges (a-b) behave as they
+    # did with input.csv
+    df = df[[c for c in schema if c in df] + [c for c in df if c not in schema]]
+    if args.utla:
+        df, schema = add_utla(df, schema)
+
+    if args.parquet:
+        pq.write_table(to_arrow(df, schema), args.parquet, compression="zstd")
+    if args.compact:
+        write_compact(df, schema, args.compact)
+    if args.dta:
+        stata_df, convert_dates = to_stata_frame(df, schema)
+        stata_df.to_stata(
+            args.dta, version=118, write_index=False, convert_dates=convert_dates
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,47 @@
-import pandas as pd
+import csv
+import hashlib
+import json
 
-MSOAs = pd.read_csv(
-    filepath_or_buffer = './lookups/MSOAs.csv'
-)
-dict_msoa = { msoa : 1/len(MSOAs.index) for msoa in MSOAs['msoa_id'].tolist() }
\ No newline at end of file
+# MSOA codes used for the uniform `msoa` dummy-data ratios. The CSV is
+# compiled to a JSON artifact (run `python analysis/dictionaries.py`) which
+# is cheap to load and doesn't need pandas; it is rebuilt on import whenever
+# its recorded hash no longer matches the CSV
+MSOA_CSV = "./lookups/MSOAs.csv"
+MSOA_ARTIFACT = "./lookups/MSOAs.json"
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def build_msoa_artifact(csv_path=MSOA_CSV, artifact_path=MSOA_ARTIFACT):
+    with open(csv_path, newline="") as f:
+        msoas = [row["msoa_id"] for row in csv.DictReader(f)]
+    artifact = {"source_sha256": _file_hash(csv_path), "msoa_id": msoas}
+    # A stale artifact is only a slowdown, so don't fail on a read-only checkout
+    try:
+        with open(artifact_path, "w") as f:
+            json.dump(artifact, f, indent=0)
+    except OSError:
+        pass
+    return msoas
+
+
+def load_msoas(csv_path=MSOA_CSV, artifact_path=MSOA_ARTIFACT):
+    try:
+        with open(artifact_path) as f:
+            artifact = json.load(f)
+        if artifact["source_sha256"] == _file_hash(csv_path):
+            return artifact["msoa_id"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_msoa_artifact(csv_path, artifact_path)
+
+
+MSOAs = load_msoas()
+dict_msoa = {msoa: 1 / len(MSOAs) for msoa in MSOAs}
+
+
+if __name__ == "__main__":
+    print(f"Wrote {len(build_msoa_artifact())} MSOAs to {MSOA_ARTIFACT}")
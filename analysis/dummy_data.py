@@ -0,0 +1,393 @@
+"""
+Generate a large synthetic cohort from the study definition's expectations.
+
+generate_cohort builds dummy data column by column in pandas, which gets
+slow well before the 1M+ rows needed to exercise the Stata pipeline at
+realistic sizes, and it draws every column independently, so neg_XXXX flags
+are set for patients with no rti_XXXX date. This draws each column for a
+whole chunk of patients at once with NumPy, honouring the same
+return_expectations (merged over default_expectations): incidence, rate,
+date earliest/latest, category ratios and int/float distributions.
+
+Variables are generated in study definition order, so anything a variable
+depends on already exists:
+
+    - a variable whose `between` window is anchored on another column
+      (neg_0900 on rti_0900) is only set where that column is
+    - value_from date columns (bmi_date_measured) share their source's
+      incidence
+    - aggregate_of columns (covid_tpp_probable) are the row-wise min/max of
+      their components
+    - categorised_as columns (smoking_status) keep their expected ratios,
+      and their hidden sub-variables are drawn too and then reassigned
+      between patients so that the compiled expressions
+      (categorised_as.py) give each patient the category drawn for them
+
+Chunks are streamed to an Arrow IPC (.feather) or Parquet file as record
+batches, with the same column types generate_cohort writes, so memory stays
+bounded by --chunk-size whatever --rows is. Run from the repository root
+inside the cohortextractor environment, then run crINPUT as usual:
+
+    python analysis/dummy_data.py --rows 5000000 --output output/input.feather
+"""
+import argparse
+import copy
+import datetime
+import os
+import sys
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from categorised_as import Categorisation
+from cohort_schema import cohort_schema
+from incremental_cohort import dependencies
+
+EPOCH = np.datetime64("1970-01-01", "D")
+
+TRUNCATE = {"day": "D", "month": "M", "year": "Y"}
+
+ARROW_TYPES = {
+    "date": pa.timestamp("ns"),
+    "bool": pa.bool_(),
+    "int": pa.int64(),
+    "float": pa.float64(),
+}
+
+# Values generate_cohort uses for patients without a value
+EMPTY = {"bool": False, "int": 0, "float": 0.0}
+
+# Expectations for hidden sub-variables, which usually set none
+DEFAULT_EXPECTATIONS = {
+    "int": {"distribution": "poisson", "mean": 2},
+    "float": {"distribution": "normal", "mean": 50, "stddev": 10},
+}
+
+
+def merge(defaults, overrides):
+    """Merge return_expectations over default_expectations, recursively"""
+    result = copy.deepcopy(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict):
+            result[key] = merge(result.get(key, {}), value)
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+
+def to_days(date):
+    if date == "today":
+        date = datetime.date.today().isoformat()
+    return int((np.datetime64(date, "D") - EPOCH).astype(int))
+
+
+def population_age_weights(max_age=110):
+    """
+    Probability of each age 0..max_age-1, from the UK population bands that
+    cohortextractor's `population_ages` distribution uses
+    """
+    import csv
+
+    import cohortextractor
+
+    path = os.path.join(
+        os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv"
+    )
+    weights = np.zeros(max_age)
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            start, end = (int(age) for age in row["band"].split("-"))
+            count = int(row["range"].replace(",", ""))
+            weights[start : min(end, max_age - 1) + 1] = count / 5
+    return weights / weights.sum()
+
+
+class ColumnSampler:
+    """Draws whole columns of values for one chunk of patients at a time"""
+
+    def __init__(self, study, seed=None):
+        self.definitions = study.covariate_definitions
+        self.defaults = study.default_expectations or {}
+        self.schema = cohort_schema(self.definitions)
+        self.rng = np.random.default_rng(seed)
+        self.deps = dependencies(self.definitions)
+        self.date_col_for = {
+            kwargs["source"]: name
+            for name, (funcname, kwargs) in self.definitions.items()
+            if funcname == "value_from"
+        }
+        self.aggregated = {
+            column
+            for funcname, kwargs in self.definitions.values()
+            if funcname == "aggregate_of"
+            for column in kwargs["column_names"]
+        }
+        # Only categorisations of other variables can be drawn, not those of
+        # the backend's own columns (care_home_type)
+        self.categorisations = {
+            name: Categorisation(kwargs["category_definitions"])
+            for name, (funcname, kwargs) in self.definitions.items()
+            if funcname == "categorised_as"
+        }
+        for name, categorisation in self.categorisations.items():
+            unknown = categorisation.names - set(self.definitions)
+            if unknown:
+                raise ValueError(f"{name} refers to undefined variables: {', '.join(sorted(unknown))}")
+        self.subvariables = set().union(
+            *(categorisation.names for categorisation in self.categorisations.values())
+        )
+        self.categories = {}
+        self._age_weights = None
+
+    def expectations(self, name):
+        kwargs = self.definitions[name][1]
+        if kwargs.get("source"):
+            kwargs = self.definitions[kwargs["source"]][1]
+        expectations = merge(self.defaults, kwargs.get("return_expectations") or {})
+        if kwargs.get("hidden"):
+            expectations = merge(DEFAULT_EXPECTATIONS, expectations)
+        return expectations
+
+    def wanted(self, name):
+        funcname, kwargs = self.definitions[name]
+        if name == "population":
+            return False
+        return not kwargs.get("hidden") or name in self.aggregated or name in self.subvariables
+
+    def present(self, name, expectations, n, columns):
+        """Mask of patients with a value, from incidence and any anchors"""
+        if expectations.get("rate") == "universal":
+            mask = np.ones(n, dtype=bool)
+        else:
+            mask = self.rng.random(n) < expectations["incidence"]
+        for start_or_end in self.definitions[name][1].get("between") or ():
+            if isinstance(start_or_end, str):
+                for anchor in self.deps[name]:
+                    if anchor in start_or_end:
+                        mask &= ~columns[anchor][1]
+        return mask
+
+    def date_range(self, name, expectations):
+        """
+        First and last day (since 1970-01-01) to draw from: the expected
+        date range narrowed to the variable's own static window, so the
+        expected incidence survives the window (generate_cohort draws over
+        the whole range and then blanks dates outside the window)
+        """
+        window = expectations.get("date") or {}
+        if "earliest" not in window or "latest" not in window:
+            raise ValueError(f"{name} must define date earliest and latest expectations")
+        low, high = to_days(window["earliest"]), to_days(window["latest"])
+        start, end = self.definitions[name][1].get("between") or (None, None)
+        if isinstance(start, str) and start[:4].isdigit():
+            low = max(low, to_days(start))
+        if isinstance(end, str) and end[:4].isdigit():
+            high = min(high, to_days(end))
+        if low > high:
+            raise ValueError(f"{name} expects dates outside its own window")
+        return low, high
+
+    def dates(self, name, expectations, n):
+        """Days since 1970-01-01, ignoring incidence"""
+        low, high = self.date_range(name, expectations)
+        if expectations.get("rate") == "exponential_increase":
+            # Truncated exponential (scale 0.1 of the range) counted back
+            # from `latest`, as generate_cohort does by oversampling
+            u = self.rng.random(n)
+            back = -0.1 * np.log1p(-u * (1 - np.exp(-10)))
+        else:
+            back = self.rng.random(n)
+        return high - np.rint(back * (high - low)).astype(np.int64)
+
+    def values(self, name, kind, expectations, n):
+        if kind == "bool":
+            return np.ones(n, dtype=bool)
+        if kind == "category":
+            if name not in self.categories:
+                self.categories[name] = self.category_weights(name, expectations)
+            labels, p = self.categories[name]
+            return self.rng.choice(len(labels), size=n, p=p).astype(np.int32)
+        spec = expectations[kind]
+        distribution = spec["distribution"]
+        if distribution == "normal":
+            drawn = self.rng.normal(spec["mean"], spec["stddev"], n)
+            return drawn.astype(np.int64) if kind == "int" else drawn
+        if distribution == "poisson":
+            return self.rng.poisson(spec["mean"], n)
+        if distribution == "population_ages":
+            if self._age_weights is None:
+                self._age_weights = population_age_weights()
+            return self.rng.choice(len(self._age_weights), size=n, p=self._age_weights)
+        raise ValueError(f"Unsupported {kind} distribution '{distribution}' for {name}")
+
+    def category_weights(self, name, expectations):
+        """
+        (labels, probabilities) of a category variable. A sub-variable
+        without ratios (most_recent_smoking_code) takes any category of its
+        codelist, and a categorisation any of its categories, so every
+        category its expressions can give has a label
+        """
+        kwargs = self.definitions[name][1]
+        if "category" in expectations:
+            ratios = dict(expectations["category"]["ratios"])
+        else:
+            ratios = {category: 1 for category in sorted({category for _, category in kwargs["codelist"]})}
+        if name in self.categorisations:
+            labels = [str(label) for label in self.categorisations[name].labels]
+            unknown = set(map(str, ratios)) - set(labels)
+            if unknown:
+                raise ValueError(f"{name} expects categories it doesn't define: {', '.join(sorted(unknown))}")
+            ratios.update({label: 0 for label in labels if label not in map(str, ratios)})
+        p = np.fromiter(ratios.values(), dtype=float, count=len(ratios))
+        return [str(label) for label in ratios], p / p.sum()
+
+    def expression_column(self, name, columns):
+        """
+        A drawn column as categorised_as expressions see it, with
+        cohortextractor's empty values for patients without one
+        """
+        values, missing = columns[name]
+        kind = self.column_kind(name)
+        if kind == "date":
+            return np.where(missing, np.datetime64("NaT"), EPOCH + values)
+        if kind == "category":
+            labels = np.array(self.categories[name][0] + [""])
+            return labels[np.where(missing, len(labels) - 1, values)]
+        return np.where(missing, EMPTY[kind], values)
+
+    def match_subvariables(self, name, codes, present, columns):
+        """
+        Reassign the sub-variables of categorisation `name` between the
+        chunk's patients, so each patient present gets the values of a
+        patient the expressions categorise as their drawn category. Where
+        no patient in the chunk has that category, the patient keeps their
+        own values and takes the category those give instead
+        """
+        categorisation = self.categorisations[name]
+        labels, _ = self.categories[name]
+        subvariables = sorted(categorisation.names)
+        expressed = {sub: self.expression_column(sub, columns) for sub in subvariables}
+        # The chunk's categories, as indexes into `labels`
+        position = np.array([labels.index(str(label)) for label in categorisation.labels])
+        given = position[categorisation.codes(expressed)]
+
+        order = np.argsort(given, kind="stable")
+        counts = np.bincount(given, minlength=len(labels))
+        starts = np.cumsum(counts) - counts
+        available = present & (counts[codes] > 0)
+        offset = (self.rng.random(len(codes)) * counts[codes]).astype(np.int64)
+        rows = np.arange(len(codes))
+        rows[available] = order[(starts[codes] + offset)[available]]
+        for sub in subvariables:
+            linked = [sub, self.date_col_for.get(sub)]
+            for column in filter(None, linked):
+                if column in columns:
+                    values, missing = columns[column]
+                    columns[column] = (values[rows], missing[rows])
+        return np.where(present & ~available, given, codes)
+
+    def column_kind(self, name):
+        funcname, kwargs = self.definitions[name]
+        if name in self.schema:
+            return self.schema[name]["type"]
+        return "category" if kwargs["column_type"] == "str" else kwargs["column_type"]
+
+    def chunk(self, n):
+        """
+        Return {name: (values, missing)} for n patients, where `missing` is a
+        boolean mask and dates are days since 1970-01-01
+        """
+        columns = {}
+        for name, (funcname, kwargs) in self.definitions.items():
+            if not self.wanted(name) or name in columns:
+                continue
+            kind = self.column_kind(name)
+            if funcname == "aggregate_of":
+                parts = [columns[part] for part in kwargs["column_names"]]
+                stacked = np.ma.masked_array(
+                    [values for values, _ in parts], mask=[missing for _, missing in parts]
+                )
+                reduce = stacked.min if kwargs["aggregate_function"] == "MIN" else stacked.max
+                reduced = reduce(axis=0)
+                columns[name] = (reduced.filled(0), np.ma.getmaskarray(reduced))
+                continue
+            if funcname == "value_from":
+                # Generated alongside its source below
+                continue
+            expectations = self.expectations(name)
+            present = self.present(name, expectations, n, columns)
+            date_col = self.date_col_for.get(name)
+            if kind == "date":
+                columns[name] = (self.dates(name, expectations, n), ~present)
+            else:
+                values = self.values(name, kind, expectations, n)
+                if name in self.categorisations:
+                    values = self.match_subvariables(name, values, present, columns)
+                columns[name] = (values, ~present)
+            if date_col is not None:
+                columns[date_col] = (self.dates(date_col, expectations, n), ~present)
+        return columns
+
+    def record_batch(self, offset, n):
+        columns = self.chunk(n)
+        arrays = [pa.array(np.arange(offset + 1, offset + n + 1, dtype=np.int64))]
+        names = ["patient_id"]
+        for name in self.schema:
+            if name == "patient_id":
+                continue
+            values, missing = columns[name]
+            kind = self.schema[name]["type"]
+            if kind == "date":
+                precision = TRUNCATE[self.schema[name]["precision"]]
+                days = (EPOCH + values).astype(f"datetime64[{precision}]")
+                array = pa.array(days.astype("datetime64[ns]"), mask=missing)
+            elif kind == "category":
+                labels, _ = self.categories[name] if name in self.categories else ([], None)
+                indices = pa.array(values, mask=missing, type=pa.int32())
+                array = pa.DictionaryArray.from_arrays(indices, pa.array(labels, pa.string()))
+            else:
+                values = np.where(missing, EMPTY[kind], values)
+                array = pa.array(values, type=ARROW_TYPES[kind])
+            arrays.append(array)
+            names.append(name)
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def write_cohort(study, rows, output, chunk_size=100_000, seed=None):
+    sampler = ColumnSampler(study, seed=seed)
+    writer = None
+    try:
+        for offset in range(0, rows, chunk_size):
+            batch = sampler.record_batch(offset, min(chunk_size, rows - offset))
+            if writer is None:
+                if output.endswith(".parquet"):
+                    writer = pq.ParquetWriter(output, batch.schema, compression="zstd")
+                else:
+                    writer = pa.ipc.new_file(output, batch.schema)
+            if output.endswith(".parquet"):
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    parser.add_argument("--output", default="output/input.feather")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    sys.path.insert(0, "./analysis")
+    study = __import__(args.study_definition).study
+    write_cohort(study, args.rows, args.output, args.chunk_size, args.seed)
+    print(f"Wrote {args.rows} dummy patients to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+"""
+Export every RTI, LRTI and negative SGSS test in the study period per patient.
+
+The study definition keeps only the last RTI in each of the RTI_WEEKS
+windows (rti_0900 ... rti_1130), a flag for a negative test near it, and
+counts over the period (rti_in_period, lrti_in_period), so every new
+exposure definition means editing study_definition.py and extracting
+again. This extracts the matching events themselves, for the study
+population, once:
+
+    rti             rti_codes events in EVENT_PERIOD
+    lrti            lrti_codes events in EVENT_PERIOD
+    sgss_negative   negative SARS-CoV-2 tests (all tests, as neg_XXXX uses)
+                    in EVENT_PERIOD widened by NEGATIVE_TEST_WINDOW_DAYS
+
+and writes them to an Arrow IPC file with one row per patient (in
+patient_id order, like the cohort) and a list<int32> column of days since
+1970 per stream. Arrow stores a list column as offsets into one values
+array, so each stream is a CSR index: patient i's days are
+days[offsets[i]:offsets[i + 1]], ascending. load_events() memory-maps the
+file, and bin_events() and any_within() re-bin the events into any set of
+weekly or daily windows, or ±N-day windows around another date, in memory.
+weekly_rti_columns() rebuilds the study definition's own columns this way.
+
+Run from the repository root inside the cohortextractor environment:
+
+    python analysis/event_arrays.py --output output/events.arrow
+
+Without a database, --from-cohort builds the events a dummy cohort implies
+(its weekly RTI dates, a negative test on the RTI date where neg_XXXX is
+set, and lrti_in_period LRTIs on random days) to develop against.
+"""
+import argparse
+import itertools
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from exposures import NEGATIVE_TEST_WINDOW_DAYS, RTI_WEEKS
+
+# rti_in_period and lrti_in_period's window, both ends inclusive
+EVENT_PERIOD = ("2020-06-09", "2020-12-01")
+
+# Clinical event streams and their codelist in codelists.py, then the SGSS
+# negative tests
+CLINICAL_STREAMS = {"rti": "rti_codes", "lrti": "lrti_codes"}
+SGSS_STREAM = "sgss_negative"
+STREAMS = [*CLINICAL_STREAMS, SGSS_STREAM]
+
+EVENTS_PATH = "output/events.arrow"
+
+# Rows fetched per page from the database
+BATCH_SIZE = 32_000
+
+# day_keys() packs a patient row and a day (days since 1970, any int32)
+# into one int64; the smallest and largest day stand for an open window end
+DAY_KEY_SPAN, DAY_KEY_SHIFT = np.int64(2**32), np.int64(2**31)
+FIRST_DAY, LAST_DAY = -(2**31), 2**31 - 1
+
+
+def to_days(dates):
+    """Days since 1970 of datetime64 values (NaT must be removed first)"""
+    return np.asarray(dates, dtype="datetime64[D]").astype("int64").astype("int32")
+
+
+def from_days(days):
+    return np.asarray(days).astype("int64").astype("datetime64[D]")
+
+
+def sgss_period(period=EVENT_PERIOD, window_days=NEGATIVE_TEST_WINDOW_DAYS):
+    start, end = period
+    window = np.timedelta64(window_days, "D")
+    return str(np.datetime64(start) - window), str(np.datetime64(end) + window)
+
+
+class EventArrays:
+    """
+    Event days per patient: patient_id[i]'s days in a stream are
+    days[stream][offsets[stream][i]:offsets[stream][i + 1]], ascending
+    """
+
+    def __init__(self, patient_id, offsets, days):
+        self.patient_id = patient_id
+        self.offsets = offsets
+        self.days = days
+
+    def __len__(self):
+        return len(self.patient_id)
+
+    def counts(self, stream):
+        return np.diff(self.offsets[stream])
+
+    def rows(self, stream):
+        """The patient row of each of a stream's events"""
+        return np.repeat(np.arange(len(self)), self.counts(stream))
+
+    def window_bounds(self, stream, anchors, low, high):
+        """
+        Indexes into days[stream] of the events from low to high days (both
+        inclusive) after each patient's anchor date: anchors has a row per
+        patient and any number of columns, low and high a value per column.
+        Returns (first, stop) arrays shaped like anchors, with first == stop
+        where there are no events or no anchor (NaT)
+        """
+        anchors = np.asarray(anchors, dtype="datetime64[D]")
+        shape = anchors.shape
+        anchors = anchors.reshape(len(self), -1)
+        low = np.broadcast_to(np.asarray(low, dtype="int64"), anchors.shape[1:])
+        high = np.broadcast_to(np.asarray(high, dtype="int64"), anchors.shape[1:])
+        rows, columns = np.nonzero(~np.isnat(anchors))
+        anchor_days = anchors[rows, columns].astype("int64")
+        first = np.zeros(anchors.shape, dtype="int64")
+        stop = np.zeros(anchors.shape, dtype="int64")
+        first[rows, columns], stop[rows, columns] = day_bounds(
+            self.offsets[stream],
+            self.days[stream],
+            rows,
+            anchor_days + low[columns],
+            anchor_days + high[columns],
+        )
+        return first.reshape(shape), stop.reshape(shape)
+
+    def patient(self, patient_id, stream):
+        """One patient's event dates in a stream"""
+        i = np.searchsorted(self.patient_id, patient_id)
+        if i == len(self) or self.patient_id[i] != patient_id:
+            raise KeyError(patient_id)
+        offsets = self.offsets[stream]
+        return from_days(self.days[stream][offsets[i] : offsets[i + 1]])
+
+
+def day_keys(rows, days):
+    """
+    (patient row, day) pairs as one int64 key, ordered as the pairs are, so
+    a CSR stream's keys are sorted and one binary search finds any pair
+    """
+    days = np.asarray(days, dtype="int64")
+    return np.asarray(rows, dtype="int64") * DAY_KEY_SPAN + (days + DAY_KEY_SHIFT)
+
+
+def day_bounds(offsets, days, rows, low, high):
+    """
+    (first, stop) indexes into a CSR stream's `days` of each queried
+    patient row's days from low to high, both inclusive
+    """
+    keys = day_keys(np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)), days)
+    first = np.searchsorted(keys, day_keys(rows, low), side="left")
+    stop = np.searchsorted(keys, day_keys(rows, high), side="right")
+    return first, stop
+
+
+def population_rows(patient_ids, ids, what):
+    """The row in the sorted `patient_ids` of each of `ids`"""
+    rows = np.searchsorted(patient_ids, ids)
+    if len(rows) and (rows.max() >= len(patient_ids) or (patient_ids[rows] != ids).any()):
+        raise ValueError(f"{what} for patients outside the population")
+    return rows
+
+
+def csr_offsets(rows, n_rows):
+    """Offsets of a CSR stream holding one value per entry of the sorted `rows`"""
+    offsets = np.zeros(n_rows + 1, dtype="int64")
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=offsets[1:])
+    return offsets
+
+
+def from_rows(patient_ids, streams):
+    """
+    EventArrays for the sorted unique `patient_ids`, from each stream's
+    (patient_id, days) arrays of events in any order
+    """
+    patient_ids = np.asarray(patient_ids, dtype="int64")
+    offsets, days = {}, {}
+    for stream, (ids, event_days) in streams.items():
+        rows = population_rows(patient_ids, ids, f"{stream} events")
+        order = np.lexsort((event_days, rows))
+        offsets[stream] = csr_offsets(rows, len(patient_ids))
+        days[stream] = np.asarray(event_days, dtype="int32")[order]
+    return EventArrays(patient_ids, offsets, days)
+
+
+def write_events(events, path=EVENTS_PATH):
+    arrays = [pa.array(events.patient_id, pa.int64())]
+    for stream in STREAMS:
+        arrays.append(
+            pa.LargeListArray.from_arrays(
+                pa.array(events.offsets[stream], pa.int64()),
+                pa.array(events.days[stream], pa.int32()),
+            )
+        )
+    metadata = {"period": ",".join(EVENT_PERIOD), "sgss_period": ",".join(sgss_period())}
+    table = pa.Table.from_arrays(arrays, names=["patient_id", *STREAMS], metadata=metadata)
+    # Uncompressed, so load_events() can map the arrays without copying them
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=max(len(events), 1))
+
+
+def load_events(path=EVENTS_PATH):
+    """The EventArrays in a file from write_events(), memory-mapped"""
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all().combine_chunks()
+    offsets, days = {}, {}
+    for stream in STREAMS:
+        (column,) = table[stream].chunks
+        offsets[stream] = column.offsets.to_numpy()
+        days[stream] = column.values.to_numpy()
+    return EventArrays(table["patient_id"].to_numpy(), offsets, days)
+
+
+def bin_events(events, stream, bins, returning="date"):
+    """
+    A stream re-binned into `bins`, (start, end) date pairs with both ends
+    inclusive that don't overlap: a patients x bins array of the last event
+    date in each bin (NaT if none), the first (returning="first_date"), or
+    the number of events (returning="count")
+    """
+    starts = to_days([start for start, _ in bins])
+    ends = to_days([end for _, end in bins])
+    order = np.argsort(starts)
+    starts, ends = starts[order], ends[order]
+    if (starts[1:] <= ends[:-1]).any():
+        raise ValueError("bins overlap")
+
+    days, rows = events.days[stream], events.rows(stream)
+    bin_index = np.searchsorted(starts, days, side="right") - 1
+    inside = bin_index >= 0
+    inside[inside] = days[inside] <= ends[bin_index[inside]]
+    # Events are sorted by (patient, day), so by (patient, bin) in here too
+    days, keys = days[inside], rows[inside] * len(bins) + bin_index[inside]
+
+    if returning == "count":
+        counts = np.bincount(keys, minlength=len(events) * len(bins))
+        result = counts.reshape(len(events), len(bins))
+    elif returning in ("date", "first_date"):
+        flat = np.full(len(events) * len(bins), np.datetime64("NaT"), dtype="datetime64[D]")
+        if returning == "date":
+            take = np.append(keys[1:] != keys[:-1], True)
+        else:
+            take = np.insert(keys[1:] != keys[:-1], 0, True)
+        flat[keys[take]] = from_days(days[take])
+        result = flat.reshape(len(events), len(bins))
+    else:
+        raise ValueError(f"Unsupported returning: {returning}")
+    # Back to the order the bins were given in
+    return result[:, np.argsort(order)]
+
+
+def any_within(events, stream, anchors, window_days):
+    """
+    Whether each patient has a stream event within ±window_days of their
+    date in `anchors` (one datetime64 per patient; NaT is never), as int8
+    """
+    first, stop = events.window_bounds(stream, anchors, -window_days, window_days)
+    return (stop > first).astype("int8")
+
+
+def weekly_rti_columns(events, weeks=RTI_WEEKS, window_days=NEGATIVE_TEST_WINDOW_DAYS):
+    """
+    The study definition's rti_XXXX, neg_XXXX, rti_in_period and
+    lrti_in_period columns, from the events
+    """
+    columns = {"patient_id": events.patient_id}
+    period = [EVENT_PERIOD]
+    columns["lrti_in_period"] = bin_events(events, "lrti", period, "count")[:, 0]
+    columns["rti_in_period"] = bin_events(events, "rti", period, "count")[:, 0]
+    last = bin_events(events, "rti", [(start, end) for _, start, end, _ in weeks])
+    for i, (week, *_) in enumerate(weeks):
+        columns[f"rti_{week}"] = last[:, i].astype("datetime64[ns]")
+        columns[f"neg_{week}"] = any_within(events, SGSS_STREAM, last[:, i], window_days)
+    return pd.DataFrame(columns)
+
+
+def population_queries(backend):
+    """Queries putting the population of `backend`'s study in #event_population"""
+    queries = list(backend.queries)
+    queries[-1] = f"SELECT patient_id INTO #event_population FROM ({queries[-1]}) t"
+    queries.append("CREATE CLUSTERED INDEX ix_patient_id ON #event_population (patient_id)")
+    return queries
+
+
+def clinical_events_select(backend, number, codelist, start, end, label):
+    """
+    (queries uploading the codelist, SELECT of the population's events with
+    codes in it between start and end) as stream `number`
+    """
+    from cohortextractor.tpp_backend import coded_event_table_column
+
+    table, column = coded_event_table_column(codelist)
+    # Names the codelist's temporary table and its log line
+    backend._current_column_name = label
+    codelist_table, queries = backend.create_codelist_table(codelist)
+    backend._current_column_name = None
+    select = f"""
+        SELECT {number} AS stream, {table}.Patient_ID AS patient_id,
+          CAST(ConsultationDate AS date) AS date
+        FROM {table}
+        INNER JOIN {codelist_table} ON {column} = {codelist_table}.code
+        INNER JOIN #event_population ON #event_population.patient_id = {table}.Patient_ID
+        WHERE CAST(ConsultationDate AS date) BETWEEN '{start}' AND '{end}'
+        """
+    return queries, select
+
+
+def sgss_select(number, test_result, start, end, earliest_specimen=False):
+    """
+    SELECT of the population's SARS-CoV-2 tests with `test_result`
+    ("positive", "negative" or "any") between start and end as stream
+    `number`, from the tables with_test_result_in_sgss reads
+    """
+    if earliest_specimen:
+        tables = {"positive": "SGSS_Positive", "negative": "SGSS_Negative"}
+        date_column = "Earliest_Specimen_Date"
+    else:
+        tables = {"positive": "SGSS_AllTests_Positive", "negative": "SGSS_AllTests_Negative"}
+        date_column = "Specimen_Date"
+    results = list(tables) if test_result == "any" else [test_result]
+    return "\nUNION ALL\n".join(
+        f"""
+        SELECT {number} AS stream, tests.Patient_ID AS patient_id,
+          CAST(tests.{date_column} AS date) AS date
+        FROM {tables[result]} tests
+        INNER JOIN #event_population ON #event_population.patient_id = tests.Patient_ID
+        WHERE CAST(tests.{date_column} AS date) BETWEEN '{start}' AND '{end}'
+        """
+        for result in results
+    )
+
+
+def fetch_streams(backend, queries, selects, batch_size=BATCH_SIZE):
+    """
+    Run `queries` (which must fill #event_population, and upload anything
+    `selects` use), then fetch the union of `selects`, each numbered as its
+    position, in (stream, patient_id, date) order. Returns the population's
+    patient_ids and [(patient_ids, days)] per select
+    """
+    from cohortextractor.mssql_utils import mssql_fetch_table
+    from cohortextractor.tpp_backend import BACKOFF_FACTOR, RETRIES, SLEEP
+
+    # The population itself comes first, as stream -1 rows with no date
+    selects = [
+        "SELECT -1 AS stream, patient_id, CAST(NULL AS date) AS date FROM #event_population",
+        *selects,
+    ]
+    union = "\nUNION ALL\n".join(selects)
+    queries = queries + [
+        f"""
+        -- Collecting events
+        SELECT ROW_NUMBER() OVER (ORDER BY stream, patient_id, date) AS row_id, t.*
+        INTO #events FROM ({union}) t
+        """,
+        "CREATE CLUSTERED INDEX ix_row_id ON #events (row_id)",
+    ]
+    backend.execute_queries(queries)
+    rows = mssql_fetch_table(
+        get_cursor=backend._get_cursor,
+        table="#events",
+        key_column="row_id",
+        batch_size=batch_size,
+        retries=RETRIES,
+        sleep=SLEEP,
+        backoff_factor=BACKOFF_FACTOR,
+    )
+    headers = next(rows)
+    columns = [headers.index(name) for name in ["stream", "patient_id", "date"]]
+    parts = []
+    while page := [[row[i] for i in columns] for row in itertools.islice(rows, batch_size)]:
+        stream, patient_id, date = zip(*page)
+        dates = pd.to_datetime(pd.Series(date, dtype=object)).to_numpy("datetime64[D]")
+        parts.append((np.array(stream), np.array(patient_id, dtype="int64"), dates))
+    backend.execute_queries(["DROP TABLE #events", "DROP TABLE #event_population"])
+
+    stream = np.concatenate([part[0] for part in parts])
+    patient_id = np.concatenate([part[1] for part in parts])
+    dates = np.concatenate([part[2] for part in parts])
+    streams = []
+    for number in range(len(selects) - 1):
+        mine = stream == number
+        streams.append((patient_id[mine], to_days(dates[mine])))
+    return patient_id[stream == -1], streams
+
+
+def fetch_events(study, batch_size=BATCH_SIZE):
+    """EventArrays for the study population, from the database"""
+    import codelists
+    from incremental_cohort import substudy
+
+    backend = substudy(study, {"population"}).backend
+    queries, selects = population_queries(backend), []
+    start, end = EVENT_PERIOD
+    for number, (stream, name) in enumerate(CLINICAL_STREAMS.items()):
+        codelist_queries, select = clinical_events_select(
+            backend, number, getattr(codelists, name), start, end, stream
+        )
+        queries += codelist_queries
+        selects.append(select)
+    selects.append(sgss_select(len(CLINICAL_STREAMS), "negative", *sgss_period()))
+    population, streams = fetch_streams(backend, queries, selects, batch_size)
+    return from_rows(population, dict(zip(STREAMS, streams)))
+
+
+def events_from_cohort(path, seed=0):
+    """The events a (dummy) cohort's columns imply; see the module docstring"""
+    weeks = [week for week, *_ in RTI_WEEKS]
+    columns = ["patient_id", "lrti_in_period"]
+    columns += [f"rti_{week}" for week in weeks] + [f"neg_{week}" for week in weeks]
+    df = pq.read_table(path, columns=columns).to_pandas(date_as_object=False)
+    # from_rows() needs the population in patient_id order
+    df = df.sort_values("patient_id", kind="stable", ignore_index=True)
+    patient_ids = df["patient_id"].to_numpy("int64")
+
+    rti = df[[f"rti_{week}" for week in weeks]].to_numpy("datetime64[D]")
+    negative = df[[f"neg_{week}" for week in weeks]].fillna(0).to_numpy("int64") == 1
+    row = np.repeat(patient_ids[:, None], len(weeks), axis=1)
+    has_rti = ~np.isnat(rti)
+    has_negative = has_rti & negative
+
+    rng = np.random.default_rng(seed)
+    lrti_counts = df["lrti_in_period"].fillna(0).clip(lower=0).to_numpy("int64")
+    start, end = to_days(list(EVENT_PERIOD))
+    streams = {
+        "rti": (row[has_rti], to_days(rti[has_rti])),
+        "lrti": (
+            np.repeat(patient_ids, lrti_counts),
+            rng.integers(start, end + 1, lrti_counts.sum()).astype("int32"),
+        ),
+        SGSS_STREAM: (row[has_negative], to_days(rti[has_negative])),
+    }
+    return from_rows(patient_ids, streams)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--output", default=EVENTS_PATH)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--from-cohort", help="build dummy events from this cohort instead")
+    args = parser.parse_args()
+
+    if args.from_cohort:
+        events = events_from_cohort(args.from_cohort)
+    else:
+        sys.path.insert(0, "./analysis")
+        study = __import__(args.study_definition).study
+        if study.backend is None:
+            sys.exit("DATABASE_URL is not set; use --from-cohort for dummy data")
+        events = fetch_events(study, args.batch_size)
+    write_events(events, args.output)
+    totals = ", ".join(f"{len(events.days[stream])} {stream}" for stream in STREAMS)
+    print(f"Wrote {totals} events for {len(events)} patients to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
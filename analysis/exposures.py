@@ -0,0 +1,67 @@
+# WEEKLY RTI EXPOSURE WINDOWS
+# Each entry is (suffix, start, end, incidence). The suffixes give the
+# rti_XXXX / neg_XXXX column names expected by the
+# `foreach week in 0900 ... 1130` loop in cr_analysis_dataset.do, so new
+# windows only need adding here (and to that loop).
+RTI_WEEKS = [
+    ("0900", "2020-06-09", "2020-08-31", 0.1),
+    ("0907", "2020-09-01", "2020-09-07", 0.03),
+    ("0914", "2020-09-08", "2020-09-14", 0.03),
+    ("0921", "2020-09-15", "2020-09-21", 0.03),
+    ("0928", "2020-09-22", "2020-09-28", 0.03),
+    ("1005", "2020-09-29", "2020-10-05", 0.03),
+    ("1012", "2020-10-06", "2020-10-12", 0.03),
+    ("1019", "2020-10-13", "2020-10-19", 0.03),
+    ("1026", "2020-10-20", "2020-10-26", 0.03),
+    ("1102", "2020-10-27", "2020-11-02", 0.03),
+    ("1109", "2020-11-03", "2020-11-09", 0.03),
+    ("1116", "2020-11-10", "2020-11-16", 0.03),
+    ("1123", "2020-11-17", "2020-11-23", 0.03),
+    ("1130", "2020-11-24", "2020-11-30", 0.03),
+]
+
+# SGSS negative tests within this many days either side of the RTI count
+# towards the neg_XXXX flag
+NEGATIVE_TEST_WINDOW_DAYS = 5
+
+
+def weekly_rti_variables(codelist, weeks=RTI_WEEKS, window_days=NEGATIVE_TEST_WINDOW_DAYS):
+    """
+    Build the rti_XXXX (date of last RTI code in the week) and neg_XXXX
+    (negative SGSS test within +/- window_days of that RTI) variable pairs
+    for every window in `weeks`, ready to be unpacked into StudyDefinition.
+
+    Every week is generated from the same template, so the windows can only
+    differ in their dates and adding a week is a one-line change to RTI_WEEKS.
+    """
+    # Imported here so the Python analysis actions can share RTI_WEEKS
+    # without cohortextractor installed
+    from cohortextractor import patients
+
+    variables = {}
+    for week, start, end, incidence in weeks:
+        rti = f"rti_{week}"
+        variables[rti] = patients.with_these_clinical_events(
+            codelist,
+            between=[start, end],
+            returning="date",
+            find_last_match_in_period=True,
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": start, "latest": end},
+                "incidence": incidence,
+            },
+        )
+        variables[f"neg_{week}"] = patients.with_test_result_in_sgss(
+            pathogen="SARS-CoV-2",
+            test_result="negative",
+            between=[
+                f"{rti} - {window_days} days",
+                f"{rti} + {window_days} days",
+            ],
+            returning="binary_flag",
+            find_last_match_in_period=True,
+            restrict_to_earliest_specimen_date=False,
+            return_expectations={"incidence": 0.5},
+        )
+    return variables
@@ -0,0 +1,220 @@
+"""
+Household exposure covariates: infections among each patient's co-residents.
+
+For every patient in the cohort (from crINPUT), over the other cohort members
+of their household (household_as_of's pseudo_id; 0 is no household):
+
+    household_members          cohort members in the household, with them
+    household_infected         co-residents with an RTI or COVID diagnosis
+                               before the patient's own min_rti (before
+                               CENSOR_DATE if they have no RTI)
+    household_first_infection  earliest infection date among co-residents
+
+A co-resident's infection date is the earliest of their RTI weeks,
+covid_tpp_probable and first_pos_test_sgss. Self-joining each household
+with Stata is quadratic in household size, which care homes make unusable.
+Instead, rows are ordered once by (household, infection date) into a CSR
+index, whose `indptr` gives each household's slice:
+
+    - the count is a binary search of the patient's reference date in their
+      household's sorted dates, less one if their own infection is earlier
+    - the leave-one-out minimum is the household's first date, or its second
+      for the patient holding the first
+
+so the whole cohort takes one sort and a few vectorised passes. Run from the
+repository root (the crHOUSE action), then in Stata
+`merge 1:1 patient_id using output/household_exposures.dta`:
+
+    python analysis/household_exposures.py
+
+--check instead compares the columns with a loop over every pair of
+co-residents, which is slow but plainly right.
+"""
+import argparse
+import collections
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from exposures import RTI_WEEKS
+
+# Patients without an RTI count co-residents infected before the end of
+# follow-up, as cr_analysis_dataset's censor_date
+CENSOR_DATE = np.datetime64("2020-12-01")
+
+RTI_COLUMNS = [f"rti_{week}" for week, *_ in RTI_WEEKS]
+COVID_COLUMNS = ["covid_tpp_probable", "first_pos_test_sgss"]
+
+# Day number standing in for "never", after every real date
+NEVER = np.iinfo("int32").max
+
+
+def to_days(dates):
+    """Days since 1970 of a datetime64 array, NEVER for NaT"""
+    days = dates.astype("datetime64[D]").astype("int64")
+    return np.where(np.isnat(dates), NEVER, days)
+
+
+class HouseholdIndex:
+    """
+    Rows grouped by household, CSR style: the members of household h are rows
+    order[indptr[h]:indptr[h + 1]], sorted by `days`. `household` is each
+    row's h, -1 for rows without a household
+    """
+
+    def __init__(self, household_ids, days):
+        household_ids = np.asarray(household_ids)
+        housed = np.flatnonzero(household_ids > 0)
+        self.ids, codes = np.unique(household_ids[housed], return_inverse=True)
+        self.household = np.full(len(household_ids), -1)
+        self.household[housed] = codes
+        # lexsort sorts by its last key first
+        self.order = housed[np.lexsort((days[housed], codes))]
+        self.indptr = np.zeros(len(self.ids) + 1, dtype="int64")
+        np.cumsum(np.bincount(codes, minlength=len(self.ids)), out=self.indptr[1:])
+        self.days = days
+
+    def sizes(self):
+        """Members of each row's household, 0 without one"""
+        counts = np.diff(self.indptr)
+        return np.where(self.household >= 0, counts[self.household], 0)
+
+    def count_others_before(self, reference):
+        """Per row, the other members of its household with days < reference"""
+        housed = self.household >= 0
+        h = self.household[housed]
+        # (household, day) pairs as one sortable key, in the index's order
+        span = np.int64(NEVER) + 1
+        keys = self.household[self.order] * span + self.days[self.order]
+        before = np.searchsorted(keys, h * span + reference[housed], side="left")
+        own = self.days[housed] < reference[housed]
+        counts = np.zeros(len(self.household), dtype="int64")
+        counts[housed] = before - self.indptr[h] - own
+        return counts
+
+    def min_of_others(self):
+        """Per row, the earliest days among the other members, NEVER if none"""
+        starts, sizes = self.indptr[:-1], np.diff(self.indptr)
+        first = self.days[self.order[starts]]
+        second = np.full(len(self.ids), NEVER, dtype="int64")
+        pairs = sizes > 1
+        second[pairs] = self.days[self.order[starts[pairs] + 1]]
+
+        housed = self.household >= 0
+        h = self.household[housed]
+        # Ties leave second == first, so either holder of the minimum gets it
+        holds_first = np.zeros(len(self.household), dtype=bool)
+        holds_first[self.order[starts]] = True
+        minimum = np.full(len(self.household), NEVER, dtype="int64")
+        minimum[housed] = np.where(holds_first[housed], second[h], first[h])
+        return minimum
+
+
+def read_cohort(path, batch_size=250_000):
+    """patient_id, household_id, infection days and reference days per row"""
+    parquet = pq.ParquetFile(path)
+    columns = ["patient_id", "household_id"] + RTI_COLUMNS + COVID_COLUMNS
+    parts = {name: [] for name in ["patient_id", "household_id", "infection", "reference"]}
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        df = batch.to_pandas(date_as_object=False)
+        min_rti = df[RTI_COLUMNS].min(axis=1).to_numpy("datetime64[ns]")
+        covid = df[COVID_COLUMNS].min(axis=1).to_numpy("datetime64[ns]")
+        parts["patient_id"].append(df["patient_id"].to_numpy("int64"))
+        parts["household_id"].append(df["household_id"].fillna(0).to_numpy("int64"))
+        parts["infection"].append(np.minimum(to_days(min_rti), to_days(covid)))
+        parts["reference"].append(
+            np.where(np.isnat(min_rti), to_days(np.array([CENSOR_DATE])), to_days(min_rti))
+        )
+    return {name: np.concatenate(values) for name, values in parts.items()}
+
+
+def household_exposures(cohort):
+    """The exposure columns for every row of read_cohort()'s arrays"""
+    index = HouseholdIndex(cohort["household_id"], cohort["infection"])
+    first = index.min_of_others()
+    first_dates = np.where(first == NEVER, np.datetime64("NaT"), first.astype("datetime64[D]"))
+    return pd.DataFrame(
+        {
+            "patient_id": cohort["patient_id"],
+            "household_members": index.sizes(),
+            "household_infected": index.count_others_before(cohort["reference"]),
+            "household_first_infection": first_dates.astype("datetime64[ns]"),
+        }
+    )
+
+
+def pairwise_exposures(cohort):
+    """
+    (household_members, household_infected, first infection days) by
+    comparing every pair of co-residents, for --check
+    """
+    households = collections.defaultdict(list)
+    for row, household_id in enumerate(cohort["household_id"]):
+        if household_id > 0:
+            households[household_id].append(row)
+    infection, reference = cohort["infection"], cohort["reference"]
+    n = len(infection)
+    members = np.zeros(n, dtype="int64")
+    infected = np.zeros(n, dtype="int64")
+    first = np.full(n, NEVER, dtype="int64")
+    for rows in households.values():
+        for row in rows:
+            others = [other for other in rows if other != row]
+            members[row] = len(rows)
+            infected[row] = sum(infection[other] < reference[row] for other in others)
+            first[row] = min((infection[other] for other in others), default=NEVER)
+    return members, infected, first
+
+
+def check(cohort, df):
+    """Exit with an error where household_exposures() and the pairwise loop differ"""
+    members, infected, first = pairwise_exposures(cohort)
+    first_days = to_days(df["household_first_infection"].to_numpy("datetime64[ns]"))
+    wrong = {
+        "household_members": df["household_members"].to_numpy() != members,
+        "household_infected": df["household_infected"].to_numpy() != infected,
+        "household_first_infection": first_days != first,
+    }
+    for name, rows in wrong.items():
+        if rows.any():
+            example = df["patient_id"][rows.argmax()]
+            sys.exit(f"{name} differs for {rows.sum()} patients, e.g. patient {example}")
+    print(f"Household exposures match the pairwise loop for {len(df)} patients")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="output/input.parquet")
+    parser.add_argument("--output", default="output/household_exposures.parquet")
+    parser.add_argument("--dta", default="output/household_exposures.dta")
+    parser.add_argument("--batch-size", type=int, default=250_000)
+    parser.add_argument(
+        "--check", action="store_true", help="compare with a pairwise loop instead of writing"
+    )
+    args = parser.parse_args()
+
+    cohort = read_cohort(args.input, args.batch_size)
+    df = household_exposures(cohort)
+    if args.check:
+        check(cohort, df)
+        return
+    df.to_parquet(args.output, index=False, compression="zstd")
+    if args.dta:
+        df.to_stata(
+            args.dta,
+            version=118,
+            write_index=False,
+            convert_dates={"household_first_infection": "td"},
+            variable_labels={
+                "household_members": "Cohort members in household",
+                "household_infected": "Co-residents infected before first RTI",
+                "household_first_infection": "Earliest co-resident infection",
+            },
+        )
+    print(f"Wrote household exposures for {len(df)} patients to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
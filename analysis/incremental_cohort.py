@@ -0,0 +1,214 @@
+"""
+Incrementally re-extract the cohort, querying only changed variables.
+
+Every output column is cached under .cache/cohort/ keyed by a hash of its
+full definition: query type and arguments, codelist contents, evaluated
+window dates and return_expectations, plus the hashes of the population and
+of any variables it references (e.g. neg_0900 -> rti_0900). A rerun only
+sends new or changed variables (and their dependencies) to the database,
+then joins them onto the cached columns by patient_id.
+
+Columns are also keyed by a data snapshot label (today's date unless
+--snapshot is given) so results from different database extracts are never
+mixed. Run from the repository root inside the cohortextractor environment:
+
+    python analysis/incremental_cohort.py --output output/input.feather
+"""
+import argparse
+import copy
+import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+CACHE_DIR = Path(".cache/cohort")
+
+NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+# The cohortextractor release whose private StudyDefinition attributes
+# with_covariates() was written against, and those attributes
+COHORTEXTRACTOR_VERSION = "1.93.3"
+STUDY_INTERNALS = [
+    "_original_covariates",
+    "_original_default_expectations",
+    "index_date",
+    "backend",
+    "set_index_date",
+    "get_pandas_csv_args",
+]
+
+
+def _canonical(value):
+    if hasattr(value, "system"):
+        codes = sorted(list(code) if isinstance(code, tuple) else [code] for code in value)
+        return {"system": value.system, "codes": codes}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in value.items()}
+    return value
+
+
+def _strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _strings(item)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _strings(key)
+            yield from _strings(item)
+
+
+def dependencies(covariate_definitions):
+    """
+    Map each variable to the other variables it references, via anchored
+    windows ("rti_0900 + 5 days"), categorised_as expressions, value_from
+    sources and aggregate_of column lists
+    """
+    names = set(covariate_definitions)
+    deps = {}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        found = set()
+        for arg, value in kwargs.items():
+            if arg == "return_expectations" or hasattr(value, "system"):
+                continue
+            for string in _strings(value):
+                found.update(NAME_RE.findall(string))
+        deps[name] = (found & names) - {name}
+    return deps
+
+
+def variable_hashes(covariate_definitions, snapshot):
+    deps = dependencies(covariate_definitions)
+    hashes = {}
+
+    def hash_of(name):
+        if name not in hashes:
+            funcname, kwargs = covariate_definitions[name]
+            definition = json.dumps(
+                [funcname, _canonical(kwargs)], sort_keys=True, default=str
+            )
+            digest = hashlib.sha256(definition.encode())
+            digest.update(snapshot.encode())
+            if name != "population":
+                digest.update(hash_of("population").encode())
+            for dep in sorted(deps[name]):
+                digest.update(hash_of(dep).encode())
+            hashes[name] = digest.hexdigest()[:16]
+        return hashes[name]
+
+    for name in covariate_definitions:
+        hash_of(name)
+    return hashes
+
+
+def with_dependencies(names, covariate_definitions):
+    deps = dependencies(covariate_definitions)
+    needed, stack = set(), list(names)
+    while stack:
+        name = stack.pop()
+        if name not in needed:
+            needed.add(name)
+            stack.extend(deps[name])
+    return needed
+
+
+def with_covariates(study, covariates):
+    """
+    A copy of `study` rebuilt from `covariates` ({name: (funcname, kwargs)},
+    in the form of its `_original_covariates`). cohortextractor has no
+    public way to do this, so it relies on StudyDefinition rebuilding its
+    evaluated definitions and backend from `_original_covariates` in
+    set_index_date(), and checks the version and attributes first
+    """
+    import cohortextractor
+
+    if cohortextractor.__version__ != COHORTEXTRACTOR_VERSION:
+        raise RuntimeError(
+            f"with_covariates() relies on StudyDefinition internals of cohortextractor "
+            f"{COHORTEXTRACTOR_VERSION}, not {cohortextractor.__version__}; check "
+            f"set_index_date() still rebuilds from _original_covariates, then update "
+            f"COHORTEXTRACTOR_VERSION"
+        )
+    missing = [name for name in STUDY_INTERNALS if not hasattr(study, name)]
+    if missing:
+        raise RuntimeError(
+            f"StudyDefinition has no {', '.join(missing)}, which with_covariates() relies on"
+        )
+    rebuilt = copy.copy(study)
+    rebuilt._original_covariates = covariates
+    rebuilt.set_index_date(study.index_date)
+    rebuilt.pandas_csv_args = rebuilt.get_pandas_csv_args(rebuilt.covariate_definitions)
+    return rebuilt
+
+
+def substudy(study, names):
+    """A copy of `study` restricted to the given variables (plus population)"""
+    return with_covariates(
+        study,
+        {
+            name: definition
+            for name, definition in study._original_covariates.items()
+            if name in names or name == "population"
+        },
+    )
+
+
+def cache_path(name, digest):
+    return CACHE_DIR / f"{name}-{digest}.feather"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--output", default="output/input.feather")
+    parser.add_argument("--snapshot", default=datetime.date.today().isoformat())
+    args = parser.parse_args()
+
+    sys.path.insert(0, "./analysis")
+    study = __import__(args.study_definition).study
+    if study.backend is None:
+        sys.exit("DATABASE_URL is not set; use generate_cohort for dummy data")
+
+    definitions = study.covariate_definitions
+    hashes = variable_hashes(definitions, args.snapshot)
+    outputs = [
+        name
+        for name, (_, kwargs) in definitions.items()
+        if name != "population" and not kwargs.get("hidden")
+    ]
+    changed = [name for name in outputs if not cache_path(name, hashes[name]).exists()]
+    print(f"{len(outputs) - len(changed)} cached columns, {len(changed)} to extract")
+
+    if changed:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        extract_path = CACHE_DIR / f"extract-{os.getpid()}.feather"
+        substudy(study, with_dependencies(changed, definitions)).to_file(extract_path)
+        extracted = pd.read_feather(extract_path)
+        for name in extracted.columns.drop("patient_id"):
+            extracted[["patient_id", name]].to_feather(cache_path(name, hashes[name]))
+        extract_path.unlink()
+
+    # Every cached column was extracted for the same population, so the
+    # join is one-to-one on patient_id
+    columns = [
+        pd.read_feather(cache_path(name, hashes[name])).set_index("patient_id")
+        for name in outputs
+    ]
+    cohort = pd.concat(columns, axis=1, join="outer").reset_index()
+    if args.output.endswith(".feather"):
+        cohort.to_feather(args.output)
+    else:
+        cohort.to_csv(args.output, index=False)
+    print(f"Wrote {len(cohort)} patients to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""
+Resolve variables with windows anchored on other variables in one interval join.
+
+The neg_XXXX variables look for a negative SGSS test
+`between=["rti_XXXX - 5 days", "rti_XXXX + 5 days"]`, and cohortextractor
+turns each of them into its own query joining the SGSS tables to that
+anchor, so every weekly window added scans the tests again. Here every
+such variable is compiled instead into one join per scan (grouped as in
+query_plan.py, so all 14 neg_XXXX share one):
+
+    1. the rest of the cohort, anchors included, is extracted as usual
+    2. each scan's events are fetched once, for the population, between the
+       earliest anchor's window start and the latest one's end, in
+       (patient, date) order (event_arrays.fetch_streams)
+    3. every anchor of every variable in the scan is matched against the
+       sorted events with one binary search for each end of its window
+       (EventArrays.window_bounds), and the variable's value read off the
+       matched range: a flag, the first or last date, or the count
+
+so the work grows with the number of events and anchors, not with the
+number of anchored variables times the size of the table.
+
+A variable is joined when both ends of its window are "<variable>",
+"<variable> + N days" or "<variable> - N days" on the same output date
+variable, it reads clinical events by codelist or SGSS tests without the
+options this doesn't reproduce, and no other variable references it.
+Anything else is left to cohortextractor. Run from the repository root
+inside the cohortextractor environment:
+
+    python analysis/interval_join.py --output output/input.feather
+
+`python analysis/interval_join.py --plan` lists the joins without a database.
+`--check output/input.parquet` resolves them on random events around a
+(dummy) cohort's anchors and compares the values with a loop over every
+event, also without a database.
+"""
+import argparse
+import collections
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+from event_arrays import (
+    BATCH_SIZE,
+    clinical_events_select,
+    fetch_streams,
+    from_days,
+    from_rows,
+    population_queries,
+    sgss_select,
+    to_days,
+)
+from incremental_cohort import dependencies, substudy
+from query_plan import scan_predicate
+
+# "<variable>", "<variable> + N days" or "<variable> - N days"
+ANCHOR_RE = re.compile(r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*(?:([+-])\s*(\d+)\s*days?)?\s*$")
+
+# Arguments each query type may have; anything else leaves the variable to
+# cohortextractor
+JOINABLE_ARGS = {
+    "with_these_clinical_events": {"codelist"},
+    "with_test_result_in_sgss": {"pathogen", "test_result", "restrict_to_earliest_specimen_date"},
+}
+COMMON_ARGS = {
+    "between",
+    "returning",
+    "find_first_match_in_period",
+    "find_last_match_in_period",
+    "date_format",
+    "return_expectations",
+    "column_type",
+}
+# Options this doesn't reproduce, allowed only when unset
+UNSUPPORTED_ARGS = {
+    "hidden",
+    "include_date_of_match",
+    "ignore_missing_values",
+    "ignore_days_where_these_codes_occur",
+    "episode_defined_as",
+    "include_reference_range_columns",
+}
+RETURNING = {"binary_flag", "date", "number_of_matches_in_period"}
+# Dates are joined at day precision; without a date_format cohortextractor
+# writes only the year
+DAY_FORMAT = "YYYY-MM-DD"
+
+# (name suffix, returning, first) of the reductions --check compares
+REDUCTIONS = [
+    ("", "binary_flag", False),
+    ("_count", "number_of_matches_in_period", False),
+    ("_first", "date", True),
+    ("_last", "date", False),
+]
+
+AnchoredWindow = collections.namedtuple(
+    "AnchoredWindow", ["name", "anchor", "low", "high", "returning", "first"]
+)
+
+
+def parse_anchor(expression):
+    """(variable, days offset) of an anchored date expression, else None"""
+    match = ANCHOR_RE.match(str(expression))
+    if not match:
+        return None
+    name, sign, days = match.groups()
+    return name, (-1 if sign == "-" else 1) * int(days or 0)
+
+
+def anchored_window(name, funcname, kwargs):
+    """The AnchoredWindow of a variable this can join, else None"""
+    if funcname not in JOINABLE_ARGS:
+        return None
+    if set(kwargs) - JOINABLE_ARGS[funcname] - COMMON_ARGS - UNSUPPORTED_ARGS:
+        return None
+    if any(kwargs.get(arg) for arg in UNSUPPORTED_ARGS):
+        return None
+    returning = kwargs.get("returning", "binary_flag")
+    if returning not in RETURNING:
+        return None
+    if returning == "date" and kwargs.get("date_format") != DAY_FORMAT:
+        return None
+    if funcname == "with_test_result_in_sgss":
+        if kwargs.get("pathogen") != "SARS-CoV-2":
+            return None
+        if kwargs.get("test_result") not in ("positive", "negative", "any"):
+            return None
+    between = kwargs.get("between") or (None, None)
+    ends = [parse_anchor(end) if end is not None else None for end in between]
+    if None in ends or ends[0][0] != ends[1][0]:
+        return None
+    (anchor, low), (_, high) = ends
+    first = bool(kwargs.get("find_first_match_in_period"))
+    return AnchoredWindow(name, anchor, low, high, returning, first)
+
+
+def is_output_date(funcname, kwargs):
+    return (
+        kwargs.get("returning") == "date"
+        and not kwargs.get("hidden")
+        and kwargs.get("date_format") == DAY_FORMAT
+        and funcname not in ("categorised_as", "aggregate_of")
+    )
+
+
+def joinable_windows(covariate_definitions):
+    """
+    {scan predicate: [AnchoredWindow, ...]} of the variables to join, in
+    study definition order
+    """
+    deps = dependencies(covariate_definitions)
+    referenced = {dep for name, found in deps.items() for dep in found}
+    windows = {}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        window = anchored_window(name, funcname, kwargs)
+        if window is None or name in referenced or window.anchor not in covariate_definitions:
+            continue
+        if is_output_date(*covariate_definitions[window.anchor]):
+            windows[name] = window
+    groups = {}
+    for name, window in windows.items():
+        # Anchors must come out of the ordinary extraction
+        if window.anchor in windows:
+            continue
+        predicate = scan_predicate(*covariate_definitions[name])
+        groups.setdefault(predicate, []).append(window)
+    return groups
+
+
+def group_select(backend, number, funcname, kwargs, start, end, label):
+    """(queries, SELECT) fetching a group's events as stream `number`"""
+    if funcname == "with_these_clinical_events":
+        return clinical_events_select(backend, number, kwargs["codelist"], start, end, label)
+    earliest = kwargs.get("restrict_to_earliest_specimen_date", True)
+    return [], sgss_select(number, kwargs["test_result"], start, end, earliest)
+
+
+def resolve(events, stream, windows, anchors):
+    """
+    Values of `windows` from a stream's events, given their anchors as a
+    patients x windows datetime64 array
+    """
+    low = [window.low for window in windows]
+    high = [window.high for window in windows]
+    first, stop = events.window_bounds(stream, anchors, low, high)
+    days = events.days[stream]
+    found = stop > first
+    columns = {}
+    for i, window in enumerate(windows):
+        if window.returning == "binary_flag":
+            columns[window.name] = found[:, i].astype("int64")
+        elif window.returning == "number_of_matches_in_period":
+            columns[window.name] = (stop - first)[:, i]
+        else:
+            index = first[:, i] if window.first else stop[:, i] - 1
+            dates = np.full(len(events), np.datetime64("NaT"), dtype="datetime64[D]")
+            dates[found[:, i]] = from_days(days[index[found[:, i]]])
+            columns[window.name] = dates.astype("datetime64[ns]")
+    return columns
+
+
+def anchor_columns(cohort, windows):
+    """A group's anchors as a patients x windows datetime64 array"""
+    return np.column_stack(
+        [pd.to_datetime(cohort[window.anchor]).to_numpy("datetime64[D]") for window in windows]
+    )
+
+
+def anchor_range(windows, anchors):
+    """Dates spanning every window of a group, or None if no anchor is set"""
+    lows = anchors + np.array([np.timedelta64(w.low, "D") for w in windows])
+    highs = anchors + np.array([np.timedelta64(w.high, "D") for w in windows])
+    if np.isnat(lows).all():
+        return None
+    return str(np.nanmin(lows)), str(np.nanmax(highs))
+
+
+def join_windows(study, groups, cohort, batch_size=BATCH_SIZE):
+    """The joined columns for `cohort`'s patients, as {name: values}"""
+    definitions = study.covariate_definitions
+    patient_ids = cohort["patient_id"].to_numpy("int64")
+    backend = substudy(study, {"population"}).backend
+    queries, selects, streams = population_queries(backend), [], []
+    for number, windows in enumerate(groups.values()):
+        anchors = anchor_columns(cohort, windows)
+        span = anchor_range(windows, anchors)
+        # Nothing can match, so fetch nothing
+        start, end = span or ("1900-01-01", "1899-12-31")
+        funcname, kwargs = definitions[windows[0].name]
+        group_queries, select = group_select(
+            backend, number, funcname, kwargs, start, end, f"join{number}"
+        )
+        queries += group_queries
+        selects.append(select)
+        streams.append((f"join{number}", windows, anchors))
+
+    population, fetched = fetch_streams(backend, queries, selects, batch_size)
+    events = from_rows(patient_ids, {stream: rows for (stream, *_), rows in zip(streams, fetched)})
+    if len(population) != len(patient_ids) or (np.sort(population) != np.sort(patient_ids)).any():
+        raise RuntimeError("The population changed between the two extractions")
+
+    columns = {}
+    for stream, windows, anchors in streams:
+        columns.update(resolve(events, stream, windows, anchors))
+    return columns
+
+
+def random_events(anchors, windows, start, end, rng, per_patient=4):
+    """
+    (rows, days) of random events from start to end days, plus events on
+    and just outside both ends of some windows, for check()
+    """
+    counts = rng.poisson(per_patient, len(anchors))
+    rows = [np.repeat(np.arange(len(anchors)), counts)]
+    days = [rng.integers(start, end + 1, counts.sum())]
+    edge_rows, columns = np.nonzero(~np.isnat(anchors) & (rng.random(anchors.shape) < 0.1))
+    anchor_days = anchors[edge_rows, columns].astype("int64")
+    for ends, step in (([w.low for w in windows], -1), ([w.high for w in windows], 1)):
+        edge = anchor_days + np.asarray(ends)[columns]
+        rows += [edge_rows, edge_rows]
+        days += [edge, edge + step]
+    return np.concatenate(rows), np.concatenate(days)
+
+
+def looped_values(days_by_row, windows, anchors):
+    """resolve()'s columns by testing every event against every window"""
+    columns = {window.name: [] for window in windows}
+    for row, days in enumerate(days_by_row):
+        for window, anchor in zip(windows, anchors[row]):
+            if np.isnat(anchor):
+                matches = []
+            else:
+                offsets = days - anchor.astype("int64")
+                matches = sorted(days[(offsets >= window.low) & (offsets <= window.high)])
+            if window.returning == "binary_flag":
+                value = int(bool(matches))
+            elif window.returning == "number_of_matches_in_period":
+                value = len(matches)
+            elif matches:
+                value = from_days(matches[0 if window.first else -1])
+            else:
+                value = np.datetime64("NaT")
+            columns[window.name].append(value)
+    return {name: np.array(values) for name, values in columns.items()}
+
+
+def check(groups, cohort, seed=0):
+    """
+    Exit with an error where resolve() and looped_values() differ on random
+    events around `cohort`'s anchors
+    """
+    cohort = cohort.sort_values("patient_id", ignore_index=True)
+    patient_ids = cohort["patient_id"].to_numpy("int64")
+    rng = np.random.default_rng(seed)
+    for number, windows in enumerate(groups.values()):
+        # Every reduction of each window, whichever the study uses
+        windows = [
+            window._replace(name=f"{window.name}{suffix}", returning=returning, first=first)
+            for window in windows
+            for suffix, returning, first in REDUCTIONS
+        ]
+        anchors = anchor_columns(cohort, windows)
+        span = anchor_range(windows, anchors)
+        if span is None:
+            continue
+        start, end = to_days(list(span))
+        rows, days = random_events(anchors, windows, start, end, rng)
+        stream = f"join{number}"
+        events = from_rows(patient_ids, {stream: (patient_ids[rows], days)})
+        resolved = resolve(events, stream, windows, anchors)
+        order = np.argsort(rows, kind="stable")
+        splits = np.cumsum(np.bincount(rows, minlength=len(cohort)))[:-1]
+        days_by_row = np.split(days[order], splits)
+        for name, values in looped_values(days_by_row, windows, anchors).items():
+            if values.dtype.kind == "M":
+                values = values.astype("datetime64[ns]").view("int64")
+                wrong = resolved[name].view("int64") != values
+            else:
+                wrong = resolved[name] != values
+            if wrong.any():
+                example = patient_ids[wrong.argmax()]
+                sys.exit(f"{name} differs for {wrong.sum()} patients, e.g. patient {example}")
+        print(f"{stream}: {len(windows)} columns match the loop over {len(days)} events")
+
+
+def plan(groups):
+    lines = []
+    for (table, _), windows in groups.items():
+        lines.append(f"{table}: one join for {len(windows)} variables")
+        for window in windows:
+            reduction = window.returning
+            if window.returning == "date":
+                reduction = f"{'first' if window.first else 'last'} date"
+            lines.append(
+                f"    {window.name:<32} {reduction} in "
+                f"[{window.anchor} {window.low:+d}d, {window.anchor} {window.high:+d}d]"
+            )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--output", default="output/input.feather")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--plan", action="store_true", help="only list the joins")
+    parser.add_argument("--check", help="check the joins on random events around this cohort")
+    args = parser.parse_args()
+
+    sys.path.insert(0, "./analysis")
+    study = __import__(args.study_definition).study
+    groups = joinable_windows(study.covariate_definitions)
+    print(plan(groups))
+    if args.plan:
+        return
+    if args.check:
+        anchors = {window.anchor for windows in groups.values() for window in windows}
+        columns = ["patient_id", *sorted(anchors)]
+        if args.check.endswith(".feather"):
+            check(groups, pd.read_feather(args.check, columns=columns))
+        else:
+            check(groups, pd.read_parquet(args.check, columns=columns))
+        return
+    if study.backend is None:
+        sys.exit("DATABASE_URL is not set; use generate_cohort for dummy data")
+
+    joined = {window.name for windows in groups.values() for window in windows}
+    rest = substudy(study, set(study.covariate_definitions) - joined)
+    extract_path = f"{args.output}.{os.getpid()}.feather"
+    rest.to_file(extract_path)
+    cohort = pd.read_feather(extract_path)
+    os.unlink(extract_path)
+
+    columns = join_windows(study, groups, cohort, args.batch_size)
+    for name, values in columns.items():
+        cohort[name] = values
+    # Columns in study definition order, as generate_cohort writes them
+    cohort = cohort[["patient_id"] + [name for name in study.covariate_definitions if name in cohort]]
+    if args.output.endswith(".feather"):
+        cohort.to_feather(args.output, compression="zstd")
+    else:
+        cohort.to_csv(args.output, index=False)
+    print(f"Wrote {len(cohort)} patients, {len(joined)} columns by interval join, to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,680 @@
+"""
+Serve the numeric measurement variables from one per-patient index.
+
+bmi, bp_sys, bp_dias, creatinine, hba1c_mmol_per_mol and hba1c_percentage
+each want a patient's most recent value (and its date) before a cutoff, and
+cohortextractor gives each its own scan of CodedEvent; most_recent_bmi
+alone scans it three times (recorded BMI, weight and height). Here the
+events with any of their codes are read in one scan instead, ordered by
+(codelist, patient, date), and reduced to an index of each patient's
+measurement days per codelist:
+
+    days    the days with a measurement, ascending
+    last    the day's last value, as the backend picks it (latest
+            ConsultationDate, then lowest CodedEvent_ID)
+    total   the sum of the day's values, and `count` how many there are
+
+Every variable is then a binary search for the last day before its cutoff
+(or within its window), read off the index:
+
+    with_these_clinical_events(returning="numeric_value")   last value
+    mean_recorded_value(on_most_recent_day_of_measurement)  that day's mean
+    mean_recorded_value                                     the window's mean
+    most_recent_bmi            weight / height² from the last weight and
+                               height, else the last recorded BMI, with
+                               measurements before minimum_age_at_measurement
+                               dropped as the backend does
+
+and the rest of the cohort is extracted by cohortextractor as usual. A
+variable is only served here when its window is made of fixed dates, its
+codelist is CTV3, and it uses none of the options this doesn't reproduce
+(first values, ignore_missing_values, ...). Run from the repository root
+inside the cohortextractor environment:
+
+    python analysis/measurements.py --output output/input.feather
+
+`python analysis/measurements.py --plan` lists the served variables without
+a database. `--check` serves them (and each with the other reductions) from
+random measurements, and compares them with the backend's queries emulated
+in pandas, also without a database.
+"""
+import argparse
+import collections
+import decimal
+import itertools
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+from cohort_schema import DATE_PRECISION
+from event_arrays import (
+    BATCH_SIZE,
+    FIRST_DAY,
+    LAST_DAY,
+    csr_offsets,
+    day_bounds,
+    day_keys,
+    from_days,
+    population_queries,
+    population_rows,
+    to_days,
+)
+from incremental_cohort import dependencies, substudy
+
+ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# most_recent_bmi's codes, as cohortextractor's TPP backend defines them
+BMI_CODES = {
+    "bmi": ["22K.."],
+    "weight": ["X76C7", "22A.."],
+    "height": ["XM01E", "229.."],
+}
+
+# Arguments each query type may have; anything else leaves the variable to
+# cohortextractor
+MEASURED_ARGS = {
+    "with_these_clinical_events": {
+        "codelist",
+        "returning",
+        "find_last_match_in_period",
+        "include_date_of_match",
+    },
+    "mean_recorded_value": {"codelist", "on_most_recent_day_of_measurement", "include_date_of_match"},
+    "most_recent_bmi": {"minimum_age_at_measurement", "include_date_of_match"},
+}
+COMMON_ARGS = {"between", "date_format", "return_expectations", "column_type"}
+# Options this doesn't reproduce, allowed only when unset
+UNSUPPORTED_ARGS = {
+    "hidden",
+    "find_first_match_in_period",
+    "ignore_missing_values",
+    "ignore_days_where_these_codes_occur",
+    "episode_defined_as",
+}
+
+# Precision of the dates cohortextractor writes for each date_format
+TRUNCATE = {"day": "D", "month": "M", "year": "Y"}
+
+Measurement = collections.namedtuple(
+    "Measurement", ["name", "funcname", "streams", "between", "reduction", "min_age"]
+)
+
+
+def is_fixed_window(between):
+    return all(end is None or ISO_DATE_RE.match(str(end)) for end in between)
+
+
+def measurement(name, funcname, kwargs):
+    """
+    The Measurement a variable is served as, else None. `streams` are
+    (label, codelist) pairs; most_recent_bmi's are its BMI, weight and
+    height codes
+    """
+    if funcname not in MEASURED_ARGS:
+        return None
+    if set(kwargs) - MEASURED_ARGS[funcname] - COMMON_ARGS - UNSUPPORTED_ARGS:
+        return None
+    if any(kwargs.get(arg) for arg in UNSUPPORTED_ARGS):
+        return None
+    between = tuple(kwargs.get("between") or (None, None))
+    if not is_fixed_window(between):
+        return None
+    if funcname == "most_recent_bmi":
+        from cohortextractor.codelistlib import codelist
+
+        streams = [(f"{name}_{kind}", codelist(codes, "ctv3")) for kind, codes in BMI_CODES.items()]
+        min_age = int(kwargs.get("minimum_age_at_measurement", 16))
+        return Measurement(name, funcname, streams, between, "bmi", min_age)
+    if getattr(kwargs["codelist"], "system", None) != "ctv3":
+        return None
+    if funcname == "with_these_clinical_events":
+        if kwargs.get("returning") != "numeric_value":
+            return None
+        reduction = "last"
+    elif kwargs.get("on_most_recent_day_of_measurement"):
+        reduction = "day_mean"
+    else:
+        reduction = "mean"
+    return Measurement(name, funcname, [(name, kwargs["codelist"])], between, reduction, None)
+
+
+def measured_variables(covariate_definitions):
+    """
+    {name: Measurement} of the variables to serve, in study definition
+    order, and {name: date column} of those with include_date_of_match
+    """
+    deps = dependencies(covariate_definitions)
+    date_columns = {
+        kwargs["source"]: name
+        for name, (funcname, kwargs) in covariate_definitions.items()
+        if funcname == "value_from"
+    }
+    # Referenced other than by their own date column
+    referenced = {
+        dep for name, found in deps.items() if covariate_definitions[name][0] != "value_from" for dep in found
+    }
+    measured = {}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        found = measurement(name, funcname, kwargs)
+        if found is not None and name not in referenced:
+            measured[name] = found
+    return measured, {name: date_columns[name] for name in measured if name in date_columns}
+
+
+def codelist_streams(measured):
+    """
+    Unique (label, codelist) streams of the measured variables, keyed by
+    their codes, so variables on the same codelist share one
+    """
+    streams = {}
+    for variable in measured.values():
+        for label, codes in variable.streams:
+            streams.setdefault(frozenset(codes), (label, codes))
+    return streams
+
+
+def scan_window(measured):
+    """The fixed dates covering every variable's window (height has no start)"""
+    starts = [variable.between[0] for variable in measured.values()]
+    ends = [variable.between[1] for variable in measured.values()]
+    if any(variable.reduction == "bmi" for variable in measured.values()):
+        starts.append(None)
+    start = None if None in starts else min(starts)
+    end = None if None in ends else max(ends)
+    return start, end
+
+
+class MeasurementIndex:
+    """
+    Measurement days per patient: patient_id[i]'s days in a stream are
+    days[stream][offsets[stream][i]:offsets[stream][i + 1]], ascending, with
+    each day's last value, total and count in the same positions
+    """
+
+    def __init__(self, patient_id, offsets, days, last, total, count):
+        self.patient_id = patient_id
+        self.offsets = offsets
+        self.days = days
+        self.last = last
+        self.total = total
+        self.count = count
+
+    def __len__(self):
+        return len(self.patient_id)
+
+    def bounds(self, stream, start=None, end=None):
+        """
+        (first, stop) indexes into the stream's days of each patient's days
+        from start to end, both inclusive (None is unbounded)
+        """
+        offsets = self.offsets[stream]
+        if start is None and end is None:
+            return offsets[:-1], offsets[1:]
+        first, stop = day_bounds(
+            offsets,
+            self.days[stream],
+            np.arange(len(self)),
+            FIRST_DAY if start is None else to_days([start])[0],
+            LAST_DAY if end is None else to_days([end])[0],
+        )
+        return first, np.maximum(stop, first)
+
+    def latest(self, stream, start=None, end=None):
+        """
+        (index of each patient's last day in the window, or -1, and whether
+        they have one)
+        """
+        first, stop = self.bounds(stream, start, end)
+        found = stop > first
+        return np.where(found, stop - 1, -1), found
+
+    def window_mean(self, stream, start=None, end=None):
+        """The mean of each patient's values in the window, NaN if none"""
+        first, stop = self.bounds(stream, start, end)
+        totals = np.concatenate([[0], np.cumsum(self.total[stream])])
+        counts = np.concatenate([[0], np.cumsum(self.count[stream])])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (totals[stop] - totals[first]) / (counts[stop] - counts[first])
+
+
+def index_from_rows(patient_ids, streams):
+    """
+    MeasurementIndex for the sorted unique `patient_ids`, from each stream's
+    (patient_id, days, values) arrays of events. Events on the same day
+    must be in the backend's order (by ConsultationDate, then
+    CodedEvent_ID descending), as the scan returns them
+    """
+    patient_ids = np.asarray(patient_ids, dtype="int64")
+    offsets, days, last, total, count = {}, {}, {}, {}, {}
+    for stream, (ids, event_days, values) in streams.items():
+        rows = population_rows(patient_ids, ids, f"{stream} measurements")
+        # lexsort is stable, so each day's events keep their order
+        order = np.lexsort((event_days, rows))
+        rows = rows[order]
+        event_days = np.asarray(event_days, dtype="int64")[order]
+        values = np.asarray(values, dtype="float64")[order]
+        keys = day_keys(rows, event_days)
+        starts = np.flatnonzero(np.insert(keys[1:] != keys[:-1], 0, True))
+        ends = np.append(starts[1:], len(keys)) - 1
+        recorded = ~np.isnan(values)
+        days[stream] = event_days[starts].astype("int32")
+        last[stream] = values[ends]
+        total[stream] = np.add.reduceat(np.where(recorded, values, 0), starts) if len(starts) else values[:0]
+        count[stream] = np.add.reduceat(recorded.astype("int64"), starts) if len(starts) else rows[:0]
+        offsets[stream] = csr_offsets(rows[starts], len(patient_ids))
+    return MeasurementIndex(patient_ids, offsets, days, last, total, count)
+
+
+def take(values, i, found, fill=np.nan):
+    """values[i] where found, else fill (streams can be empty)"""
+    if not len(values):
+        return np.full(len(i), fill)
+    return np.where(found, values[np.where(found, i, 0)], fill)
+
+
+def birth_years(dates_of_birth):
+    """Calendar year of birth, or one no measurement is old enough for if unknown"""
+    dates = np.asarray(dates_of_birth, dtype="datetime64[Y]")
+    return np.where(np.isnat(dates), np.iinfo("int64").max, dates.astype("int64") + 1970)
+
+
+def bmi_values(index, variable, stream_labels, years_of_birth):
+    """
+    most_recent_bmi's (value, date) per patient: the backend's
+    ROUND(COALESCE(weight / SQUARE(NULLIF(height, 0)), bmi), 1), each the
+    last in its window and dropped if taken before min_age (by calendar
+    year, as DATEDIFF(YEAR, ...))
+    """
+    start, end = variable.between
+    labels = {label.rsplit("_", 1)[1]: stream_labels[label] for label, _ in variable.streams}
+    windows = {"bmi": (start, end), "weight": (start, end), "height": (None, end)}
+    latest = {}
+    for kind, (low, high) in windows.items():
+        stream = labels[kind]
+        i, found = index.latest(stream, low, high)
+        days = take(index.days[stream], i, found, 0).astype("int64")
+        years = from_days(days).astype("datetime64[Y]").astype("int64") + 1970
+        found &= years - years_of_birth >= variable.min_age
+        latest[kind] = (take(index.last[stream], i, found), days, found)
+
+    weight, weight_days, has_weight = latest["weight"]
+    height, _, has_height = latest["height"]
+    bmi, bmi_days, has_bmi = latest["bmi"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        computed = weight / np.where(height == 0, np.nan, height) ** 2
+    value = np.where(np.isnan(computed), bmi, computed)
+    # ROUND(value, 1) rounds halves away from zero, unlike np.round
+    value = np.sign(value) * np.floor(np.abs(value) * 10 + 0.5) / 10
+    # The weight's date unless either measurement is missing
+    both = has_weight & has_height & ~np.isnan(weight) & ~np.isnan(height)
+    dated = np.where(both, True, has_bmi)
+    days = np.where(both, weight_days, bmi_days)
+    return value, np.where(dated, from_days(days), np.datetime64("NaT"))
+
+
+def serve(index, variable, stream_labels, years_of_birth):
+    """A variable's (value, date) per patient; NaN and NaT where there's none"""
+    if variable.reduction == "bmi":
+        return bmi_values(index, variable, stream_labels, years_of_birth)
+    ((label, _),) = variable.streams
+    stream = stream_labels[label]
+    i, found = index.latest(stream, *variable.between)
+    days = take(index.days[stream], i, found, 0).astype("int64")
+    dates = np.where(found, from_days(days), np.datetime64("NaT"))
+    if variable.reduction == "last":
+        value = take(index.last[stream], i, found)
+    elif variable.reduction == "day_mean":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            value = take(index.total[stream], i, found) / take(index.count[stream], i, found)
+    else:
+        value = index.window_mean(stream, *variable.between)
+    return np.where(found, value, np.nan), dates
+
+
+def output_date(dates, date_format):
+    """Dates truncated to the precision cohortextractor writes them at"""
+    precision = TRUNCATE[DATE_PRECISION[date_format or "YYYY"]]
+    return np.asarray(dates, dtype="datetime64[D]").astype(f"datetime64[{precision}]").astype(
+        "datetime64[ns]"
+    )
+
+
+def scan_queries(backend, streams, start, end):
+    """
+    Queries uploading each stream's codelist and collecting the population
+    (with dates of birth, as stream -1) and all their events into
+    #measurements, numbered by row_id in (stream, patient, time) order
+    """
+    queries = population_queries(backend)
+    codes = []
+    for number, (label, codelist) in enumerate(streams):
+        # Names the codelist's temporary table and its log line
+        backend._current_column_name = label
+        table, codelist_queries = backend.create_codelist_table(codelist)
+        backend._current_column_name = None
+        queries += codelist_queries
+        codes.append(f"SELECT code, {number} AS stream FROM {table}")
+    conditions = ["1 = 1"]
+    if start is not None:
+        conditions.append(f"CAST(CodedEvent.ConsultationDate AS date) >= '{start}'")
+    if end is not None:
+        conditions.append(f"CAST(CodedEvent.ConsultationDate AS date) <= '{end}'")
+    union = "\nUNION ALL\n".join(codes)
+    queries += [
+        f"SELECT code, stream INTO #measurement_codes FROM ({union}) t",
+        "CREATE CLUSTERED INDEX ix_code ON #measurement_codes (code)",
+        f"""
+        -- Collecting measurements
+        SELECT
+          ROW_NUMBER() OVER (ORDER BY stream, patient_id, consulted, event_id DESC) AS row_id,
+          stream, patient_id, CAST(consulted AS date) AS date, value
+        INTO #measurements
+        FROM (
+          SELECT -1 AS stream, Patient.Patient_ID AS patient_id,
+            CAST(Patient.DateOfBirth AS datetime) AS consulted, 0 AS event_id,
+            CAST(NULL AS float) AS value
+          FROM Patient
+          INNER JOIN #event_population ON #event_population.patient_id = Patient.Patient_ID
+          UNION ALL
+          SELECT codes.stream, CodedEvent.Patient_ID, CodedEvent.ConsultationDate,
+            CodedEvent.CodedEvent_ID, CodedEvent.NumericValue
+          FROM CodedEvent
+          INNER JOIN #measurement_codes codes ON CodedEvent.CTV3Code = codes.code
+          INNER JOIN #event_population ON #event_population.patient_id = CodedEvent.Patient_ID
+          WHERE {" AND ".join(conditions)}
+        ) t
+        """,
+        "CREATE CLUSTERED INDEX ix_row_id ON #measurements (row_id)",
+    ]
+    return queries
+
+
+def fetch_index(backend, streams, start, end, batch_size=BATCH_SIZE):
+    """
+    (MeasurementIndex with a stream per (label, codelist) numbered by
+    position, dates of birth) for the population of `backend`'s study
+    """
+    from cohortextractor.mssql_utils import mssql_fetch_table
+    from cohortextractor.tpp_backend import BACKOFF_FACTOR, RETRIES, SLEEP
+
+    backend.execute_queries(scan_queries(backend, streams, start, end))
+    rows = mssql_fetch_table(
+        get_cursor=backend._get_cursor,
+        table="#measurements",
+        key_column="row_id",
+        batch_size=batch_size,
+        retries=RETRIES,
+        sleep=SLEEP,
+        backoff_factor=BACKOFF_FACTOR,
+    )
+    headers = next(rows)
+    columns = [headers.index(name) for name in ["stream", "patient_id", "date", "value"]]
+    parts = []
+    while page := [[row[i] for i in columns] for row in itertools.islice(rows, batch_size)]:
+        stream, patient_id, date, value = zip(*page)
+        dates = pd.to_datetime(pd.Series(date, dtype=object)).to_numpy("datetime64[D]")
+        values = pd.to_numeric(pd.Series(value, dtype=object)).to_numpy("float64")
+        parts.append((np.array(stream), np.array(patient_id, dtype="int64"), dates, values))
+    backend.execute_queries(
+        ["DROP TABLE #measurements", "DROP TABLE #measurement_codes", "DROP TABLE #event_population"]
+    )
+
+    stream, patient_id, dates, values = (np.concatenate(part) for part in zip(*parts))
+    population = stream == -1
+    by_stream = {}
+    for number in range(len(streams)):
+        mine = stream == number
+        by_stream[number] = (patient_id[mine], to_days(dates[mine]), values[mine])
+    return index_from_rows(patient_id[population], by_stream), dates[population]
+
+
+def serve_all(measured, date_columns, index, stream_numbers, years_of_birth, definitions):
+    """{column: values} of the measured variables and their date columns"""
+    columns = {}
+    for name, variable in measured.items():
+        value, dates = serve(index, variable, stream_numbers, years_of_birth)
+        # cohortextractor writes 0 where there's no value
+        columns[name] = np.nan_to_num(value, nan=0.0)
+        if name in date_columns:
+            date_column = date_columns[name]
+            columns[date_column] = output_date(dates, definitions[date_column][1].get("date_format"))
+    return columns
+
+
+def stream_numbers(measured):
+    """
+    The scan's (label, codelist) streams, and each variable's streams, by
+    label, to their number in the scan
+    """
+    streams = codelist_streams(measured)
+    labels = [label for label, _ in streams.values()]
+    numbers = {
+        label: labels.index(streams[frozenset(codes)][0])
+        for variable in measured.values()
+        for label, codes in variable.streams
+    }
+    return list(streams.values()), numbers
+
+
+def measure(study, measured, date_columns, cohort, batch_size=BATCH_SIZE):
+    """The measured columns for `cohort`'s patients, in its row order"""
+    streams, numbers = stream_numbers(measured)
+    backend = substudy(study, {"population"}).backend
+    index, dates_of_birth = fetch_index(backend, streams, *scan_window(measured), batch_size)
+    patient_ids = cohort["patient_id"].to_numpy("int64")
+    if len(index) != len(patient_ids) or (index.patient_id != np.sort(patient_ids)).any():
+        raise RuntimeError("The population changed between the two extractions")
+    years_of_birth = birth_years(dates_of_birth)
+    columns = serve_all(measured, date_columns, index, numbers, years_of_birth, study.covariate_definitions)
+    # From the index's patient_id order back to the cohort's
+    rows = np.searchsorted(index.patient_id, patient_ids)
+    return {name: values[rows] for name, values in columns.items()}
+
+
+def plan(measured, date_columns):
+    streams = codelist_streams(measured)
+    lines = [f"clinical_events: one scan of {len(streams)} codelists for {len(measured)} variables"]
+    for name, variable in measured.items():
+        start, end = variable.between
+        date = f", date as {date_columns[name]}" if name in date_columns else ""
+        lines.append(f"    {name:<32} {variable.reduction} in [{start or '-'}, {end or '-'}]{date}")
+    return "\n".join(lines)
+
+
+def random_events(n_streams, patient_ids, rng, per_stream=6):
+    """
+    A CodedEvent-like frame (stream, patient_id, event_id, consulted, value)
+    of random measurements for check(), with many on the same day and
+    some at the same time. A tenth of the values are missing and some are 0
+    """
+    counts = rng.poisson(per_stream * n_streams, len(patient_ids))
+    n = counts.sum()
+    start, end = to_days(["2005-01-01", "2021-06-30"])
+    # Half on 200 shared days
+    shared = rng.choice(rng.integers(start, end, 200), n)
+    days = np.where(rng.random(n) < 0.5, shared, rng.integers(start, end, n))
+    times = rng.choice(np.array([0, 9, 9, 14], dtype="timedelta64[h]"), n)
+    # Quarters, so some values round half-way
+    values = np.round(rng.uniform(0, 100, n) * 4) / 4
+    values[rng.random(n) < 0.1] = np.nan
+    values[rng.random(n) < 0.05] = 0
+    return pd.DataFrame(
+        {
+            "stream": rng.integers(0, n_streams, n),
+            "patient_id": np.repeat(patient_ids, counts),
+            "event_id": rng.permutation(n) + 1,
+            "consulted": from_days(days) + times,
+            "value": values,
+        }
+    )
+
+
+def index_from_events(events, patient_ids, n_streams, start, end):
+    """The MeasurementIndex scan_queries() and fetch_index() build from `events`"""
+    date = events["consulted"].dt.normalize()
+    events = events[(date >= (start or "1900-01-01")) & (date <= (end or "2100-01-01"))]
+    # ROW_NUMBER() OVER (ORDER BY stream, patient_id, consulted, event_id DESC)
+    events = events.assign(order=-events["event_id"])
+    events = events.sort_values(["stream", "patient_id", "consulted", "order"])
+    by_stream = {}
+    for number in range(n_streams):
+        mine = events[events["stream"] == number]
+        by_stream[number] = (
+            mine["patient_id"].to_numpy("int64"),
+            to_days(mine["consulted"].to_numpy("datetime64[D]")),
+            mine["value"].to_numpy("float64"),
+        )
+    return index_from_rows(patient_ids, by_stream)
+
+
+def latest_rows(events):
+    """
+    Each patient's row numbered 1 by ROW_NUMBER() OVER (PARTITION BY
+    Patient_ID ORDER BY ConsultationDate DESC, CodedEvent_ID)
+    """
+    events = events.sort_values(["consulted", "event_id"], ascending=[False, True])
+    return events.drop_duplicates("patient_id").set_index("patient_id")
+
+
+def sql_round(value):
+    """ROUND(value, 1), halves away from zero"""
+    if np.isnan(value):
+        return value
+    return float(decimal.Decimal(value).quantize(decimal.Decimal("0.1"), decimal.ROUND_HALF_UP))
+
+
+def backend_values(variable, events, numbers, patients):
+    """
+    A variable's (value, date) per patient (NaN and NaT where there's none),
+    as cohortextractor's TPP queries compute them, over `events`; for check()
+    """
+
+    def window(label, start, end):
+        mine = events[events["stream"] == numbers[label]]
+        date = mine["consulted"].dt.normalize()
+        return mine[(date >= (start or "1900-01-01")) & (date <= (end or "2100-01-01"))]
+
+    def per_patient(series):
+        return series.reindex(patients.index)
+
+    start, end = variable.between
+    if variable.reduction != "bmi":
+        ((label, _),) = variable.streams
+        events = window(label, start, end)
+    if variable.reduction == "last":
+        latest = latest_rows(events)
+        return per_patient(latest["value"]), per_patient(latest["consulted"].dt.normalize())
+    if variable.reduction == "mean":
+        # No date: the backend only gives the most recent day's
+        return per_patient(events.groupby("patient_id")["value"].mean()), None
+    if variable.reduction == "day_mean":
+        day = events["consulted"].dt.normalize()
+        last_day = day.groupby(events["patient_id"]).max()
+        on_day = events[day.to_numpy() == last_day.reindex(events["patient_id"]).to_numpy()]
+        return per_patient(on_day.groupby("patient_id")["value"].mean()), per_patient(last_day)
+
+    latest = {}
+    windows = {"bmi": (start, end), "weight": (start, end), "height": (None, end)}
+    for label, _ in variable.streams:
+        kind = label.rsplit("_", 1)[1]
+        rows = latest_rows(window(label, *windows[kind]))
+        born = patients["date_of_birth"].reindex(rows.index).dt.year
+        # The LEFT JOIN ON DATEDIFF(YEAR, DateOfBirth, ConsultationDate) >= min_age
+        rows = rows[rows["consulted"].dt.year - born >= variable.min_age]
+        latest[kind] = (per_patient(rows["value"]), per_patient(rows["consulted"].dt.normalize()))
+    bmi, bmi_date = latest["bmi"]
+    weight, weight_date = latest["weight"]
+    height, _ = latest["height"]
+    value = (weight / height.where(height != 0) ** 2).fillna(bmi)
+    value = value.map(sql_round)
+    return value, bmi_date.where(weight.isna() | height.isna(), weight_date)
+
+
+def check(measured, n_patients=2000, seed=0):
+    """
+    Exit with an error where serve() and backend_values() differ on random
+    measurements: the study's variables, and each non-BMI one with every
+    reduction, over its own window and a closed one
+    """
+    variables = dict(measured)
+    for name, variable in measured.items():
+        if variable.reduction == "bmi":
+            continue
+        for reduction, between in itertools.product(
+            ["last", "day_mean", "mean"], [variable.between, ("2015-06-01", "2019-12-31")]
+        ):
+            if (reduction, between) != (variable.reduction, variable.between):
+                variant = f"{name} {reduction} in [{between[0] or '-'}, {between[1]}]"
+                variables[variant] = variable._replace(reduction=reduction, between=between)
+    streams, numbers = stream_numbers(variables)
+
+    rng = np.random.default_rng(seed)
+    patient_ids = np.sort(rng.choice(10**7, n_patients, replace=False)) + 1
+    dates_of_birth = from_days(rng.integers(*to_days(["1930-01-01", "2015-01-01"]), n_patients))
+    dates_of_birth[rng.random(n_patients) < 0.02] = np.datetime64("NaT")
+    patients = pd.DataFrame({"date_of_birth": dates_of_birth}, index=patient_ids)
+    events = random_events(len(streams), patient_ids, rng)
+    index = index_from_events(events, patient_ids, len(streams), *scan_window(variables))
+
+    years_of_birth = birth_years(dates_of_birth)
+    for name, variable in variables.items():
+        value, dates = serve(index, variable, numbers, years_of_birth)
+        expected_value, expected_dates = backend_values(variable, events, numbers, patients)
+        expected_value = expected_value.to_numpy("float64")
+        wrong = ~(np.isclose(value, expected_value) | (np.isnan(value) & np.isnan(expected_value)))
+        if expected_dates is not None:
+            expected_dates = expected_dates.to_numpy("datetime64[D]").view("int64")
+            wrong |= np.asarray(dates, dtype="datetime64[D]").view("int64") != expected_dates
+        if wrong.any():
+            example = patient_ids[wrong.argmax()]
+            sys.exit(f"{name} differs for {wrong.sum()} patients, e.g. patient {example}")
+    print(f"{len(variables)} variables match the backend's queries on {len(events)} measurements")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--output", default="output/input.feather")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--plan", action="store_true", help="only list the served variables")
+    parser.add_argument(
+        "--check", action="store_true", help="compare with the backend's queries on random data"
+    )
+    args = parser.parse_args()
+
+    sys.path.insert(0, "./analysis")
+    study = __import__(args.study_definition).study
+    measured, date_columns = measured_variables(study.covariate_definitions)
+    print(plan(measured, date_columns))
+    if args.plan:
+        return
+    if args.check:
+        check(measured)
+        return
+    if study.backend is None:
+        sys.exit("DATABASE_URL is not set; use generate_cohort for dummy data")
+
+    served = set(measured) | set(date_columns.values())
+    rest = substudy(study, set(study.covariate_definitions) - served)
+    extract_path = f"{args.output}.{os.getpid()}.feather"
+    rest.to_file(extract_path)
+    cohort = pd.read_feather(extract_path)
+    os.unlink(extract_path)
+
+    columns = measure(study, measured, date_columns, cohort, args.batch_size)
+    for name, values in columns.items():
+        cohort[name] = values
+    # Columns in study definition order, as generate_cohort writes them
+    cohort = cohort[["patient_id"] + [name for name in study.covariate_definitions if name in cohort]]
+    if args.output.endswith(".feather"):
+        cohort.to_feather(args.output, compression="zstd")
+    else:
+        cohort.to_csv(args.output, index=False)
+    print(f"Wrote {len(cohort)} patients, {len(served)} columns from the measurement index, to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+The MSOA to UTLA lookup as a memory-mapped array.
+
+lookups/MSOA_lookup.csv is compiled (run `python analysis/msoa_lookup.py`)
+into lookups/MSOA_lookup.npy, an int16 UTLA id for every MSOA number (the
+digits of E02000001-E02006934, -1 where there's no MSOA), with the UTLA
+codes and names in lookups/MSOA_lookup.json. Like dictionaries.py's MSOA
+artifact, both are rebuilt on load whenever the recorded hash no longer
+matches the CSV.
+
+Joining is then indexing: each distinct MSOA in a column is parsed once and
+every row takes its UTLA id from the array, rather than every action hashing
+the cohort against the lookup again (`merge m:1 msoa`). The array is opened
+with mmap_mode="r", so the actions and worker processes using it share one
+copy in the page cache.
+"""
+import csv
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+MSOA_LOOKUP_CSV = "./lookups/MSOA_lookup.csv"
+MSOA_LOOKUP_INDEX = "./lookups/MSOA_lookup.npy"
+MSOA_LOOKUP_ARTIFACT = "./lookups/MSOA_lookup.json"
+
+# English MSOA codes; the number after the prefix indexes the array
+MSOA_PREFIX = "E02"
+MSOA_RE = re.compile(rf"{MSOA_PREFIX}\d{{6}}")
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class MsoaLookup:
+    """
+    UTLA ids by MSOA number (`index`), and the code and name of each id.
+    `utla` and `utla_name` end with "", so indexing them with the id -1
+    gives "" for unmatched MSOAs, as merge m:1 leaves them
+    """
+
+    def __init__(self, index, utla, utla_name):
+        self.index = index
+        self.utla = np.array(list(utla) + [""], dtype=object)
+        self.utla_name = np.array(list(utla_name) + [""], dtype=object)
+
+    def utla_ids(self, msoa):
+        """UTLA id of every MSOA code in `msoa`, -1 where it isn't in the lookup"""
+        msoa = pd.Series(msoa)
+        if isinstance(msoa.dtype, pd.CategoricalDtype):
+            codes, uniques = msoa.cat.codes.to_numpy(), msoa.cat.categories
+        else:
+            codes, uniques = pd.factorize(msoa.astype(object))
+        uniques = pd.Series(uniques, dtype=object).astype(str)
+        valid = uniques.str.fullmatch(MSOA_RE.pattern).to_numpy(bool)
+        numbers = np.full(len(uniques), -1)
+        numbers[valid] = uniques[valid].str[len(MSOA_PREFIX):].astype("int64")
+        valid &= numbers < len(self.index)
+        # A trailing -1 for missing MSOAs, whose code is -1
+        ids = np.full(len(uniques) + 1, -1, dtype="int16")
+        ids[:-1][valid] = self.index[numbers[valid]]
+        return ids[codes]
+
+    def join(self, msoa):
+        """utla and utla_name for each MSOA code in `msoa`"""
+        ids = self.utla_ids(msoa)
+        return pd.DataFrame({"utla": self.utla[ids], "utla_name": self.utla_name[ids]})
+
+
+def build_msoa_lookup(
+    csv_path=MSOA_LOOKUP_CSV, index_path=MSOA_LOOKUP_INDEX, artifact_path=MSOA_LOOKUP_ARTIFACT
+):
+    with open(csv_path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    bad = [row["msoa"] for row in rows if not MSOA_RE.fullmatch(row["msoa"])]
+    if bad:
+        raise ValueError(f"Unexpected MSOA codes in {csv_path}: {bad[:5]}")
+    utlas = sorted({(row["utla"], row["utla_name"]) for row in rows})
+    ids = {utla: i for i, (utla, _) in enumerate(utlas)}
+    numbers = [int(row["msoa"][len(MSOA_PREFIX):]) for row in rows]
+    index = np.full(max(numbers) + 1, -1, dtype="int16")
+    index[numbers] = [ids[row["utla"]] for row in rows]
+    artifact = {
+        "source_sha256": _file_hash(csv_path),
+        "utla": [utla for utla, _ in utlas],
+        "utla_name": [name for _, name in utlas],
+    }
+    # A stale artifact is only a slowdown, so don't fail on a read-only checkout
+    try:
+        np.save(index_path, index)
+        with open(artifact_path, "w") as f:
+            json.dump(artifact, f, indent=0)
+    except OSError:
+        pass
+    return MsoaLookup(index, artifact["utla"], artifact["utla_name"])
+
+
+def load_msoa_lookup(
+    csv_path=MSOA_LOOKUP_CSV, index_path=MSOA_LOOKUP_INDEX, artifact_path=MSOA_LOOKUP_ARTIFACT
+):
+    try:
+        with open(artifact_path) as f:
+            artifact = json.load(f)
+        if artifact["source_sha256"] == _file_hash(csv_path):
+            index = np.load(index_path, mmap_mode="r")
+            return MsoaLookup(index, artifact["utla"], artifact["utla_name"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_msoa_lookup(csv_path, index_path, artifact_path)
+
+
+def self_check():
+    """Joins and artifact rebuilds on a tiny lookup, for analysis/self_checks.py"""
+
+    def write_csv(path, rows):
+        with open(path, "w", newline="") as f:
+            f.write("utla,msoa,utla_name\n")
+            f.writelines(f"{utla},{msoa},{name}\n" for utla, msoa, name in rows)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, name) for name in ["lookup.csv", "lookup.npy", "lookup.json"]]
+        rows = [("E09000002", "E02000002", "Barking"), ("E09000001", "E02000004", "City")]
+        write_csv(paths[0], rows)
+        lookup = load_msoa_lookup(*paths)
+        msoa = ["E02000004", "E02000002", None, "E02000003", "E02999999", "W02000002"]
+        joined = lookup.join(msoa)
+        # Missing, unlisted, out-of-range and non-English MSOAs are all unmatched
+        assert list(joined["utla"]) == ["E09000001", "E09000002", "", "", "", ""], joined
+        assert list(joined["utla_name"]) == ["City", "Barking", "", "", "", ""], joined
+        categorical = lookup.utla_ids(pd.Categorical(["E02000002", None, "E02000002"]))
+        assert list(categorical) == [1, -1, 1], categorical
+
+        # An unchanged CSV is served from the memory-mapped artifact
+        assert isinstance(load_msoa_lookup(*paths).index, np.memmap)
+
+        # An edited CSV no longer matches the recorded hash, so it's rebuilt
+        write_csv(paths[0], [("E09000003", "E02000002", "Barnet")])
+        rebuilt = load_msoa_lookup(*paths)
+        assert not isinstance(rebuilt.index, np.memmap)
+        assert list(rebuilt.join(["E02000002", "E02000004"])["utla_name"]) == ["Barnet", ""]
+        with open(paths[2]) as f:
+            assert json.load(f)["source_sha256"] == _file_hash(paths[0])
+
+        # As is a corrupt artifact
+        with open(paths[2], "w") as f:
+            f.write("{")
+        assert list(load_msoa_lookup(*paths).utla) == ["E09000003", ""]
+
+
+if __name__ == "__main__":
+    lookup = build_msoa_lookup()
+    print(
+        f"Wrote {(lookup.index >= 0).sum()} MSOAs in {len(lookup.utla) - 1} UTLAs "
+        f"to {MSOA_LOOKUP_INDEX}"
+    )
@@ -0,0 +1,266 @@
+"""
+Profile a cohort extraction variable by variable.
+
+generate_cohort runs one temporary-table query per variable and then joins
+them, logging only the total, so there's no way to tell which variables
+dominate the runtime. This runs the same queries one variable at a time and
+records for each:
+
+    - wall time of its queries (including codelist uploads and the index)
+    - CPU time, logical reads and physical reads from the session counters
+      in sys.dm_exec_sessions (SQL Server counts scans in 8KB pages; it
+      doesn't report rows scanned per statement without query plans)
+    - rows and kilobytes of its temporary table
+    - null fraction and cardinality of its column in the joined output
+
+Hidden variables (e.g. prednisolone_last_year, which only feeds a
+categorised_as) are profiled too: they still get a temporary table, and
+their column is added to the joined output for the column statistics.
+Derived variables (categorised_as, value_from, aggregate_of) have no query
+of their own and only get column statistics.
+
+The null fraction counts the value cohortextractor writes when there is no
+result ('' for dates and strings, 0 for numbers, -1 for IMD), since the
+output has no NULLs. The profile is written as JSON and HTML; pass the JSON
+of an earlier run as --baseline to flag variables that have got slower.
+Run from the repository root inside the cohortextractor environment:
+
+    python analysis/profile_cohort.py --output output/extraction_profile.json
+"""
+import argparse
+import html
+import json
+import re
+import sys
+import time
+
+from incremental_cohort import with_covariates
+
+SESSION_STATS = """
+SELECT cpu_time, logical_reads, reads
+FROM sys.dm_exec_sessions
+WHERE session_id = @@SPID
+"""
+
+TEMP_TABLE_STATS = """
+SELECT SUM(row_count), SUM(used_page_count) * 8
+FROM tempdb.sys.dm_db_partition_stats
+WHERE object_id = OBJECT_ID('tempdb..#{name}') AND index_id IN (0, 1)
+"""
+
+# get_queries() ends each variable's query list with this index
+INDEX_RE = re.compile(r"^CREATE CLUSTERED INDEX patient_id_ix ON #(\w+) \(patient_id\)$")
+
+PROFILE_TABLE = "#profile_output"
+
+# Slower than the baseline by this factor and by at least this many seconds
+REGRESSION_FACTOR = 1.5
+REGRESSION_SECONDS = 5
+
+
+def unhidden(study):
+    """
+    A copy of `study` with every variable in the output, so hidden
+    sub-variables get column statistics too
+    """
+    return with_covariates(
+        study,
+        {
+            name: (funcname, dict(kwargs, hidden=False) if name != "population" else kwargs)
+            for name, (funcname, kwargs) in study._original_covariates.items()
+        },
+    )
+
+
+def variable_queries(queries):
+    """
+    Split the backend's query list into {variable: [sql, ...]} for the
+    per-variable temporary tables, in order, and the final join query
+    """
+    by_variable, pending = {}, []
+    for query in queries[:-1]:
+        pending.append(query)
+        match = INDEX_RE.match(query.strip())
+        if match:
+            by_variable[match.group(1)] = pending
+            pending = []
+    if pending:
+        raise ValueError("Queries don't end with a temporary table index")
+    return by_variable, queries[-1]
+
+
+def null_value(kwargs):
+    if kwargs.get("returning") == "index_of_multiple_deprivation":
+        return "-1"
+    if kwargs["column_type"] in ("date", "str"):
+        return "''"
+    return "0"
+
+
+def column_stats_query(definitions, names):
+    """One pass over the joined output computing every column's statistics"""
+    selects = ["COUNT(*)"]
+    for name in names:
+        kwargs = definitions[name][1]
+        selects.append(
+            f"SUM(CASE WHEN [{name}] IS NULL OR [{name}] = {null_value(kwargs)} "
+            f"THEN 1 ELSE 0 END)"
+        )
+        selects.append(f"COUNT(DISTINCT [{name}])")
+    return f"SELECT {', '.join(selects)} FROM {PROFILE_TABLE}"
+
+
+def fetch_one(cursor, query):
+    cursor.execute(query)
+    return cursor.fetchone()
+
+
+def timed(cursor, queries):
+    """Run `queries`, returning wall seconds and session counter deltas"""
+    before = fetch_one(cursor, SESSION_STATS)
+    start = time.perf_counter()
+    for query in queries:
+        cursor.execute(query)
+    seconds = time.perf_counter() - start
+    after = fetch_one(cursor, SESSION_STATS)
+    cpu, logical, physical = (a - b for a, b in zip(after, before))
+    return {
+        "seconds": round(seconds, 3),
+        "cpu_seconds": cpu / 1000,
+        "logical_reads": logical,
+        "physical_reads": physical,
+    }
+
+
+def profile_study(study):
+    """
+    Run the study's queries one variable at a time and return the profile
+    as {"variables": {name: {...}}, "join": {...}, "patients": n}
+    """
+    profiled = unhidden(study)
+    definitions = profiled.covariate_definitions
+    by_variable, join_query = variable_queries(profiled.backend.queries)
+    cursor = profiled.backend.get_db_connection().cursor()
+
+    variables = {
+        name: {"query": funcname, "hidden": bool(kwargs.get("hidden"))}
+        for name, (funcname, kwargs) in study.covariate_definitions.items()
+    }
+    # In query order, as anchored windows refer to earlier temporary tables
+    for name, queries in by_variable.items():
+        entry = variables[name]
+        entry.update(timed(cursor, queries))
+        rows, kilobytes = fetch_one(cursor, TEMP_TABLE_STATS.format(name=name))
+        entry.update(temp_table_rows=rows, temp_table_kb=kilobytes)
+        print(f"{name}: {entry['seconds']}s, {rows} rows")
+
+    join = timed(cursor, [f"SELECT * INTO {PROFILE_TABLE} FROM ({join_query}) t"])
+    names = [name for name in definitions if name != "population"]
+    patients, *stats = fetch_one(cursor, column_stats_query(definitions, names))
+    for name, nulls, distinct in zip(names, stats[::2], stats[1::2]):
+        variables[name].update(
+            null_fraction=round(nulls / patients, 4) if patients else None,
+            cardinality=distinct,
+        )
+    cursor.execute(f"DROP TABLE {PROFILE_TABLE}")
+    return {"patients": patients, "join": join, "variables": variables}
+
+
+def regressions(profile, baseline):
+    """Variables at least REGRESSION_FACTOR times slower than in `baseline`"""
+    slower = {}
+    for name, entry in profile["variables"].items():
+        before = baseline["variables"].get(name, {}).get("seconds")
+        now = entry.get("seconds")
+        if before is None or now is None:
+            continue
+        if now >= before * REGRESSION_FACTOR and now - before >= REGRESSION_SECONDS:
+            slower[name] = {"seconds": now, "baseline_seconds": before}
+    return slower
+
+
+HTML_COLUMNS = [
+    "query",
+    "hidden",
+    "seconds",
+    "cpu_seconds",
+    "logical_reads",
+    "physical_reads",
+    "temp_table_rows",
+    "temp_table_kb",
+    "null_fraction",
+    "cardinality",
+]
+
+
+def profile_html(profile):
+    def cell(value):
+        return f"<td>{'' if value is None else html.escape(str(value))}</td>"
+
+    slower = profile.get("regressions", {})
+    ordered = sorted(
+        profile["variables"].items(),
+        key=lambda item: item[1].get("seconds") or 0,
+        reverse=True,
+    )
+    rows = [
+        f"<tr{' class=slower' if name in slower else ''}>{cell(name)}"
+        + "".join(cell(entry.get(column)) for column in HTML_COLUMNS)
+        + "</tr>"
+        for name, entry in ordered
+    ]
+    total = sum(entry.get("seconds") or 0 for entry in profile["variables"].values())
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Extraction profile</title>
+<style>
+  body {{ font-family: sans-serif; }}
+  table {{ border-collapse: collapse; }}
+  td, th {{ border: 1px solid #ccc; padding: 2px 6px; text-align: right; }}
+  td:first-child {{ text-align: left; }}
+  tr.slower {{ background: #fdd; }}
+</style>
+</head>
+<body>
+<h1>Extraction profile</h1>
+<p>{profile['patients']} patients; {total:.1f}s in variable queries,
+{profile['join']['seconds']:.1f}s in the output join.
+{len(slower)} variables slower than the baseline are highlighted.</p>
+<table>
+<tr><th>variable</th>{''.join(f'<th>{column}</th>' for column in HTML_COLUMNS)}</tr>
+{chr(10).join(rows)}
+</table>
+</body>
+</html>
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--output", default="output/extraction_profile.json")
+    parser.add_argument("--baseline", help="profile JSON from an earlier run")
+    args = parser.parse_args()
+
+    sys.path.insert(0, "./analysis")
+    study = __import__(args.study_definition).study
+    if study.backend is None:
+        sys.exit("DATABASE_URL is not set; profiling needs a database")
+
+    profile = profile_study(study)
+    if args.baseline:
+        with open(args.baseline) as f:
+            profile["regressions"] = regressions(profile, json.load(f))
+        for name, entry in profile["regressions"].items():
+            print(f"{name} slower: {entry['baseline_seconds']}s -> {entry['seconds']}s")
+    with open(args.output, "w") as f:
+        json.dump(profile, f, indent=2)
+    with open(re.sub(r"\.json$", "", args.output) + ".html", "w") as f:
+        f.write(profile_html(profile))
+    print(f"Wrote profile of {len(profile['variables'])} variables to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Find event-table scans that several study definition variables share.
+
+cohortextractor turns every variable into its own query, so two variables
+that filter the same table with the same codelist each scan it separately.
+This pass groups variables by scan predicate: the event table plus every
+argument that selects rows (codelist, pathogen, diagnoses, ...), excluding
+the date window and the reduction (first/last date, flag, count, value).
+Each group only needs one scan, materialised once over the widest of its
+windows, with the per-variable windows and reductions applied to that.
+
+Run `python analysis/query_plan.py` for a report of the scans saved.
+"""
+import json
+
+# Event table scanned by each query type. Demographic, registration and
+# derived (categorised_as, value_from, aggregate_of) columns aren't event
+# scans and are left out of the plan
+EVENT_TABLES = {
+    "with_these_clinical_events": "clinical_events",
+    "mean_recorded_value": "clinical_events",
+    "most_recent_bmi": "clinical_events",
+    "with_these_medications": "medications",
+    "with_test_result_in_sgss": "sgss_tests",
+    "admitted_to_hospital": "apcs",
+    "with_these_codes_on_death_certificate": "ons_deaths",
+    "with_tpp_vaccination_record": "vaccinations",
+}
+
+# Arguments that pick the date window or the reduction applied to the
+# matching rows, rather than which rows match
+WINDOW_ARGS = {"between"}
+REDUCTION_ARGS = {
+    "returning",
+    "find_first_match_in_period",
+    "find_last_match_in_period",
+    "on_most_recent_day_of_measurement",
+    "include_date_of_match",
+    "date_format",
+    "column_type",
+    "hidden",
+    "return_expectations",
+}
+
+
+def _freeze(value):
+    # Codelists are compared by contents, not identity, so two separately
+    # loaded copies of the same CSV still share a scan
+    if hasattr(value, "system"):
+        return ("codelist", value.system, frozenset(value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+def scan_predicate(funcname, kwargs):
+    """
+    Return a hashable (table, filters) key for an event query, or None if
+    the query doesn't scan an event table
+    """
+    table = EVENT_TABLES.get(funcname)
+    if table is None:
+        return None
+    filters = tuple(
+        (arg, _freeze(value))
+        for arg, value in sorted(kwargs.items())
+        if arg not in WINDOW_ARGS and arg not in REDUCTION_ARGS and value is not None
+    )
+    return table, filters
+
+
+def describe_reduction(funcname, kwargs):
+    returning = kwargs.get("returning") or funcname
+    if kwargs.get("find_first_match_in_period"):
+        returning = f"first {returning}"
+    elif kwargs.get("find_last_match_in_period"):
+        returning = f"last {returning}"
+    start, end = kwargs.get("between") or (None, None)
+    return f"{returning} [{start or '-'}, {end or '-'}]"
+
+
+def shared_scans(covariate_definitions):
+    """
+    Group event-scanning variables by scan predicate. Returns a list of
+    (table, [(variable, reduction), ...]) in study definition order, one per
+    distinct scan
+    """
+    groups = {}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        predicate = scan_predicate(funcname, kwargs)
+        if predicate is None:
+            continue
+        groups.setdefault(predicate, []).append(
+            (name, describe_reduction(funcname, kwargs))
+        )
+    return [(predicate[0], members) for predicate, members in groups.items()]
+
+
+def derivable_unions(covariate_definitions):
+    """
+    Find variables whose codelist is the union of the codelists of other
+    variables with the same table, filters, window and reduction. A first or
+    last date (or a flag) over the union is the min/max (or OR) of the
+    component columns, e.g. patients.minimum_of(...), so needs no scan
+    """
+    queries = {}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        codes = kwargs.get("codelist")
+        predicate = scan_predicate(funcname, kwargs)
+        if predicate is None or codes is None:
+            continue
+        table, filters = predicate
+        others = tuple(item for item in filters if item[0] != "codelist")
+        key = (table, others, describe_reduction(funcname, kwargs))
+        queries[name] = (key, frozenset(codes))
+
+    derivable = {}
+    for name, (key, codes) in queries.items():
+        parts = [
+            other
+            for other, (other_key, other_codes) in queries.items()
+            if other != name and other_key == key and other_codes < codes
+        ]
+        covered = frozenset().union(*(queries[part][1] for part in parts))
+        if len(parts) > 1 and covered == codes:
+            derivable[name] = parts
+    return derivable
+
+
+def plan_report(covariate_definitions):
+    scans = shared_scans(covariate_definitions)
+    queries = sum(len(members) for _, members in scans)
+    return {
+        "queries": queries,
+        "scans": len(scans),
+        "scans_saved": queries - len(scans),
+        "shared": [
+            {"table": table, "variables": dict(members)}
+            for table, members in scans
+            if len(members) > 1
+        ],
+        "derivable_unions": derivable_unions(covariate_definitions),
+    }
+
+
+if __name__ == "__main__":
+    import sys
+
+    sys.path.insert(0, "./analysis")
+    from study_definition import study
+
+    report = plan_report(study.covariate_definitions)
+    for group in report["shared"]:
+        print(f"{group['table']}: one scan for {len(group['variables'])} variables")
+        for name, reduction in group["variables"].items():
+            print(f"    {name:<32} {reduction}")
+    for name, parts in report["derivable_unions"].items():
+        print(f"{name} could be derived from {', '.join(parts)} without a scan")
+    print(
+        f"{report['queries']} event queries need {report['scans']} scans "
+        f"({report['scans_saved']} saved)"
+    )
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "w") as f:
+            json.dump(report, f, indent=2)
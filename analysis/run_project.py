@@ -0,0 +1,271 @@
+"""
+Run project.yaml actions locally, in parallel where their needs allow.
+
+Run one after another, a local iteration costs the sum of every action,
+although after crINPUT the Stata and Python branches don't depend on each
+other. This builds the `needs:` graph and starts each action as soon as
+everything it needs has succeeded, at most --workers at a time and within
+--memory-mb of estimated peak memory (an action's peak from its last run
+here, else DEFAULT_ACTION_MB). Ready actions with the longest estimated path
+to the end of the run start first, so a run takes about as long as its
+critical path.
+
+An action is skipped as up to date when its outputs exist and nothing it
+reads has changed since it last succeeded: its command, its scripts (and the
+analysis modules a Python script imports), the outputs of its needs, the
+lookups, and for Stata the adofiles. These are compared by content hash;
+digests are cached in --state by file size and modification time, so
+unchanged cohorts aren't re-read every run.
+
+generate_cohort runs the installed `cohortextractor`, or dummy_data.py with
+--dummy-rows. Each action's output goes to metadata/<action>.log, as with
+the job runner. Run from the repository root:
+
+    python analysis/run_project.py --dummy-rows 100000 anCOX anCASE
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+from benchmark_pipeline import command, load_actions, output_paths, run_measured, with_needs
+
+# Assumed peak memory of an action that hasn't run here yet
+DEFAULT_ACTION_MB = 1024
+
+# Default --memory-mb, as a share of physical memory
+MEMORY_FRACTION = 0.8
+
+# Read by every action, and by every Stata action
+SHARED_INPUTS = ["lookups"]
+STATA_INPUTS = ["analysis/adofiles"]
+
+IMPORT_RE = re.compile(r"^\s*(?:from|import)\s+(\w+)", re.MULTILINE)
+
+SUCCEEDED = ["ok", "up to date"]
+
+
+def topological(actions, names):
+    """`names` ordered so every action comes after its needs"""
+    ordered, visiting = [], set()
+
+    def visit(name):
+        if name in ordered:
+            return
+        if name in visiting:
+            raise ValueError(f"Action {name} needs itself")
+        visiting.add(name)
+        for need in actions[name].get("needs") or []:
+            visit(need)
+        ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return ordered
+
+
+def critical_paths(actions, names, seconds):
+    """Estimated seconds from the start of each action to the end of the run"""
+    remaining = {}
+    for name in reversed(names):
+        dependents = [other for other in names if name in (actions[other].get("needs") or [])]
+        remaining[name] = seconds(name) + max((remaining[other] for other in dependents), default=0)
+    return remaining
+
+
+def files_under(path):
+    if os.path.isfile(path):
+        return [path]
+    found = []
+    for root, dirs, names in os.walk(path):
+        dirs[:] = [name for name in dirs if name != "__pycache__"]
+        found += [os.path.join(root, name) for name in names]
+    return sorted(found)
+
+
+def expand(patterns):
+    return sorted(path for pattern in patterns for path in glob.glob(pattern))
+
+
+def script_files(args):
+    """Files named in an action's arguments, and the analysis modules they import"""
+    pending = [arg for arg in args if os.path.isfile(arg)]
+    # cohortextractor's --study-definition names a module
+    pending += [f"analysis/{arg}.py" for arg in args if os.path.isfile(f"analysis/{arg}.py")]
+    found = set()
+    while pending:
+        path = pending.pop()
+        if path in found:
+            continue
+        found.add(path)
+        if path.endswith(".py"):
+            with open(path) as f:
+                modules = IMPORT_RE.findall(f.read())
+            pending += [
+                f"analysis/{module}.py"
+                for module in modules
+                if os.path.isfile(f"analysis/{module}.py")
+            ]
+    return sorted(found)
+
+
+def input_files(actions, name):
+    image, *args = actions[name]["run"].split()
+    paths = script_files(args)
+    for directory in SHARED_INPUTS + (STATA_INPUTS if image.startswith("stata") else []):
+        paths += files_under(directory)
+    for need in actions[name].get("needs") or []:
+        paths += expand(output_paths(actions[need]))
+    return paths
+
+
+def file_digest(path, cache):
+    """sha256 of a file, reused from `cache` while its size and mtime match"""
+    stat = os.stat(path)
+    key = [stat.st_size, stat.st_mtime_ns]
+    cached = cache.get(path)
+    if cached and cached[:2] == key:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    cache[path] = key + [digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def action_digest(actions, name, cmd, cache):
+    digest = hashlib.sha256(json.dumps([cmd, actions[name]], sort_keys=True).encode())
+    for path in input_files(actions, name):
+        digest.update(f"{path}\0{file_digest(path, cache)}\n".encode())
+    return digest.hexdigest()
+
+
+def outputs_exist(action):
+    return all(glob.glob(pattern) for pattern in output_paths(action))
+
+
+def load_state(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"actions": {}, "files": {}}
+
+
+def save_state(state, path):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def start(name, cmd, done):
+    """Run `cmd` in a thread, putting (name, exit code, seconds, MB) on `done`"""
+
+    def target():
+        with open(f"metadata/{name}.log", "w") as log:
+            try:
+                result = run_measured(cmd, ".", log=log)
+            except OSError as e:
+                print(e, file=log)
+                result = (-1, 0.0, 0.0)
+        done.put((name, *result))
+
+    threading.Thread(target=target, daemon=True).start()
+
+
+def run(actions, names, commands, state, state_path, workers, memory_mb, force=False):
+    """Run `names` (with their needs among them), returning {action: status}"""
+    records, cache = state["actions"], state["files"]
+    remaining = critical_paths(
+        actions, names, lambda name: records.get(name, {}).get("seconds", 1)
+    )
+    pending = sorted(names, key=lambda name: -remaining[name])
+    status, digests, running = {}, {}, {}
+    done = queue.Queue()
+
+    while pending or running:
+        progressed = False
+        for name in list(pending):
+            needs = actions[name].get("needs") or []
+            if any(status.get(need) is None for need in needs):
+                continue
+            if commands[name] is None or any(status[need] not in SUCCEEDED for need in needs):
+                status[name] = "skipped"
+            else:
+                if name not in digests:
+                    digests[name] = action_digest(actions, name, commands[name], cache)
+                record = records.get(name, {})
+                if not force and record.get("hash") == digests[name] and outputs_exist(actions[name]):
+                    status[name] = "up to date"
+                else:
+                    mb = record.get("peak_rss_mb", DEFAULT_ACTION_MB)
+                    # An action too large for the budget still runs on its own
+                    if running and (
+                        len(running) >= workers or sum(running.values()) + mb > memory_mb
+                    ):
+                        continue
+                    running[name] = mb
+                    start(name, commands[name], done)
+                    status[name] = None
+            pending.remove(name)
+            progressed = True
+            print(f"{name}: {status[name] or 'started'}")
+        if progressed or not running:
+            continue
+
+        name, code, seconds, rss = done.get()
+        del running[name]
+        status[name] = "ok" if code == 0 else f"failed ({code})"
+        records[name] = {"seconds": seconds, "peak_rss_mb": rss}
+        if code == 0:
+            records[name]["hash"] = digests[name]
+        save_state(state, state_path)
+        print(f"{name}: {status[name]} in {seconds:.1f}s, {rss:.0f} MB (metadata/{name}.log)")
+    return status
+
+
+def physical_mb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("actions", nargs="*", help="actions to run with their needs (default all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--memory-mb", type=float, default=int(physical_mb() * MEMORY_FRACTION))
+    parser.add_argument("--dummy-rows", type=int, help="build the cohort with dummy_data.py")
+    parser.add_argument("--stata", default=os.environ.get("STATA", "stata-mp"))
+    parser.add_argument("--force", action="store_true", help="rerun up to date actions")
+    parser.add_argument("--state", default="metadata/run_project.json")
+    args = parser.parse_args()
+
+    actions = load_actions()
+    names = topological(actions, with_needs(actions, args.actions or list(actions)))
+    commands = {name: command(actions[name], args.stata, args.dummy_rows) for name in names}
+    for directory in ["output", "logs", "metadata"]:
+        os.makedirs(directory, exist_ok=True)
+
+    state = load_state(args.state)
+    start_time = time.perf_counter()
+    status = run(
+        actions, names, commands, state, args.state, args.workers, args.memory_mb, args.force
+    )
+    save_state(state, args.state)
+
+    elapsed = time.perf_counter() - start_time
+    total = sum(state["actions"][name]["seconds"] for name in names if status[name] == "ok")
+    print(f"\nFinished in {elapsed:.1f}s; the actions run took {total:.1f}s in total")
+    for name in names:
+        print(f"  {name:<16} {status[name]}")
+    if any(status[name] not in SUCCEEDED for name in names):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Run the analysis modules' self checks.
+
+Each module in MODULES has a self_check() that runs its pure functions on a
+few hand-made rows and asserts what they return, so the checkPY action fails
+in CI (which runs every project.yaml action on dummy data) when one of them
+changes behaviour. They need no cohort or database. The checks that compare
+whole outputs with a slow reference (household_exposures.py --check,
+interval_join.py --check, measurements.py --check) stay separate, as they
+need a cohort or take minutes.
+
+    python analysis/self_checks.py
+"""
+import argparse
+import importlib
+import time
+
+# Modules with a self_check(), in the order they run
+MODULES = [
+    "cr_case_cube",
+    "an_case_counts",
+    "cr_convert_cohort",
+    "codelists",
+    "msoa_lookup",
+    "comorbidities",
+    "cr_analysis_dataset",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="output/self_checks.txt")
+    args = parser.parse_args()
+
+    lines = []
+    for name in MODULES:
+        start = time.perf_counter()
+        importlib.import_module(name).self_check()
+        lines.append(f"{name:<24} ok {time.perf_counter() - start:.2f}s")
+        print(lines[-1])
+    with open(args.output, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+if __name__ == "__main__":
+    main()
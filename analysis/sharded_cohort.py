@@ -0,0 +1,168 @@
+"""
+Extract the cohort in per-STP shards, concurrently and resumably.
+
+The study population (everyone registered 2019-09-01 to 2020-09-01) is
+otherwise extracted in one query, so any failure restarts all of England.
+This first extracts just the `stp` variable to find the distinct values,
+then runs generate_cohort once per value with `--param shard=stp=<value>`,
+which makes restrict_to_shard() (shards.py) in the study definition limit the
+population to that STP. Patients with no STP get a shard of their own, so
+no one is lost.
+
+Shards run as up to --jobs concurrent generate_cohort processes, and each
+completed shard is checkpointed under .cache/shards/, keyed by a hash of the
+whole study definition and the --snapshot label. Failed shards are retried
+up to --retries times; rerunning the command re-extracts only the shards
+that have no checkpoint. The shards are then concatenated into --output.
+
+Only variable values can partition the population: the study definition
+language has no predicate on patient_id, so hash-range shards aren't
+possible.
+
+Sharding gives resumability and failure isolation, not throughput. The TPP
+backend builds each variable's temporary table over every patient and only
+applies the population in the final WHERE, so every shard still scans
+CodedEvent, SGSS, APCS and the other tables for all of England: N shards
+cost about N times one full extraction, and --jobs of them run those scans
+concurrently. Use it when restarting a failed full extraction costs more
+than that. Run from the repository root inside the cohortextractor
+environment:
+
+    python analysis/sharded_cohort.py --jobs 4 --output output/input.feather
+"""
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from incremental_cohort import substudy, variable_hashes
+
+CACHE_DIR = Path(".cache/shards")
+
+
+def load_study(name):
+    sys.path.insert(0, "./analysis")
+    return __import__(name).study
+
+
+def study_hash(study, snapshot):
+    hashes = variable_hashes(study.covariate_definitions, snapshot)
+    return hashlib.sha256("".join(sorted(hashes.values())).encode()).hexdigest()[:16]
+
+
+def shard_values(study, key, path):
+    """Distinct values of the shard key variable over the population"""
+    substudy(study, {key}).to_file(path)
+    values = pd.read_feather(path)[key].astype(object).fillna("")
+    os.unlink(path)
+    return sorted(set(values))
+
+
+def shard_path(run_dir, value):
+    return run_dir / f"{value or '_missing'}.feather"
+
+
+def extract_shard(study_definition, key, value, path):
+    """Extract one shard, writing `path` only once it's complete"""
+    partial = path.with_suffix(".partial.feather")
+    subprocess.run(
+        [
+            shutil.which("cohortextractor") or "cohortextractor",
+            "generate_cohort",
+            "--study-definition",
+            study_definition,
+            "--output-file",
+            str(partial),
+            "--param",
+            f"shard={key}={value}",
+        ],
+        check=True,
+    )
+    os.replace(partial, path)
+    return value
+
+
+def run_shards(args, key, values, run_dir):
+    """Extract every shard without a checkpoint; return the values that failed"""
+    todo = [value for value in values if not shard_path(run_dir, value).exists()]
+    print(f"{len(values) - len(todo)} shards checkpointed, {len(todo)} to extract")
+    # Each shard is its own generate_cohort process, so threads are enough
+    # to keep --jobs of them running
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+        futures = {
+            pool.submit(
+                extract_shard, args.study_definition, key, value, shard_path(run_dir, value)
+            ): value
+            for value in todo
+        }
+        for future in concurrent.futures.as_completed(futures):
+            value = futures[future]
+            try:
+                future.result()
+                print(f"Extracted shard {key}={value!r}")
+            except Exception as e:
+                print(f"Shard {key}={value!r} failed: {e!r}")
+                failed.append(value)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--output", default="output/input.feather")
+    parser.add_argument("--shard-by", default="stp")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--snapshot", default=datetime.date.today().isoformat())
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition)
+    if study.backend is None:
+        sys.exit("DATABASE_URL is not set; use generate_cohort for dummy data")
+    key = args.shard_by
+    if key not in study.covariate_definitions:
+        sys.exit(f"{key} is not a variable in {args.study_definition}")
+
+    run_dir = CACHE_DIR / study_hash(study, args.snapshot)
+    run_dir.mkdir(parents=True, exist_ok=True)
+    values_path = run_dir / "shards.txt"
+    if values_path.exists():
+        values = values_path.read_text().split("\n")
+    else:
+        values = shard_values(study, key, run_dir / "shard_key.feather")
+        values_path.write_text("\n".join(values))
+
+    # See the module docstring
+    print(f"{len(values)} shards: each scans the source tables for every patient")
+    failed = run_shards(args, key, values, run_dir)
+    for attempt in range(args.retries):
+        if not failed:
+            break
+        print(f"Retrying {len(failed)} failed shards (attempt {attempt + 1})")
+        failed = run_shards(args, key, values, run_dir)
+    if failed:
+        sys.exit(f"{len(failed)} shards failed; rerun to extract only those")
+
+    cohort = pd.concat(
+        [pd.read_feather(shard_path(run_dir, value)) for value in values],
+        ignore_index=True,
+    )
+    if not cohort["patient_id"].is_unique:
+        sys.exit("Shards overlap: some patients were extracted more than once")
+    if args.output.endswith(".feather"):
+        cohort.to_feather(args.output)
+    else:
+        cohort.to_csv(args.output, index=False)
+    print(f"Wrote {len(cohort)} patients from {len(values)} shards to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
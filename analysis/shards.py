@@ -0,0 +1,35 @@
+# PER-STP POPULATION SHARDS
+# sharded_cohort.py runs generate_cohort once per shard with
+# `--param shard=<key>=<value>`; the study definition passes its population
+# through restrict_to_shard() to pick that shard out. This only narrows the
+# population: the backend still computes every variable over all patients, so
+# each shard costs about a full extraction. Kept free of pandas so importing
+# the study definition stays cheap.
+import re
+
+# Shard key values are interpolated into a categorised_as expression
+SAFE_VALUE = re.compile(r"^[A-Za-z0-9_]*$")
+
+
+def restrict_to_shard(population, **shard_keys):
+    """
+    Return `population` restricted to the shard picked by the `shard`
+    parameter ("<key>=<value>", passed by sharded_cohort.py as
+    `--param shard=...`), or unchanged when there is none. `shard_keys` maps
+    each key this study can be sharded on to its variable definition
+    """
+    from cohortextractor import params, patients
+
+    shard = params.get("shard")
+    if not shard:
+        return population
+    key, _, value = shard.partition("=")
+    if key not in shard_keys:
+        raise ValueError(f"Can't shard on {key}; expected one of {', '.join(shard_keys)}")
+    if not SAFE_VALUE.match(value):
+        raise ValueError(f"Can't shard on {key} value {value!r}")
+    return patients.satisfying(
+        f"shard_population AND shard_{key} = '{value}'",
+        shard_population=population,
+        **{f"shard_{key}": shard_keys[key]},
+    )
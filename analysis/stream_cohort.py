@@ -0,0 +1,293 @@
+"""
+Extract the cohort, streaming it to the output file in patient_id batches.
+
+generate_cohort pages through its final table in patient_id order, but for
+anything other than CSV it builds the whole cohort as one DataFrame before
+writing it, so peak memory grows with population x columns. This runs the
+same queries and writes each page of --batch-size patients as soon as it
+arrives, so at most one page is held at once:
+
+    .csv              the rows as generate_cohort would write them
+    .parquet          one row group per page
+    .feather/.arrow   one record batch per page (Arrow IPC, as feather)
+
+Columnar pages are typed with cohort_schema.json as crINPUT types the
+cohort: dates, bools and numbers as in generate_cohort's feather output,
+and categories as strings with nulls for missing values, since a category's
+values are only known once every page is in. Unique patient_ids are checked
+as strictly increasing ids instead of by collecting them all.
+
+With --index, `<output>.index.json` records each page's first and last
+patient_id, row offset and row count (and byte offset for CSV), so
+read_patients() can read a range of patients without scanning the file.
+
+Run from the repository root inside the cohortextractor environment:
+
+    python analysis/stream_cohort.py --output output/input.feather --index
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cohort_schema import SCHEMA_PATH, load_schema
+from cr_convert_cohort import ARROW_TYPES, apply_schema
+
+# Patients per page fetched and written; generate_cohort fetches 32000
+BATCH_SIZE = 32_000
+
+# Columnar type of each schema type. Dates are timestamps, as in
+# generate_cohort's feather output (crINPUT reads them as datetimes), and
+# categories stay strings (see above)
+COLUMN_TYPES = {
+    **ARROW_TYPES,
+    "date": pa.timestamp("ns"),
+    "category": pa.string(),
+}
+
+
+def index_path(path):
+    return f"{path}.index.json"
+
+
+def fetch_rows(backend, batch_size):
+    """
+    The cohort as generate_cohort's TPPBackend.to_file() fetches it: a header
+    row, then rows in patient_id order
+    """
+    from cohortextractor.mssql_utils import mssql_fetch_table
+    from cohortextractor.tpp_backend import BACKOFF_FACTOR, RETRIES, SLEEP
+
+    queries = list(backend.queries)
+    if backend.temporary_database:
+        table = backend.save_results_to_temporary_db(queries)
+    else:
+        table = "#final_output"
+        queries[-1] = f"SELECT * INTO {table} FROM ({queries[-1]}) t"
+        queries.append(f"CREATE INDEX ix_patient_id ON {table} (patient_id)")
+        backend.execute_queries(queries)
+    yield from mssql_fetch_table(
+        get_cursor=backend._get_cursor,
+        table=table,
+        key_column="patient_id",
+        batch_size=batch_size,
+        retries=RETRIES,
+        sleep=SLEEP,
+        backoff_factor=BACKOFF_FACTOR,
+    )
+    backend.execute_queries([f"DROP TABLE {table}"])
+
+
+def pages(rows, batch_size):
+    """(headers, lists of up to batch_size rows) from a header-first row iterator"""
+    headers = list(next(rows))
+    id_index = headers.index("patient_id")
+    last_id = None
+    while page := list(itertools.islice(rows, batch_size)):
+        ids = np.array([row[id_index] for row in page])
+        if (last_id is not None and ids[0] <= last_id) or (np.diff(ids) <= 0).any():
+            raise RuntimeError("patient_ids are not unique and increasing")
+        last_id = ids[-1]
+        yield headers, page
+
+
+def arrow_schema(headers, schema):
+    """Columns missing from `schema` are left for Arrow to infer, per page"""
+    return [
+        (column, COLUMN_TYPES.get(schema.get(column, {}).get("type"))) for column in headers
+    ]
+
+
+def page_table(headers, page, schema):
+    df = apply_schema(pd.DataFrame.from_records(page, columns=headers), schema)
+    arrays, fields = [], []
+    for column, arrow_type in arrow_schema(headers, schema):
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # The database returns "" where there's no value
+            values = series.astype(object)
+            series = values.where(values != "")
+        array = pa.array(series, from_pandas=True)
+        if arrow_type is not None:
+            array = array.cast(arrow_type)
+        arrays.append(array)
+        fields.append(pa.field(column, array.type))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+class CsvPages:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.started = False
+
+    def write(self, headers, page, schema):
+        if not self.started:
+            self.writer.writerow(headers)
+            self.started = True
+        self.file.flush()
+        offset = self.file.tell()
+        self.writer.writerows(page)
+        return {"byte_offset": offset}
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetPages:
+    def __init__(self, path):
+        self.path, self.writer = path, None
+
+    def write(self, headers, page, schema):
+        table = page_table(headers, page, schema)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema, compression="zstd")
+        self.writer.write_table(table.cast(self.writer.schema), row_group_size=len(page))
+        return {}
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ArrowPages:
+    def __init__(self, path):
+        self.sink, self.writer = pa.OSFile(path, "wb"), None
+
+    def write(self, headers, page, schema):
+        table = page_table(headers, page, schema)
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = pa.ipc.new_file(self.sink, self.schema)
+        for batch in table.cast(self.schema).to_batches(max_chunksize=len(page)):
+            self.writer.write_batch(batch)
+        return {}
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.sink.close()
+
+
+def page_writer(path):
+    if path.endswith(".csv"):
+        return CsvPages(path)
+    if path.endswith(".parquet"):
+        return ParquetPages(path)
+    if path.endswith((".feather", ".arrow")):
+        return ArrowPages(path)
+    raise ValueError(f"Unsupported output format: {path}")
+
+
+def write_pages(rows, path, schema, batch_size=BATCH_SIZE, index=False):
+    """
+    Write a header-first row iterator to `path` a page at a time, returning
+    the number of rows. With `index`, also write the page index
+    """
+    entries, offset = [], 0
+    writer = page_writer(path)
+    try:
+        for headers, page in pages(rows, batch_size):
+            entry = writer.write(headers, page, schema)
+            id_index = headers.index("patient_id")
+            entries.append(
+                {
+                    "first_patient_id": int(page[0][id_index]),
+                    "last_patient_id": int(page[-1][id_index]),
+                    "row_offset": offset,
+                    "rows": len(page),
+                    **entry,
+                }
+            )
+            offset += len(page)
+    finally:
+        writer.close()
+    if index:
+        with open(index_path(path), "w") as f:
+            json.dump({"pages": entries}, f, indent=1)
+    return offset
+
+
+def read_patients(path, first=None, last=None, columns=None):
+    """
+    Patients with first <= patient_id <= last from a file written with
+    --index, reading only the pages that can hold them
+    """
+    with open(index_path(path)) as f:
+        entries = json.load(f)["pages"]
+    wanted = [
+        number
+        for number, entry in enumerate(entries)
+        if (first is None or entry["last_patient_id"] >= first)
+        and (last is None or entry["first_patient_id"] <= last)
+    ]
+    if columns is not None and "patient_id" not in columns:
+        columns = ["patient_id"] + list(columns)
+    if path.endswith(".csv"):
+        df = read_csv_pages(path, entries, wanted, columns)
+    elif path.endswith(".parquet"):
+        df = pq.ParquetFile(path).read_row_groups(wanted, columns=columns).to_pandas()
+    else:
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            batches = [reader.get_batch(number) for number in wanted]
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+            df = (table.select(columns) if columns else table).to_pandas()
+    in_range = pd.Series(True, index=df.index)
+    if first is not None:
+        in_range &= df["patient_id"] >= first
+    if last is not None:
+        in_range &= df["patient_id"] <= last
+    return df[in_range].reset_index(drop=True)
+
+
+def read_csv_pages(path, entries, wanted, columns):
+    with open(path, newline="") as f:
+        headers = next(csv.reader(f))
+    if not wanted:
+        return pd.DataFrame(columns=columns or headers)
+    start = entries[wanted[0]]["byte_offset"]
+    after = wanted[-1] + 1
+    end = entries[after]["byte_offset"] if after < len(entries) else os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return pd.read_csv(
+        io.BytesIO(data),
+        names=headers,
+        usecols=columns,
+        dtype=str,
+        keep_default_na=False,
+        na_values=[""],
+    ).astype({"patient_id": "int64"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--output", default="output/input.feather")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--index", action="store_true", help="write <output>.index.json")
+    parser.add_argument("--schema", default=SCHEMA_PATH)
+    args = parser.parse_args()
+
+    sys.path.insert(0, "./analysis")
+    study = __import__(args.study_definition).study
+    if study.backend is None:
+        sys.exit("DATABASE_URL is not set; use generate_cohort for dummy data")
+
+    rows = fetch_rows(study.backend, args.batch_size)
+    written = write_pages(rows, args.output, load_schema(args.schema), args.batch_size, args.index)
+    print(f"Wrote {written} patients to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,16 +5,59 @@ from cohortextractor import (
     patients,
     codelist_from_csv,
     codelist,
-    combine_codelists,
     filter_codes_by_category,
 )
 
 # dictionary of MSOA codes (for dummy data)
 from dictionaries import dict_msoa
 
+# weekly RTI exposure windows
+from exposures import weekly_rti_variables
+
+# per-STP population shards (see sharded_cohort.py)
+from shards import restrict_to_shard
+
 # IMPORT CODELIST DEFINITIONS FROM CODELIST.PY (WHICH PULLS THEM FROM
-# CODELIST FOLDER
-from codelists import *
+# CODELIST FOLDER). Codelists are loaded lazily, so only the ones named here
+# are read from disk
+from codelists import (
+    covid_codelist,
+    covid_identification_in_primary_care_case_codes_clinical,
+    covid_identification_in_primary_care_case_codes_test,
+    covid_identification_in_primary_care_case_codes_seq,
+    lrti_codes,
+    rti_codes,
+    aplastic_codes,
+    hiv_codes,
+    permanent_immune_codes,
+    temp_immune_codes,
+    stroke,
+    dementia,
+    clear_smoking_codes,
+    other_neuro,
+    ethnicity_codes,
+    ethnicity_codes_16,
+    chronic_respiratory_disease_codes,
+    asthma_codes,
+    pred_codes,
+    chronic_cardiac_disease_codes,
+    diabetes_codes,
+    lung_cancer_codes,
+    haem_cancer_codes,
+    other_cancer_codes,
+    chronic_liver_disease_codes,
+    creatinine_codes,
+    hba1c_new_codes,
+    hba1c_old_codes,
+    dialysis_codes,
+    organ_transplant_codes,
+    spleen_codes,
+    sickle_cell_codes,
+    ra_sle_psoriasis_codes,
+    systolic_blood_pressure_codes,
+    diastolic_blood_pressure_codes,
+    hypertension_codes,
+)
 
 
 # STUDY DEFINITION
@@ -27,8 +70,10 @@ study = StudyDefinition(
     },
 
    # STUDY POPULATION
-    population=patients.registered_with_one_practice_between(
-        "2019-09-01", "2020-09-01"
+    # Unchanged unless sharded_cohort.py passes --param shard=stp=<code>
+    population=restrict_to_shard(
+        patients.registered_with_one_practice_between("2019-09-01", "2020-09-01"),
+        stp=patients.registered_practice_as_of("2020-09-01", returning="stp_code"),
     ),
 
     dereg_date=patients.date_deregistered_from_all_supported_practices(
@@ -53,15 +98,6 @@ study = StudyDefinition(
 
 
     ### Primary care COVID cases
-    covid_tpp_probable=patients.with_these_clinical_events(
-        combine_codelists(covid_identification_in_primary_care_case_codes_clinical,
-                          covid_identification_in_primary_care_case_codes_test,
-                          covid_identification_in_primary_care_case_codes_seq),
-        return_first_date_in_period=True,
-        include_day=True,
-        return_expectations={"date": {"earliest": "2020-08-20"}, "incidence" : 0.6},
-    ),
-
     covid_tpp_clin=patients.with_these_clinical_events(
         covid_identification_in_primary_care_case_codes_clinical,
         return_first_date_in_period=True,
@@ -83,6 +119,12 @@ study = StudyDefinition(
         return_expectations={"date": {"earliest": "2020-08-20"}, "incidence" : 0.1},
     ),
 
+    # First date over the combined codelists is the earliest of the three
+    # separate first dates, so derive it rather than scanning the events again
+    covid_tpp_probable=patients.minimum_of(
+        "covid_tpp_clin", "covid_tpp_test", "covid_tpp_seq",
+    ),
+
     ### COVID test positive (SGSS)
     first_pos_test_sgss=patients.with_test_result_in_sgss(
        pathogen="SARS-CoV-2",
@@ -145,271 +187,8 @@ study = StudyDefinition(
         return_expectations={"int": {"distribution": "normal", "mean": 2, "stddev": 1}, "incidence": 0.2},
     ),    
 
-    rti_0900=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-06-09", "2020-08-31"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-06-06", "latest": "2020-08-31"}, "incidence" : 0.1},
-    ),
-
-    neg_0900=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_0900 - 5 days", "rti_0900 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),    
-
-    rti_0907=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-09-01", "2020-09-07"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-09-07", "latest": "2020-09-13"}, "incidence" : 0.03},
-    ),
-
-    neg_0907=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_0907 - 5 days", "rti_0907 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),     
-
-    rti_0914=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-09-08", "2020-09-14"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-09-08", "latest": "2020-09-14"}, "incidence" : 0.03},
-    ),
-
-    neg_0914=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_0914 - 5 days", "rti_0914 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),     
-
-    rti_0921=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-09-15", "2020-09-21"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-09-15", "latest": "2020-09-21"}, "incidence" : 0.03},
-    ),
-
-    neg_0921=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_0921 - 5 days", "rti_0921 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),     
-
-    rti_0928=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-09-22", "2020-09-28"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-09-22", "latest": "2020-09-28"}, "incidence" : 0.03},
-    ),
-
-    neg_0928=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_0928 - 5 days", "rti_0928 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),     
-
-    rti_1005=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-09-29", "2020-10-05"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-09-29", "latest": "2020-10-05"}, "incidence" : 0.03},
-    ),
-
-    neg_1005=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_1005 - 5 days", "rti_1005 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),     
-
-    rti_1012=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-10-06", "2020-10-12"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-10-06", "latest": "2020-10-12"}, "incidence" : 0.03},
-    ),
-
-    neg_1012=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_1012 - 5 days", "rti_1012 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),   
-
-    rti_1019=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-10-13", "2020-10-19"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-10-13", "latest": "2020-10-19"}, "incidence" : 0.03},
-    ),
-
-    neg_1019=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_1019 - 5 days", "rti_1019 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),   
-
-    rti_1026=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-10-20", "2020-10-26"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-10-20", "latest": "2020-10-26"}, "incidence" : 0.03},
-    ),
-
-    neg_1026=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_1026 - 5 days", "rti_1026 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),  
-
-    rti_1102=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-10-27", "2020-11-02"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-10-27", "latest": "2020-11-02"}, "incidence" : 0.03},
-    ),
-
-    neg_1102=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_1102 - 5 days", "rti_1102 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),  
-
-    rti_1109=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-11-03", "2020-11-09"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-11-03", "latest": "2020-11-09"}, "incidence" : 0.03},
-    ),
-
-    neg_1109=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_1109 - 5 days", "rti_1109 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),  
-
-    rti_1116=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-11-10", "2020-11-16"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-11-10", "latest": "2020-11-16"}, "incidence" : 0.03},
-    ),
-
-    neg_1116=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_1116 - 5 days", "rti_1116 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),  
-
-    rti_1123=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-11-17", "2020-11-23"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-11-17", "latest": "2020-11-23"}, "incidence" : 0.03},
-    ),
-
-    neg_1123=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_1123 - 5 days", "rti_1123 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),  
-
-    rti_1130=patients.with_these_clinical_events(
-        rti_codes,
-        between=["2020-11-24", "2020-11-30"],
-        returning="date",
-        find_last_match_in_period=True,
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "2020-11-24", "latest": "2020-11-30"}, "incidence" : 0.03},
-    ),
-
-    neg_1130=patients.with_test_result_in_sgss(
-    	pathogen="SARS-CoV-2",
-    	test_result="negative",
-    	between=["rti_1130 - 5 days", "rti_1130 + 5 days"],
-    	returning="binary_flag",
-        find_last_match_in_period=True,
-    	restrict_to_earliest_specimen_date=False,
-    	return_expectations={"incidence" : 0.5},
-	),  
+    # Weekly RTI dates and +/-5 day negative SGSS test flags (rti_0900 ... neg_1130)
+    **weekly_rti_variables(rti_codes),
 
 
     ## DEMOGRAPHIC COVARIATES
@@ -583,6 +362,8 @@ study = StudyDefinition(
         include_month=True,
     ),
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/55
+    # "NOT chronic_respiratory_disease" reuses the first-date column above
+    # (empty if never coded) instead of scanning the same codelist again
     asthma=patients.categorised_as(
         {
             "0": "DEFAULT",
@@ -590,7 +371,7 @@ study = StudyDefinition(
                 (
                   recent_asthma_code OR (
                     asthma_code_ever AND NOT
-                    copd_code_ever
+                    chronic_respiratory_disease
                   )
                 ) AND (
                   prednisolone_last_year = 0 OR 
@@ -601,7 +382,7 @@ study = StudyDefinition(
                 (
                   recent_asthma_code OR (
                     asthma_code_ever AND NOT
-                    copd_code_ever
+                    chronic_respiratory_disease
                   )
                 ) AND
                 prednisolone_last_year > 0 AND
@@ -614,9 +395,6 @@ study = StudyDefinition(
             asthma_codes, between=["2017-02-01", "2020-09-01"],
         ),
         asthma_code_ever=patients.with_these_clinical_events(asthma_codes),
-        copd_code_ever=patients.with_these_clinical_events(
-            chronic_respiratory_disease_codes
-        ),
         prednisolone_last_year=patients.with_these_medications(
             pred_codes,
             between=["2019-09-01", "2020-09-01"],